@@ -0,0 +1,128 @@
+"""Sales figures of festivals read from SalesRollup table.
+
+Rollups are kept by ticket state transitions in classes.py and
+cascades.py (reservation, approval, cancellation, cancellation of approved
+ticket decreases approvals), so their totals equal current states of
+tickets and dashboards never scan Ticket table. Tickets
+created or changed by other means (imports, seed data, manual fixes) are
+added by periodic reconcile(), which compares totals of rollups with one
+grouped query over Ticket table and records the differences to today's
+rollup.
+"""
+from sqlalchemy import case, func
+from classes import db, Festival, SalesRollup, Ticket
+
+# Totals of festival without tickets
+NO_SALES = (0,) * len(SalesRollup.counters)
+
+
+def ticket_totals(fest_ids=None):
+    """Totals of counters of SalesRollup computed from Ticket table"""
+    price = func.coalesce(Ticket.price, 0)
+    query = db.session.query(
+        Ticket.fest_id,
+        func.count(Ticket.ticket_id),
+        func.sum(case([(Ticket.approved == 1, 1)], else_=0)),
+        func.sum(case([(Ticket.approved == 2, 1)], else_=0)),
+        func.sum(price),
+        func.sum(case([(Ticket.approved == 1, price)], else_=0)),
+        func.sum(case([(Ticket.approved == 2, price)], else_=0)),
+    ).group_by(Ticket.fest_id)
+    if fest_ids is not None:
+        query = query.filter(Ticket.fest_id.in_(fest_ids))
+    return {row[0]: [int(value or 0) for value in row[1:]] for row in query}
+
+
+def rollup_totals(fest_ids=None):
+    query = db.session.query(
+        SalesRollup.fest_id,
+        *[func.sum(getattr(SalesRollup, name)) for name in SalesRollup.counters],
+    ).group_by(SalesRollup.fest_id)
+    if fest_ids is not None:
+        query = query.filter(SalesRollup.fest_id.in_(fest_ids))
+    return {row[0]: [int(value or 0) for value in row[1:]] for row in query}
+
+
+def reconcile(fest_ids=None):
+    """Record differences between Ticket table and rollups to today's rollups
+
+    Returns:
+        dict fest_id -> dict of recorded differences
+    """
+    tickets = ticket_totals(fest_ids)
+    rollups = rollup_totals(fest_ids)
+    fixed = {}
+    for fest_id in set(tickets) | set(rollups):
+        expected = tickets.get(fest_id, NO_SALES)
+        current = rollups.get(fest_id, NO_SALES)
+        deltas = {
+            name: want - have
+            for name, want, have in zip(SalesRollup.counters, expected, current)
+            if want != have
+        }
+        if deltas:
+            SalesRollup.record(fest_id, **deltas)
+            fixed[fest_id] = deltas
+    db.session.commit()
+    return fixed
+
+
+def summary(fest_ids=None):
+    """Totals of festivals with fill rate (sold tickets / capacity), newest first
+
+    Args:
+        fest_ids: festivals to include, None for all
+    """
+    totals = rollup_totals(fest_ids)
+    query = db.session.query(
+        Festival.fest_id, Festival.fest_name, Festival.time_from, Festival.max_capacity
+    ).order_by(Festival.time_from.desc())
+    if fest_ids is not None:
+        query = query.filter(Festival.fest_id.in_(fest_ids))
+    result = []
+    for fest_id, name, time_from, capacity in query:
+        row = dict(zip(SalesRollup.counters, totals.get(fest_id, NO_SALES)))
+        sold = row["reservations"] - row["cancellations"]
+        row.update(
+            fest_id=fest_id,
+            fest_name=name,
+            time_from=time_from.isoformat(),
+            max_capacity=capacity,
+            sold=sold,
+            fill_rate=round(sold / capacity, 4) if capacity else None,
+        )
+        result.append(row)
+    return result
+
+
+def daily(fest_id, date_from=None, date_to=None):
+    """Rollups of festival by day with running number of sold tickets"""
+    capacity = (
+        db.session.query(Festival.max_capacity).filter_by(fest_id=fest_id).scalar()
+    )
+    query = SalesRollup.query.filter(SalesRollup.fest_id == fest_id)
+    if date_from is not None:
+        sold = (
+            db.session.query(
+                func.sum(SalesRollup.reservations - SalesRollup.cancellations)
+            )
+            .filter(SalesRollup.fest_id == fest_id, SalesRollup.day < date_from)
+            .scalar()
+        )
+        query = query.filter(SalesRollup.day >= date_from)
+    else:
+        sold = 0
+    if date_to is not None:
+        query = query.filter(SalesRollup.day <= date_to)
+    sold = int(sold or 0)
+    days = []
+    for rollup in query.order_by(SalesRollup.day):
+        sold += rollup.reservations - rollup.cancellations
+        row = {name: getattr(rollup, name) for name in SalesRollup.counters}
+        row.update(
+            day=rollup.day.isoformat(),
+            sold=sold,
+            fill_rate=round(sold / capacity, 4) if capacity else None,
+        )
+        days.append(row)
+    return days
@@ -0,0 +1,359 @@
+"""Export and import of database as (compressed) CSV files (PostgreSQL only).
+
+All tables are dumped from one REPEATABLE READ snapshot: coordinator
+transaction exports it with pg_export_snapshot() and every worker connection
+imports it with SET TRANSACTION SNAPSHOT, so tables are consistent with each
+other even when tickets are sold during the export. Tables are dumped in
+parallel and streamed through compressor straight to files.
+
+Directory with backup contains one file per table and manifest.json with
+row counts and SHA-256 checksums of uncompressed CSV data.
+
+Import loads tables in order given by foreign keys, independent tables in
+parallel connections. Every file is streamed by COPY into temporary staging
+table and merged to the real table, so import can be run repeatedly:
+
+    * file with primary key: INSERT ... ON CONFLICT (primary key)
+    * file with unique column (User.user_email): ON CONFLICT on that column
+    * other files (seed data in src/data rely on serial IDs): only rows, which
+      are not in table yet, are inserted in order of file
+
+With mode "skip" conflicting rows are left untouched instead of updated.
+"""
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import psycopg2
+from psycopg2 import extensions
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+from classes import db
+
+MANIFEST = "manifest.json"
+EXTENSIONS = {"gzip": ".csv.gz", "zstd": ".csv.zst", "none": ".csv"}
+
+
+def connect():
+    return psycopg2.connect(os.getenv("DATABASE_URL"))
+
+
+def base_tables(cur):
+    """Names of tables with their estimated sizes, biggest first"""
+    cur.execute(
+        """
+        SELECT t.table_name, coalesce(c.reltuples, 0)
+        FROM information_schema.tables t
+        LEFT JOIN pg_class c ON c.oid = quote_ident(t.table_name)::regclass
+        WHERE t.table_schema = 'public' AND t.table_type = 'BASE TABLE'
+        ORDER BY 2 DESC, 1
+        """
+    )
+    return [name for name, _ in cur.fetchall()]
+
+
+def compression_of(path):
+    for compression, extension in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def open_compressed(path, compression):
+    if compression == "gzip":
+        return gzip.open(path, "wb", compresslevel=6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs package zstandard")
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    if compression == "none":
+        return open(path, "wb")
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def open_decompressed(path, compression):
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs package zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+class ChecksumWriter:
+    """File-like object for COPY TO, hashes data before it is compressed"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.stream.write(data)
+
+
+def dump_table(snapshot, table, directory, compression):
+    """COPY one table inside transaction bound to ``snapshot``"""
+    start = time.perf_counter()
+    path = os.path.join(directory, table + EXTENSIONS[compression])
+    conn = connect()
+    try:
+        # Imported snapshot needs REPEATABLE READ from the first statement
+        conn.set_session(
+            isolation_level=extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
+        )
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        with open_compressed(path, compression) as stream:
+            writer = ChecksumWriter(stream)
+            cur.copy_expert(f'COPY "{table}" TO STDOUT WITH CSV HEADER', writer)
+        rows = cur.rowcount
+        if rows < 0:
+            cur.execute(f'SELECT count(*) FROM "{table}"')
+            rows = cur.fetchone()[0]
+        conn.rollback()
+    finally:
+        conn.close()
+    return {
+        "table": table,
+        "file": os.path.basename(path),
+        "rows": rows,
+        "bytes": writer.size,
+        "compressed_bytes": os.path.getsize(path),
+        "sha256": writer.sha256.hexdigest(),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def export(directory=None, workers=4, compression="gzip"):
+    """Dump all tables to ``directory`` from one consistent snapshot.
+
+    Returns:
+        manifest (dict), which is also written to directory/manifest.json
+    """
+    if directory is None:
+        directory = os.path.join(
+            "src/data/backup", datetime.now().strftime("%Y%m%d-%H%M%S")
+        )
+    os.makedirs(directory)
+    start = time.perf_counter()
+    coordinator = connect()
+    try:
+        coordinator.set_session(
+            isolation_level=extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
+        )
+        cur = coordinator.cursor()
+        tables = base_tables(cur)
+        # Snapshot is valid only while coordinator transaction is open
+        cur.execute("SELECT pg_export_snapshot(), now()")
+        snapshot, taken_at = cur.fetchone()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            dumped = list(
+                pool.map(
+                    lambda table: dump_table(snapshot, table, directory, compression),
+                    tables,
+                )
+            )
+        coordinator.rollback()
+    finally:
+        coordinator.close()
+
+    manifest = {
+        "snapshot_time": taken_at.isoformat(),
+        "compression": compression,
+        "seconds": round(time.perf_counter() - start, 3),
+        "tables": {entry.pop("table"): entry for entry in dumped},
+    }
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class ChecksumReader:
+    """File-like object for COPY FROM, hashes data after it is decompressed"""
+
+    def __init__(self, stream, sha256):
+        self.stream = stream
+        self.sha256 = sha256
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        self.sha256.update(data)
+        return data
+
+
+def table_files(directory):
+    """Map table name to file in ``directory``.
+
+    Files are named by table, optionally with numeric prefix (01-User.csv)
+    and compression extension (User.csv.gz).
+    """
+    tables = set(db.metadata.tables)
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        compression = compression_of(name)
+        if not os.path.isfile(path) or compression is None:
+            continue
+        table = re.sub(r"^\d+-", "", name[: -len(EXTENSIONS[compression])])
+        if table not in tables:
+            raise ValueError(f"File {name} does not belong to any table")
+        files[table] = path
+    return files
+
+
+def dependencies(tables):
+    """Tables (from ``tables``) referenced by foreign keys of every table"""
+    return {
+        name: {
+            key.column.table.name
+            for key in db.metadata.tables[name].foreign_keys
+            if key.column.table.name in tables and key.column.table.name != name
+        }
+        for name in tables
+    }
+
+
+def merge_statement(table, columns, mode):
+    """INSERT from staging table, which makes repeated import idempotent"""
+    staging = f'"_import_{table.name}"'
+    names = ", ".join(f'"{c}"' for c in columns)
+    insert = f'INSERT INTO "{table.name}" ({names}) SELECT {names} FROM {staging} s'
+    keys = [c.name for c in table.primary_key.columns]
+    if not set(keys) <= set(columns):
+        unique = [c.name for c in table.columns if c.unique and c.name in columns]
+        keys = unique[:1]
+    if not keys:
+        same = " AND ".join(f't."{c}" IS NOT DISTINCT FROM s."{c}"' for c in columns)
+        return (
+            f'{insert} WHERE NOT EXISTS (SELECT 1 FROM "{table.name}" t WHERE {same}) '
+            "ORDER BY s._row"
+        )
+    conflict = ", ".join(f'"{k}"' for k in keys)
+    updates = [c for c in columns if c not in keys]
+    if mode == "skip" or not updates:
+        return f"{insert} ORDER BY s._row ON CONFLICT ({conflict}) DO NOTHING"
+    assignments = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in updates)
+    return (
+        f"{insert} ORDER BY s._row "
+        f"ON CONFLICT ({conflict}) DO UPDATE SET {assignments}"
+    )
+
+
+def load_table(name, path, mode, expected=None):
+    """Stream one file to staging table and merge it in single transaction"""
+    start = time.perf_counter()
+    table = db.metadata.tables[name]
+    sha256 = hashlib.sha256()
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        with open_decompressed(path, compression_of(path)) as stream:
+            reader = ChecksumReader(stream, sha256)
+            header = reader.readline().decode()
+            columns = [c.strip() for c in next(csv.reader([header]))]
+            unknown = [c for c in columns if c not in table.columns]
+            if unknown:
+                raise ValueError(f"Table {name} has no columns {', '.join(unknown)}")
+            names = ", ".join(f'"{c}"' for c in columns)
+            cur.execute(
+                f'CREATE TEMP TABLE "_import_{name}" ON COMMIT DROP AS '
+                f'SELECT {names} FROM "{name}" WITH NO DATA'
+            )
+            cur.execute(f'ALTER TABLE "_import_{name}" ADD COLUMN _row bigserial')
+            cur.copy_expert(f'COPY "_import_{name}" ({names}) FROM STDIN CSV', reader)
+        cur.execute(f'SELECT count(*) FROM "_import_{name}"')
+        rows = cur.fetchone()[0]
+        if expected is not None:
+            if expected["sha256"] != sha256.hexdigest() or expected["rows"] != rows:
+                raise ValueError(f"File of table {name} does not match manifest")
+        cur.execute(merge_statement(table, columns, mode))
+        merged = cur.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    seconds = time.perf_counter() - start
+    return {
+        "table": name,
+        "rows": rows,
+        "merged": merged,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
+    }
+
+
+def reset_sequences(tables):
+    """Move serial sequences after the highest imported IDs"""
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        for name in tables:
+            keys = list(db.metadata.tables[name].primary_key.columns)
+            if len(keys) != 1:
+                continue
+            cur.execute(
+                "SELECT pg_get_serial_sequence(%s, %s)", (f'"{name}"', keys[0].name)
+            )
+            sequence = cur.fetchone()[0]
+            if sequence is None:
+                continue
+            cur.execute(
+                f'SELECT setval(%s, coalesce(max("{keys[0].name}"), 1), '
+                f'max("{keys[0].name}") IS NOT NULL) FROM "{name}"',
+                (sequence,),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def restore(directory="src/data", workers=4, mode="upsert"):
+    """Load all table files from ``directory``, parents before children.
+
+    Files are checked against manifest.json when directory has one.
+
+    Returns:
+        list of per-table results in order of completion
+    """
+    if mode not in ("upsert", "skip"):
+        raise ValueError(f"Unknown mode {mode}")
+    files = table_files(directory)
+    manifest = {}
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)["tables"]
+    waiting = dependencies(files)
+    done, results, running = set(), [], {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while waiting or running:
+            for name in [n for n, deps in waiting.items() if deps <= done]:
+                del waiting[name]
+                running[
+                    pool.submit(load_table, name, files[name], mode, manifest.get(name))
+                ] = name
+            if not running:
+                raise ValueError(f"Cyclic foreign keys between {', '.join(waiting)}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future))
+                results.append(future.result())
+    reset_sequences(files)
+    return results
@@ -0,0 +1,995 @@
+"""Benchmarks for hot paths of festival IS. Run them with manage.py (bench_* commands)"""
+import csv
+import io
+import json
+import random
+import statistics
+import time
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, islice
+import boto3
+from datetime import datetime, timedelta
+from sqlalchemy import case, func, or_
+from werkzeug.security import generate_password_hash
+from festival_is import app
+from classes import (
+    db,
+    Admin,
+    Band,
+    Festival,
+    Organizer,
+    Performance,
+    SalesRollup,
+    Seller,
+    SellersList,
+    Stage,
+    Ticket,
+    User,
+)
+import cascades
+import media
+import migrations
+
+BENCH_STYLES = ["rock", "pop", "jazz", "metal", "techno", "folk", "rap", "indie"]
+
+
+def create_bench_festival(capacity):
+    """Create festival owned by root admin, that is used only by benchmark"""
+    now = datetime.now()
+    fest = Festival(
+        fest_name="Benchmark",
+        fest_logo="https://festival-static.s3-eu-west-1.amazonaws.com/def_fest_logo.png",
+        description="Festival created by benchmark",
+        style="bench",
+        address="Bench, Bench street, 1",
+        cost=100,
+        time_from=now + timedelta(days=30),
+        time_to=now + timedelta(days=31),
+        max_capacity=capacity,
+        age_restriction=0,
+        org_id=1,
+        status=0,
+    )
+    db.session.add(fest)
+    db.session.commit()
+    return fest.fest_id
+
+
+def drop_bench_festival(fest_id):
+    Ticket.query.filter_by(fest_id=fest_id).delete()
+    SalesRollup.query.filter_by(fest_id=fest_id).delete()
+    Festival.query.filter_by(fest_id=fest_id).delete()
+    db.session.commit()
+
+
+def reservations(attempts=5000, capacity=1000, workers=10):
+    """Fire ``attempts`` parallel reservations against festival with ``capacity`` places.
+
+    Every worker thread has its own app context, so its own session and
+    connection from pool (keep ``workers`` below pool size + overflow).
+    """
+    with app.app_context():
+        fest_id = create_bench_festival(capacity)
+
+    def reserve(i):
+        with app.app_context():
+            try:
+                Ticket.reserve(
+                    fest_id,
+                    user_email=f"bench{i}@bench.io",
+                    name="Bench",
+                    surname="User",
+                )
+                return True
+            except ValueError:
+                return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        reserved = sum(pool.map(reserve, range(attempts)))
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        sold = Ticket.query.filter_by(fest_id=fest_id).count()
+        counter = Festival.get_festival(fest_id).current_ticket_count
+        drop_bench_festival(fest_id)
+
+    result = {
+        "attempts": attempts,
+        "capacity": capacity,
+        "workers": workers,
+        "reserved": reserved,
+        "tickets": sold,
+        "counter": counter,
+        "oversold": max(sold - capacity, 0),
+        "seconds": round(elapsed, 3),
+        "attempts_per_second": round(attempts / elapsed, 1),
+    }
+    for key, value in result.items():
+        print(f"{key:>20}: {value}")
+    if sold != counter or sold > capacity:
+        print("Capacity counter is inconsistent with sold tickets!")
+    return result
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert_chunks(table, rows, chunk=5000):
+    """Insert rows by multi-row INSERTs of ``chunk`` rows, commit after each of them
+
+    Returns:
+        list of primary keys of inserted rows
+    """
+    key = list(table.primary_key.columns)[0]
+    ids = []
+    for part in chunks(rows, chunk):
+        if db.engine.dialect.name == "postgresql":
+            result = db.session.execute(table.insert().values(part).returning(key))
+            ids += [row[0] for row in result]
+        else:
+            # SQLite has no INSERT ... RETURNING, it is used only for small data
+            for row in part:
+                result = db.session.execute(table.insert().values(row))
+                ids.append(result.inserted_primary_key[0])
+        db.session.commit()
+    return ids
+
+
+def copy_rows(table, columns, rows, chunk=100000):
+    """Load rows (tuples in order of ``columns``) by COPY, much faster than INSERT
+
+    Returns:
+        number of loaded rows
+    """
+    names = ", ".join(f'"{c}"' for c in columns)
+    count = 0
+    for part in chunks(rows, chunk):
+        if db.engine.dialect.name == "postgresql":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(part)
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(f'COPY "{table.name}" ({names}) FROM STDIN CSV', buffer)
+        else:
+            db.session.execute(
+                table.insert(), [dict(zip(columns, row)) for row in part]
+            )
+        db.session.commit()
+        count += len(part)
+    return count
+
+
+def bench_email(token, perms, i):
+    return f"bench-{token}-{perms}-{i}@bench.io"
+
+
+def schedule(rng, stage_ids, time_from, time_to):
+    """Performances of festival: every evening from 14:00 to 23:00 on every stage"""
+    day = time_from.replace(hour=14, minute=0, second=0, microsecond=0)
+    while day < time_to:
+        closing = min(day.replace(hour=23), time_to)
+        for stage_id in stage_ids:
+            slot = max(day, time_from + timedelta(hours=1))
+            while True:
+                end = slot + timedelta(minutes=rng.choice([45, 60, 75, 90]))
+                if end >= closing:
+                    break
+                yield slot, end, stage_id
+                slot = end + timedelta(minutes=rng.choice([15, 20, 30]))
+        day += timedelta(days=1)
+
+
+def seed(
+    users=10000,
+    sellers=100,
+    organizers=20,
+    admins=5,
+    festivals=1000,
+    tickets=200000,
+    bands=500,
+    stages_per_festival=3,
+):
+    """Fill database with synthetic data, every generated name contains word "bench"
+
+    Roles follow inheritance of models: every seller has row in User and
+    Seller, organizer also in Organizer and admin also in Admin table.
+    Festivals have their own stages with non-colliding evening performances,
+    popularity of festivals (number of tickets) is skewed like in real sales.
+
+    Returns:
+        dict with lists of generated IDs
+    """
+    rng = random.Random(42)
+    token = f"{random.getrandbits(32):x}"
+    now = datetime.now()
+    passwd = generate_password_hash("bench", method="sha256")
+
+    def role(count, perms):
+        ids = insert_chunks(
+            User.__table__,
+            (
+                dict(
+                    user_email=bench_email(token, perms, i),
+                    name="Bench",
+                    surname="User",
+                    passwd=passwd,
+                    avatar="https://festival-static.s3-eu-west-1.amazonaws.com/default_avatar.png",
+                    perms=perms,
+                    address="Bench",
+                    active=True,
+                    role_active=True,
+                )
+                for i in range(count)
+            ),
+        )
+        tables = [(Seller, "seller_id"), (Organizer, "org_id"), (Admin, "admin_id")]
+        for model, key in tables[: max(4 - perms, 0)]:
+            insert_chunks(model.__table__, ({key: i} for i in ids))
+        return ids
+
+    user_ids = role(users, 4)
+    seller_ids = role(sellers, 3)
+    org_ids = role(organizers, 2)
+    admin_ids = role(admins, 1)
+
+    band_ids = insert_chunks(
+        Band.__table__,
+        (
+            dict(
+                name=f"bench{i}",
+                logo="No logo",
+                scores=rng.randint(1, 10),
+                genre=rng.choice(BENCH_STYLES),
+                tags=";".join(rng.sample(BENCH_STYLES, 2)),
+                created_on=now.date(),
+            )
+            for i in range(bands)
+        ),
+    )
+
+    fest_rows = []
+    for i in range(festivals):
+        start = now + timedelta(days=rng.randint(-365, 365), hours=rng.randint(8, 16))
+        fest_rows.append(
+            dict(
+                fest_name=f"bench{i}",
+                fest_logo="No logo",
+                description="Festival generated by benchmark",
+                style=rng.choice(BENCH_STYLES),
+                address="Bench",
+                cost=rng.randint(0, 100) * 10,
+                time_from=start,
+                time_to=start + timedelta(days=rng.randint(1, 5)),
+                max_capacity=0,
+                current_ticket_count=0,
+                age_restriction=rng.choice([0, 12, 16, 18]),
+                sale=rng.choice([0, 0, 0, 10, 20]),
+                org_id=rng.choice(org_ids or [1]),
+                status=rng.choice([0, 1, 1, 1, 2]),
+            )
+        )
+    fest_ids = insert_chunks(Festival.__table__, fest_rows)
+
+    # Every festival gets its own stages, so schedules of festivals never collide
+    stage_counts = [rng.randint(1, stages_per_festival) for _ in fest_ids]
+    stage_ids = insert_chunks(
+        Stage.__table__,
+        (
+            dict(size=rng.choice([500, 1000, 2000, 5000]), removed=False)
+            for _ in range(sum(stage_counts))
+        ),
+    )
+    fest_stages, position = {}, 0
+    for fest_id, count in zip(fest_ids, stage_counts):
+        fest_stages[fest_id] = stage_ids[position : position + count]
+        position += count
+    copy_rows(
+        Performance.__table__,
+        ("fest_id", "stage_id", "band_id", "canceled", "time_from", "time_to"),
+        (
+            (fest_id, stage_id, rng.choice(band_ids), False, start, end)
+            for fest_id, fest in zip(fest_ids, fest_rows)
+            for start, end, stage_id in schedule(
+                rng, fest_stages[fest_id], fest["time_from"], fest["time_to"]
+            )
+        ),
+    )
+    insert_chunks(
+        SellersList.__table__,
+        (
+            dict(fest_id=rng.choice(fest_ids), seller_id=rng.choice(seller_ids))
+            for _ in range(festivals)
+        ),
+    )
+
+    # Popularity of festivals follows power law
+    weights = list(accumulate(1 / (rank + 1) ** 0.8 for rank in range(len(fest_ids))))
+    popular = fest_ids[:]
+    rng.shuffle(popular)
+    prices = {
+        fest_id: int(Festival.ticket_price(fest["cost"], fest["sale"]))
+        for fest_id, fest in zip(fest_ids, fest_rows)
+    }
+
+    def ticket(_):
+        i = rng.randrange(len(user_ids))
+        fest_id = rng.choices(popular, cum_weights=weights)[0]
+        registered = rng.random() < 0.8
+        return (
+            bench_email(token, 4, i),
+            user_ids[i] if registered else None,
+            fest_id,
+            "Bench",
+            "User",
+            prices[fest_id],
+            rng.choice([0, 1, 1, 2]),
+        )
+
+    copy_rows(
+        Ticket.__table__,
+        ("user_email", "user_id", "fest_id", "name", "surname", "price", "approved"),
+        map(ticket, range(tickets)),
+    )
+
+    festival = Festival.__table__
+    sold = (
+        db.session.query(func.count(Ticket.ticket_id))
+        .filter(Ticket.fest_id == festival.c.fest_id, Ticket.approved != 2)
+        .correlate(festival)
+        .as_scalar()
+    )
+    stages_of_fest = (
+        db.session.query(Performance.stage_id)
+        .filter(Performance.fest_id == festival.c.fest_id)
+        .correlate(festival)
+    )
+    capacity = (
+        db.session.query(func.coalesce(func.sum(Stage.size), 0))
+        .filter(Stage.stage_id.in_(stages_of_fest))
+        .correlate(festival)
+        .as_scalar()
+    )
+    for part in chunks(fest_ids, 5000):
+        db.session.execute(
+            festival.update()
+            .where(festival.c.fest_id.in_(part))
+            .values(current_ticket_count=sold)
+        )
+        db.session.execute(
+            festival.update()
+            .where(festival.c.fest_id.in_(part))
+            .values(
+                max_capacity=case(
+                    [(capacity > festival.c.current_ticket_count, capacity)],
+                    else_=festival.c.current_ticket_count,
+                )
+            )
+        )
+        db.session.commit()
+    if db.engine.dialect.name == "postgresql":
+        db.engine.execute("ANALYZE")
+    return dict(
+        token=token,
+        users=user_ids,
+        sellers=seller_ids,
+        organizers=org_ids,
+        admins=admin_ids,
+        festivals=fest_ids,
+        stages=stage_ids,
+        bands=band_ids,
+    )
+
+
+def hot_queries(seeded, rng):
+    """Queries on predicates used by classes.py, with random parameters"""
+    i = rng.randrange(len(seeded["users"]))
+    user_id = seeded["users"][i]
+    email = bench_email(seeded["token"], 4, i)
+    fest_id = rng.choice(seeded["festivals"])
+    stage_id = rng.choice(seeded["stages"])
+    seller_id = rng.choice(seeded["sellers"])
+    org_id = rng.choice(seeded["organizers"] or [1])
+    band = f"bench{rng.randrange(len(seeded['bands']))}"
+    moment = datetime.now() + timedelta(days=rng.randint(-365, 365))
+    return {
+        "reservation blocker": lambda: Ticket.pending_count(
+            fest_id=fest_id, user_id=user_id
+        ),
+        "anonymous blocker": lambda: Ticket.pending_count(user_email=email),
+        "tickets of user": lambda: Ticket.query.filter(
+            or_(Ticket.user_id == user_id, Ticket.user_email == email)
+        ).all(),
+        "tickets of festival": lambda: Ticket.query.filter_by(fest_id=fest_id).all(),
+        "stage collisions": lambda: Performance.query.filter(
+            Performance.stage_id == stage_id,
+            Performance.time_from < moment + timedelta(hours=1),
+            Performance.time_to > moment,
+        ).all(),
+        "festival line up": lambda: Performance.query.filter(
+            Performance.fest_id == fest_id, Performance.canceled == False
+        ).all(),
+        "festivals of seller": lambda: SellersList.query.filter_by(
+            seller_id=seller_id
+        ).all(),
+        "festivals of organizer": lambda: Festival.query.filter_by(org_id=org_id)
+        .limit(50)
+        .all(),
+        "band by name": lambda: Band.query.filter_by(name=band).first(),
+        "home page": lambda: Festival.query.filter(Festival.status == 1)
+        .order_by(Festival.time_from, Festival.fest_id)
+        .limit(Festival.page_size)
+        .all(),
+    }
+
+
+def measure(seeded, repeat):
+    """Median latency of every hot query in milliseconds"""
+    rng = random.Random(7)
+    samples = {}
+    for _ in range(repeat):
+        for name, query in hot_queries(seeded, rng).items():
+            start = time.perf_counter()
+            query()
+            samples.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        db.session.rollback()
+    return {name: round(statistics.median(values), 3) for name, values in samples.items()}
+
+
+def indexes(users=10000, festivals=1000, tickets=200000, repeat=50, output=None):
+    """Query latencies on seeded database without and with managed indexes"""
+    with app.app_context():
+        print(f"Seeding {users} users, {festivals} festivals, {tickets} tickets")
+        seeded = seed(users=users, festivals=festivals, tickets=tickets)
+        print("Dropped indexes:", ", ".join(migrations.drop_indexes()))
+        if db.engine.dialect.name == "postgresql":
+            db.engine.execute("ANALYZE")
+        before = measure(seeded, repeat)
+        print("Created indexes:", ", ".join(migrations.create_indexes()))
+        after = measure(seeded, repeat)
+
+    print(f"{'query':>25} {'before ms':>10} {'after ms':>10}")
+    for name in before:
+        print(f"{name:>25} {before[name]:>10} {after[name]:>10}")
+    result = {"before": before, "after": after}
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+# Traffic mix of load test: (weight, perms of logged in user or None, route, URL)
+TRAFFIC = [
+    (30, None, "GET /", lambda s: "/"),
+    (8, None, "GET /?style&sort", lambda s: f"/?style={s.style()}&sort=cost"),
+    (5, None, "GET /?after", lambda s: f"/?after={s.cursor()}"),
+    (22, None, "GET /festival/<id>", lambda s: f"/festival/{s.festival()}"),
+    (12, 4, "GET /my_tickets", lambda s: "/my_tickets"),
+    (8, 3, "GET /my_festivals", lambda s: "/my_festivals"),
+    (
+        6,
+        3,
+        "GET /my_festivals/<id>/manage_tickets",
+        lambda s: f"/my_festivals/{s.festival()}/manage_tickets",
+    ),
+    (4, 2, "GET /manage_sellers", lambda s: "/manage_sellers"),
+    (3, 1, "GET /manage_festivals", lambda s: "/manage_festivals"),
+    (2, 1, "GET /manage_users", lambda s: "/manage_users"),
+]
+
+
+class VirtualUser:
+    """One client of load test with its own random generator and test client"""
+
+    def __init__(self, pool, seed):
+        self.pool = pool
+        self.rng = random.Random(seed)
+        self.client = app.test_client()
+
+    def style(self):
+        return self.rng.choice(BENCH_STYLES)
+
+    def festival(self):
+        return self.rng.choice(self.pool["festivals"])
+
+    def cursor(self):
+        fest_id = self.festival()
+        return f"{self.pool['starts'][fest_id].isoformat()}|{fest_id}"
+
+    def login(self, perms):
+        with self.client.session_transaction() as session:
+            if perms is None:
+                session.pop("_user_id", None)
+            else:
+                session["_user_id"] = str(self.rng.choice(self.pool[perms]))
+                session["_fresh"] = True
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def load_pool(limit=1000):
+    """IDs of seeded users by role and festivals, which virtual users choose from"""
+    pool = {}
+    for perms in (1, 2, 3, 4):
+        pool[perms] = [
+            user_id
+            for (user_id,) in db.session.query(User.user_id)
+            .filter(User.perms == perms, User.user_email.like("bench-%"))
+            .limit(limit)
+        ]
+        if not pool[perms]:
+            raise ValueError(f"No seeded users with perms {perms}, run seed_db first")
+    pool["starts"] = dict(
+        db.session.query(Festival.fest_id, Festival.time_from)
+        .filter(Festival.fest_name.like("bench%"), Festival.status == 1)
+        .limit(limit)
+    )
+    pool["festivals"] = list(pool["starts"])
+    if not pool["festivals"]:
+        raise ValueError("No seeded festivals, run seed_db first")
+    return pool
+
+
+def load(duration=60, clients=20, output=None):
+    """Replay TRAFFIC mix by ``clients`` parallel virtual users for ``duration`` seconds.
+
+    Requests go through Flask test client in this process, so they exercise
+    views, templates and database (use DATABASE_URL of local stand-in of
+    production database seeded by seed_db), without network and web server.
+
+    Returns:
+        dict route -> requests, errors and p50/p95/p99 latencies in milliseconds
+    """
+    app.config["WTF_CSRF_ENABLED"] = False
+    with app.app_context():
+        pool = load_pool()
+    weights = [entry[0] for entry in TRAFFIC]
+
+    def run(seed):
+        user = VirtualUser(pool, seed)
+        samples, errors = {}, {}
+        while time.perf_counter() < deadline:
+            _, perms, route, url = user.rng.choices(TRAFFIC, weights)[0]
+            user.login(perms)
+            start = time.perf_counter()
+            try:
+                failed = user.client.get(url(user)).status_code >= 400
+            except Exception:
+                failed = True
+            samples.setdefault(route, []).append((time.perf_counter() - start) * 1000)
+            errors[route] = errors.get(route, 0) + failed
+        return samples, errors
+
+    samples, errors = {}, {}
+    # Error handlers of views redirect errors to home page, without them
+    # errors are responses with error status
+    handlers = app.error_handler_spec.pop(None, None)
+    deadline = time.perf_counter() + duration
+    try:
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            for client_samples, client_errors in executor.map(run, range(clients)):
+                for route, values in client_samples.items():
+                    samples.setdefault(route, []).extend(values)
+                    errors[route] = errors.get(route, 0) + client_errors[route]
+    finally:
+        if handlers is not None:
+            app.error_handler_spec[None] = handlers
+
+    result = {}
+    for route, values in sorted(samples.items()):
+        values.sort()
+        result[route] = {
+            "requests": len(values),
+            "errors": errors[route],
+            "p50": round(percentile(values, 0.50), 1),
+            "p95": round(percentile(values, 0.95), 1),
+            "p99": round(percentile(values, 0.99), 1),
+        }
+    total = sum(entry["requests"] for entry in result.values())
+    print(f"{'route':>40} {'requests':>9} {'errors':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route, entry in result.items():
+        print(
+            f"{route:>40} {entry['requests']:>9} {entry['errors']:>7} "
+            f"{entry['p50']:>8} {entry['p95']:>8} {entry['p99']:>8}"
+        )
+    print(f"{total} requests in {duration} s, {round(total / duration, 1)} requests/s")
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+def add_stage_with_performances(fest, band_id, count):
+    """New stage with ``count`` hour long performances at the start of festival"""
+    stage = Stage(size=1000, removed=False)
+    db.session.add(stage)
+    db.session.flush()
+    for i in range(count):
+        start = fest.time_from + timedelta(hours=1 + 2 * i)
+        db.session.add(
+            Performance(
+                fest_id=fest.fest_id,
+                stage_id=stage.stage_id,
+                band_id=band_id,
+                canceled=False,
+                time_from=start,
+                time_to=start + timedelta(hours=1),
+            )
+        )
+    db.session.commit()
+    return stage
+
+
+def bench_tickets(fest_id, count, user_id=None):
+    """Insert ``count`` pending and approved tickets of festival"""
+    now = datetime.now()
+    Festival.query.filter_by(fest_id=fest_id).update(
+        {Festival.current_ticket_count: Festival.current_ticket_count + count}
+    )
+    return insert_chunks(
+        Ticket.__table__,
+        (
+            dict(
+                user_email=None if user_id else f"bench{i}@bench.io",
+                user_id=user_id,
+                fest_id=fest_id,
+                name="Bench",
+                surname="User",
+                price=100,
+                approved=i % 2,
+                reserved_at=now,
+            )
+            for i in range(count)
+        ),
+    )
+
+
+def method_cases(seeded):
+    """Domain methods of classes.py measured by bench_methods.
+
+    Every case is function, which prepares data for one call (not measured)
+    and returns the measured call.
+    """
+
+    def pick(key, model):
+        return model.query.filter_by(user_id=random.choice(seeded[key])).first()
+
+    def festival():
+        return Festival.get_festival(random.choice(seeded["festivals"]))
+
+    def reserve_ticket():
+        user, fest_id = pick("users", User), random.choice(seeded["festivals"])
+
+        def call():
+            try:
+                user.reserve_ticket(fest_id)
+            except ValueError:  # sold out or too many pending tickets
+                pass
+
+        return call
+
+    def fest_add_perf():
+        admin, fest = pick("admins", Admin), festival()
+        stage = add_stage_with_performances(fest, random.choice(seeded["bands"]), 0)
+        start = fest.time_from + timedelta(hours=1)
+        end = start + timedelta(hours=1)
+        form = {
+            "band_name": Band.query.get(random.choice(seeded["bands"])).name,
+            "stage_id": str(stage.stage_id),
+            "date_from": start.strftime("%Y-%m-%d"),
+            "time_from": start.strftime("%H:%M"),
+            "date_to": end.strftime("%Y-%m-%d"),
+            "time_to": end.strftime("%H:%M"),
+        }
+        return lambda: admin.fest_add_perf(form, fest.fest_id)
+
+    def fest_del_perf():
+        admin, fest = pick("admins", Admin), festival()
+        stage = add_stage_with_performances(fest, random.choice(seeded["bands"]), 1)
+        perf = Performance.query.filter_by(stage_id=stage.stage_id).first()
+        return lambda: admin.fest_del_perf(perf_id=perf.perf_id)
+
+    def remove_stage():
+        admin, fest = pick("admins", Admin), festival()
+        stage = add_stage_with_performances(fest, random.choice(seeded["bands"]), 3)
+        return lambda: admin.remove_stage(stage.stage_id)
+
+    def new_seller():
+        (seller_id,) = insert_chunks(
+            User.__table__,
+            [
+                dict(
+                    user_email=bench_email(seeded["token"], 3, random.getrandbits(64)),
+                    name="Bench",
+                    surname="User",
+                    passwd="bench",
+                    perms=3,
+                    address="Bench",
+                )
+            ],
+        )
+        insert_chunks(Seller.__table__, [dict(seller_id=seller_id)])
+        insert_chunks(
+            SellersList.__table__,
+            [
+                dict(fest_id=fest_id, seller_id=seller_id)
+                for fest_id in random.sample(seeded["festivals"], 3)
+            ],
+        )
+        return seller_id
+
+    def remove_role():
+        admin, seller_id = pick("admins", Admin), new_seller()
+        return lambda: admin.remove_role(seller_id)
+
+    def remove_user():
+        admin, seller_id = pick("admins", Admin), new_seller()
+        bench_tickets(random.choice(seeded["festivals"]), 5, seller_id)
+        return lambda: admin.remove_user(seller_id)
+
+    def cancel_fest():
+        admin, fest_id = pick("admins", Admin), create_bench_festival(100)
+        bench_tickets(fest_id, 100)
+        return lambda: admin.cancel_fest(fest_id)
+
+    cases = {
+        "reserve_ticket": reserve_ticket,
+        "get_tickets": lambda: pick("users", User).get_tickets,
+        "get_recomendations": lambda: pick("users", User).get_recomendations,
+        "fest_add_perf": fest_add_perf,
+        "fest_del_perf": fest_del_perf,
+        "remove_stage": remove_stage,
+        "remove_role": remove_role,
+        "remove_user": remove_user,
+        "cancel_fest": cancel_fest,
+        "get_festivals": lambda: pick("sellers", Seller).get_festivals,
+        "manage_festivals": lambda: pick("admins", Admin).manage_festivals,
+    }
+    if db.engine.dialect.name != "postgresql":
+        # Reservations need UPDATE ... RETURNING
+        del cases["reserve_ticket"]
+    return cases
+
+
+def measure_methods(seeded, repeat):
+    """Median and 95th percentile of every domain method in milliseconds"""
+    result = {}
+    for name, prepare in method_cases(seeded).items():
+        samples = []
+        for _ in range(repeat):
+            call = prepare()
+            # Some methods print debug output, keep report readable
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                call()
+                samples.append((time.perf_counter() - start) * 1000)
+            db.session.rollback()
+        samples.sort()
+        result[name] = {
+            "median_ms": round(statistics.median(samples), 3),
+            "p95_ms": round(percentile(samples, 0.95), 3),
+        }
+    return result
+
+
+def methods(sizes=(1000, 10000), repeat=20, output=None):
+    """Benchmark domain methods on growing database.
+
+    For every size database is seeded up to ``size`` users, size / 10
+    festivals and size * 10 tickets (run it on empty database).
+
+    Returns:
+        dict with environment and results by size and method
+    """
+    random.seed(13)
+    merged, seeded_size, results = {}, 0, {}
+    with app.app_context():
+        for size in sorted(sizes):
+            delta = size - seeded_size
+            print(f"Seeding up to {size} users, {size // 10} festivals, {size * 10} tickets")
+            seeded = seed(
+                users=delta,
+                sellers=max(delta // 100, 5),
+                organizers=max(delta // 1000, 2),
+                admins=max(delta // 5000, 2),
+                festivals=max(delta // 10, 10),
+                tickets=delta * 10,
+                bands=max(delta // 20, 20),
+            )
+            for key, values in seeded.items():
+                merged[key] = values if key == "token" else merged.get(key, []) + values
+            seeded_size = size
+            results[str(size)] = measure_methods(merged, repeat)
+        dialect = db.engine.dialect.name
+
+    print(f"{'method':>20}" + "".join(f"{size:>12}" for size in results))
+    for name in results[str(sorted(sizes)[0])]:
+        medians = [results[size][name]["median_ms"] for size in results]
+        print(f"{name:>20}" + "".join(f"{median:>12}" for median in medians))
+    report = {
+        "database": dialect,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "repeat": repeat,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(baseline, current, threshold=0.2, noise_ms=0.5):
+    """Compare median latencies of two bench_methods reports.
+
+    Method is regressed when it is slower than baseline by more than
+    ``threshold`` (fraction) and by more than ``noise_ms`` milliseconds.
+
+    Returns:
+        list of (size, method, baseline ms, current ms) of regressed methods
+    """
+    with open(baseline) as f:
+        old = json.load(f)["results"]
+    with open(current) as f:
+        new = json.load(f)["results"]
+    regressions = []
+    print(f"{'size':>8} {'method':>20} {'baseline':>10} {'current':>10} {'change':>8}")
+    for size in sorted(set(old) & set(new), key=int):
+        for name in sorted(set(old[size]) & set(new[size])):
+            before = old[size][name]["median_ms"]
+            after = new[size][name]["median_ms"]
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold and after - before > noise_ms
+            if regressed:
+                regressions.append((size, name, before, after))
+            print(
+                f"{size:>8} {name:>20} {before:>10} {after:>10} {change:>+8.1%}"
+                + ("  REGRESSION" if regressed else "")
+            )
+    return regressions
+
+
+def signing(calls=200):
+    """Latency of presigned POST with new boto3 client per call and with shared one.
+
+    Signing itself needs no request to S3, so it measures construction of
+    client (credentials, endpoints, botocore models) against signing only.
+    """
+    def fresh():
+        boto3.client("s3").generate_presigned_post(
+            Bucket=app.config["S3_BUCKET"], Key="bench/file.png", ExpiresIn=3600
+        )
+
+    def shared():
+        media.sign_post("bench/file.png", "image/png")
+
+    result = {}
+    for name, sign in (("new client", fresh), ("shared client", shared)):
+        samples = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            sign()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        result[name] = {
+            "p50_ms": round(percentile(samples, 0.5), 3),
+            "p95_ms": round(percentile(samples, 0.95), 3),
+            "p99_ms": round(percentile(samples, 0.99), 3),
+        }
+        timings = ", ".join(f"{key} {value}" for key, value in result[name].items())
+        print(f"{name:>15}: {timings}")
+    return result
+
+
+def cascade_timings(sizes=(100, 1000, 10000), repeat=3, output=None):
+    """Time set-based cascades by number of affected tickets.
+
+    For every size: cancel festival with ``size`` tickets, remove stage
+    playing on size / 100 festivals (its removal cancels tickets over new
+    capacity) and remove organizer of size / 100 festivals with ``size``
+    pending reservations. Every call gets fresh data, run it on empty
+    database.
+
+    Returns:
+        dict size -> cascade -> median milliseconds
+    """
+    def prepare_festivals(size, capacity_extra=0, org_id=1):
+        count = max(size // 100, 1)
+        fest_ids = []
+        for _ in range(count):
+            fest_id = create_bench_festival(size // count + capacity_extra)
+            Festival.query.filter_by(fest_id=fest_id).update({"org_id": org_id})
+            bench_tickets(fest_id, size // count, org_id if org_id != 1 else None)
+            fest_ids.append(fest_id)
+        db.session.commit()
+        return fest_ids
+
+    def cancel_fest(size):
+        fest_id = create_bench_festival(size)
+        bench_tickets(fest_id, size)
+        return lambda: cascades.cancel_festivals([fest_id])
+
+    def remove_stage(size):
+        (band_id,) = insert_chunks(
+            Band.__table__,
+            [
+                dict(
+                    name="bench",
+                    logo="No logo",
+                    scores=1,
+                    genre="rock",
+                    created_on=datetime.now().date(),
+                )
+            ],
+        )
+        fests = [
+            Festival.query.get(fest_id)
+            for fest_id in prepare_festivals(size, capacity_extra=500)
+        ]
+        stage = add_stage_with_performances(fests[0], band_id, 0)
+        # Festivals start at the same time, performances on shared stage are
+        # one minute apart (ex_performance_stage_time)
+        insert_chunks(
+            Performance.__table__,
+            [
+                dict(
+                    fest_id=fest.fest_id,
+                    stage_id=stage.stage_id,
+                    band_id=band_id,
+                    canceled=False,
+                    time_from=fest.time_from + timedelta(minutes=i),
+                    time_to=fest.time_from + timedelta(minutes=i + 1),
+                )
+                for i, fest in enumerate(fests)
+            ],
+        )
+        return lambda: cascades.remove_stage(stage.stage_id)
+
+    def remove_user(size):
+        (org_id,) = insert_chunks(
+            User.__table__,
+            [
+                dict(
+                    user_email=bench_email("cascade", 2, random.getrandbits(64)),
+                    name="Bench",
+                    surname="User",
+                    passwd="bench",
+                    perms=2,
+                    address="Bench",
+                )
+            ],
+        )
+        insert_chunks(Seller.__table__, [dict(seller_id=org_id)])
+        insert_chunks(Organizer.__table__, [dict(org_id=org_id)])
+        prepare_festivals(size, org_id=org_id)
+        return lambda: cascades.remove_users([org_id])
+
+    results = {}
+    with app.app_context():
+        for size in sorted(sizes):
+            results[str(size)] = {}
+            for name, prepare in (
+                ("cancel_fest", cancel_fest),
+                ("remove_stage", remove_stage),
+                ("remove_user", remove_user),
+            ):
+                samples = []
+                for _ in range(repeat):
+                    call = prepare(size)
+                    start = time.perf_counter()
+                    call()
+                    samples.append((time.perf_counter() - start) * 1000)
+                results[str(size)][name] = round(statistics.median(samples), 3)
+            print(f"{size} tickets: {results[str(size)]}")
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
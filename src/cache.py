@@ -0,0 +1,86 @@
+"""In-process caches with TTL and hit/miss metrics.
+
+Every gunicorn worker has its own copy of cache, so explicit invalidation
+affects only the worker which made the change. Other workers see the change
+after TTL of entry expires.
+"""
+import time
+from threading import Lock
+
+# All created caches by name, used for metrics endpoint
+caches = {}
+
+
+class TTLCache:
+    def __init__(self, name, ttl=60, max_size=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = {}
+        self._generation = 0
+        self._lock = Lock()
+        caches[name] = self
+
+    def get(self, key, loader):
+        """Return cached value for ``key`` or store result of ``loader()``.
+
+        None (row does not exist yet) is not stored, so a row created later
+        is seen at once.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        value = loader()
+        with self._lock:
+            # Don't store value loaded before invalidation, it can be stale
+            if value is not None and generation == self._generation:
+                self._data.pop(key, None)
+                self._evict(now)
+                self._data[key] = (now + self.ttl, value)
+        return value
+
+    def _evict(self, now):
+        """Drop expired entries and the oldest ones over ``max_size``.
+
+        All entries have the same TTL and are inserted at the end, so the
+        entries are ordered by expiration.
+        """
+        while self._data:
+            key = next(iter(self._data))
+            if self._data[key][0] > now and not (
+                self.max_size and len(self._data) >= self.max_size
+            ):
+                break
+            del self._data[key]
+
+    def invalidate(self, key=None):
+        """Drop entry for ``key`` or whole cache if key is not given"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "name": self.name,
+                "ttl": self.ttl,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / requests, 3) if requests else None,
+            }
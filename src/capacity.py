@@ -0,0 +1,170 @@
+"""Counters of free places of festivals.
+
+Festival.current_ticket_count stays the source of truth, counters only keep
+readers (festival pages, availability stream) and sold out festivals away
+from the hot Festival row. Counter of festival is loaded from database on
+first use and expires after ``ttl`` seconds, so it is reconciled with the
+database at least that often (see reconcile in classes.py for full
+recount from Ticket table).
+
+Backends:
+
+    * LocalCounters: sharded dicts with one lock per shard, every gunicorn
+      worker has its own counters (like caches in cache.py). Places
+      released by other workers are missed until the counter expires, so
+      their refusals are only hints and Festival.take_places checks them by
+      the database
+    * RedisCounters: counters shared by all workers in Redis, reserve and
+      release are Lua scripts, so they are atomic (fakeredis can be used in
+      tests when installed with its lua extra)
+"""
+import time
+from threading import Lock
+
+try:
+    import redis
+except ImportError:  # Redis backend is optional
+    redis = None
+
+# Keys of festivals in Redis
+REDIS_PREFIX = "festival_is:capacity:"
+
+RESERVE_SCRIPT = """
+local left = redis.call('GET', KEYS[1])
+if not left then return -1 end
+if tonumber(left) < tonumber(ARGV[1]) then return 0 end
+redis.call('DECRBY', KEYS[1], ARGV[1])
+return 1
+"""
+RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return false
+"""
+
+
+class LocalCounters:
+    # Counters are not shared by workers, refusal is not final
+    shared = False
+
+    def __init__(self, ttl=30, shards=16):
+        self.ttl = ttl
+        self._shards = [({}, Lock()) for _ in range(shards)]
+
+    def _shard(self, fest_id):
+        return self._shards[hash(fest_id) % len(self._shards)]
+
+    def get(self, fest_id, loader):
+        """Free places of festival, ``loader()`` reads them from database"""
+        data, lock = self._shard(fest_id)
+        now = time.monotonic()
+        with lock:
+            entry = data.get(fest_id)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        free = loader()
+        if free is None:
+            return None
+        with lock:
+            data[fest_id] = [now + self.ttl, free]
+        return free
+
+    def reserve(self, fest_id, count, loader):
+        """Take ``count`` places, False when counter says they are not free"""
+        if self.get(fest_id, loader) is None:
+            return False
+        data, lock = self._shard(fest_id)
+        with lock:
+            entry = data.get(fest_id)
+            if entry is None:
+                # Dropped meanwhile, database decides
+                return True
+            if entry[1] < count:
+                return False
+            entry[1] -= count
+            return True
+
+    def release(self, fest_id, count=1):
+        data, lock = self._shard(fest_id)
+        with lock:
+            entry = data.get(fest_id)
+            if entry is not None:
+                entry[1] += count
+
+    def set(self, fest_id, free):
+        data, lock = self._shard(fest_id)
+        with lock:
+            data[fest_id] = [time.monotonic() + self.ttl, free]
+
+    def forget(self, fest_id):
+        data, lock = self._shard(fest_id)
+        with lock:
+            data.pop(fest_id, None)
+
+    def stats(self):
+        return {
+            "backend": "local",
+            "ttl": self.ttl,
+            "shards": len(self._shards),
+            "festivals": sum(len(data) for data, _ in self._shards),
+        }
+
+
+class RedisCounters:
+    shared = True
+
+    def __init__(self, client, ttl=30):
+        self.client = client
+        self.ttl = ttl
+        self._reserve = client.register_script(RESERVE_SCRIPT)
+        self._release = client.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def key(fest_id):
+        return f"{REDIS_PREFIX}{fest_id}"
+
+    def get(self, fest_id, loader):
+        free = self.client.get(self.key(fest_id))
+        if free is not None:
+            return int(free)
+        free = loader()
+        if free is None:
+            return None
+        # Counter set by other worker meanwhile wins
+        self.client.set(self.key(fest_id), free, ex=self.ttl, nx=True)
+        return free
+
+    def reserve(self, fest_id, count, loader):
+        for _ in range(2):
+            result = self._reserve(keys=[self.key(fest_id)], args=[count])
+            if result != -1:
+                return result == 1
+            if self.get(fest_id, loader) is None:
+                return False
+        # Expired again right after load, database decides
+        return True
+
+    def release(self, fest_id, count=1):
+        self._release(keys=[self.key(fest_id)], args=[count])
+
+    def set(self, fest_id, free):
+        self.client.set(self.key(fest_id), free, ex=self.ttl)
+
+    def forget(self, fest_id):
+        self.client.delete(self.key(fest_id))
+
+    def stats(self):
+        return {"backend": "redis", "ttl": self.ttl}
+
+
+def from_config(config):
+    """Counters by CAPACITY_BACKEND ("local" or "redis") of app config"""
+    ttl = config["CAPACITY_TTL"]
+    if config["CAPACITY_BACKEND"] == "redis":
+        if redis is None:
+            raise ValueError("Redis capacity backend needs package redis")
+        return RedisCounters(redis.Redis.from_url(config["CAPACITY_REDIS_URL"]), ttl)
+    if config["CAPACITY_BACKEND"] == "local":
+        return LocalCounters(ttl, config["CAPACITY_SHARDS"])
+    raise ValueError(f"Unknown capacity backend {config['CAPACITY_BACKEND']}")
@@ -0,0 +1,255 @@
+"""Set-based cascades of cancelling festivals, removing stages, roles and users.
+
+Every cascade changes all affected rows by a few UPDATE and DELETE
+statements and commits once, instead of loading rows and changing them one
+by one. Tickets of affected festivals are cancelled in bulk (sales rollups
+are updated in the same transaction) and sold tickets of the festivals are
+recounted by one UPDATE. Page caches and counters of free places of the
+festivals are dropped after commit.
+
+Festival rows are locked before their tickets, like by reservations.
+Tickets changed by other transactions between counting and cancelling
+them may leave rollups off by few tickets, reconcile_sales fixes that.
+"""
+from sqlalchemy import and_, case, func
+from classes import (
+    db,
+    catalogue,
+    Festival,
+    Performance,
+    SalesRollup,
+    SellersList,
+    Stage,
+    Ticket,
+    User,
+)
+
+# Festivals of organizers who lose their role are moved to root admin
+ROOT_ID = 1
+
+
+def lock_festivals(fest_ids):
+    db.session.query(Festival.fest_id).filter(
+        Festival.fest_id.in_(fest_ids)
+    ).order_by(Festival.fest_id).with_for_update().all()
+
+
+def recount_places(fest_ids):
+    """Set current_ticket_count of festivals to number of not cancelled tickets"""
+    counted = (
+        db.session.query(func.count(Ticket.ticket_id))
+        .filter(Ticket.fest_id == Festival.fest_id, Ticket.approved != 2)
+        .correlate(Festival)
+        .as_scalar()
+    )
+    Festival.query.filter(Festival.fest_id.in_(fest_ids)).update(
+        {Festival.current_ticket_count: counted}, synchronize_session=False
+    )
+
+
+def cancel_tickets(condition, reason):
+    """Cancel not cancelled tickets matching ``condition``, without commit.
+
+    Returns:
+        (IDs of festivals of cancelled tickets, number of cancelled tickets)
+    """
+    price = func.coalesce(Ticket.price, 0)
+    totals = (
+        db.session.query(
+            Ticket.fest_id,
+            func.count(Ticket.ticket_id),
+            func.sum(price),
+            func.sum(case([(Ticket.approved == 1, 1)], else_=0)),
+            func.sum(case([(Ticket.approved == 1, price)], else_=0)),
+        )
+        .filter(condition, Ticket.approved != 2)
+        .group_by(Ticket.fest_id)
+        .all()
+    )
+    if not totals:
+        return [], 0
+    fest_ids = sorted(row[0] for row in totals)
+    lock_festivals(fest_ids)
+    cancelled = Ticket.query.filter(condition, Ticket.approved != 2).update(
+        {Ticket.approved: 2, Ticket.reason: reason}, synchronize_session=False
+    )
+    for fest_id, count, amount, approved, approved_amount in totals:
+        # Cancelled approved tickets are not approved any more
+        SalesRollup.record(
+            fest_id,
+            cancellations=count,
+            cancelled_amount=int(amount),
+            approvals=-int(approved),
+            approved_amount=-int(approved_amount),
+        )
+    recount_places(fest_ids)
+    return fest_ids, cancelled
+
+
+def over_capacity(fest_ids):
+    """Select of IDs of newest not cancelled tickets over capacity of festivals"""
+    ranked = (
+        db.session.query(
+            Ticket.ticket_id,
+            Ticket.fest_id,
+            func.row_number()
+            .over(partition_by=Ticket.fest_id, order_by=Ticket.ticket_id)
+            .label("position"),
+        )
+        .filter(Ticket.fest_id.in_(fest_ids), Ticket.approved != 2)
+        .subquery()
+    )
+    return (
+        db.session.query(ranked.c.ticket_id)
+        .join(Festival, Festival.fest_id == ranked.c.fest_id)
+        .filter(ranked.c.position > Festival.max_capacity)
+    )
+
+
+def finish(fest_ids):
+    """Drop caches of changed festivals after commit"""
+    catalogue.invalidate()
+    Festival.invalidate_page(*fest_ids)
+    Festival.forget_places(*fest_ids)
+
+
+def cancel_festivals(fest_ids, reason="Festival is canceled"):
+    """Cancel festivals with all their tickets, performances and sellers.
+
+    Returns:
+        number of cancelled tickets
+    """
+    fest_ids = sorted(int(fest_id) for fest_id in fest_ids)
+    lock_festivals(fest_ids)
+    Performance.query.filter(Performance.fest_id.in_(fest_ids)).delete(
+        synchronize_session=False
+    )
+    SellersList.query.filter(SellersList.fest_id.in_(fest_ids)).delete(
+        synchronize_session=False
+    )
+    _, cancelled = cancel_tickets(Ticket.fest_id.in_(fest_ids), reason)
+    Festival.query.filter(Festival.fest_id.in_(fest_ids)).update(
+        {Festival.status: 2}, synchronize_session=False
+    )
+    db.session.commit()
+    finish(fest_ids)
+    return cancelled
+
+
+def cancel_performances(condition, reason="Due to capacity reason"):
+    """Cancel performances matching ``condition``, without commit.
+
+    Capacity of affected festivals is set to sum of sizes of distinct stages
+    which still have their not cancelled performances, newest tickets over
+    new capacity are cancelled.
+
+    Returns:
+        (IDs of affected festivals, number of cancelled tickets)
+    """
+    fest_ids = sorted(
+        fest_id
+        for (fest_id,) in db.session.query(Performance.fest_id)
+        .filter(condition, Performance.canceled == False)
+        .distinct()
+    )
+    if not fest_ids:
+        return [], 0
+    lock_festivals(fest_ids)
+    Performance.query.filter(condition, Performance.canceled == False).update(
+        {Performance.canceled: True}, synchronize_session=False
+    )
+    playing = (
+        db.session.query(Performance.stage_id)
+        .filter(Performance.fest_id == Festival.fest_id, Performance.canceled == False)
+        .correlate(Festival)
+    )
+    capacity = (
+        db.session.query(func.coalesce(func.sum(func.coalesce(Stage.size, 0)), 0))
+        .filter(Stage.stage_id.in_(playing))
+        .correlate(Festival)
+        .as_scalar()
+    )
+    Festival.query.filter(Festival.fest_id.in_(fest_ids)).update(
+        {Festival.max_capacity: capacity}, synchronize_session=False
+    )
+    _, cancelled = cancel_tickets(Ticket.ticket_id.in_(over_capacity(fest_ids)), reason)
+    return fest_ids, cancelled
+
+
+def remove_performance(perf_id):
+    fest_ids, cancelled = cancel_performances(Performance.perf_id == int(perf_id))
+    db.session.commit()
+    finish(fest_ids)
+    return cancelled
+
+
+def remove_stage(stage_id):
+    """Cancel all performances on stage and mark it removed
+
+    Returns:
+        number of cancelled tickets
+    """
+    stage_id = int(stage_id)
+    fest_ids, cancelled = cancel_performances(Performance.stage_id == stage_id)
+    Stage.query.filter_by(stage_id=stage_id).update(
+        {Stage.removed: True}, synchronize_session=False
+    )
+    db.session.commit()
+    finish(fest_ids)
+    return cancelled
+
+
+def take_roles(user_ids):
+    """Drop roles of users, without commit
+
+    Returns:
+        IDs of festivals moved from the users to root admin
+    """
+    SellersList.query.filter(SellersList.seller_id.in_(user_ids)).delete(
+        synchronize_session=False
+    )
+    fest_ids = [
+        fest_id
+        for (fest_id,) in db.session.query(Festival.fest_id).filter(
+            Festival.org_id.in_(user_ids)
+        )
+    ]
+    if fest_ids:
+        Festival.query.filter(Festival.fest_id.in_(fest_ids)).update(
+            {Festival.org_id: ROOT_ID}, synchronize_session=False
+        )
+    User.query.filter(User.user_id.in_(user_ids)).update(
+        {User.perms: 4, User.role_active: False}, synchronize_session=False
+    )
+    return fest_ids
+
+
+def remove_roles(user_ids):
+    fest_ids = take_roles([int(user_id) for user_id in user_ids])
+    db.session.commit()
+    finish(fest_ids)
+
+
+def remove_users(user_ids, reason="User is removed"):
+    """Deactivate users, drop their roles and cancel their pending reservations
+
+    Returns:
+        number of cancelled tickets
+    """
+    user_ids = [int(user_id) for user_id in user_ids]
+    staff = [
+        user_id
+        for (user_id,) in db.session.query(User.user_id).filter(
+            User.user_id.in_(user_ids), User.perms <= 3
+        )
+    ]
+    fest_ids = take_roles(staff) if staff else []
+    reserved, cancelled = cancel_tickets(
+        and_(Ticket.user_id.in_(user_ids), Ticket.approved == 0), reason
+    )
+    User.query.filter(User.user_id.in_(user_ids)).update(
+        {User.active: False}, synchronize_session=False
+    )
+    db.session.commit()
+    finish(set(fest_ids) | set(reserved))
+    return cancelled
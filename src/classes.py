@@ -1,26 +1,57 @@
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from flask_sqlalchemy import SQLAlchemy
-from re import match
+from re import match, sub
 from sqlalchemy import (
     Column,
     Integer,
     Text,
     Date,
     DateTime,
+    Float,
     ForeignKey,
     String,
     Boolean,
     ForeignKeyConstraint,
+    Index,
     or_,
     and_,
+    update,
+    func,
 )
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, backref, joinedload
+from types import SimpleNamespace
 from festival_is import app
+from cache import TTLCache
+import capacity
+from scheduling import Schedule, LINEUP_TIME_FORMAT
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy(app)
 
+# Published festivals, their styles and search terms for home page and search
+catalogue = TTLCache(
+    "catalogue",
+    ttl=app.config["CATALOGUE_TTL"],
+    max_size=app.config["CATALOGUE_CACHE_SIZE"],
+)
+# View models of festival pages (with rendered fragments) by fest_id
+festival_pages = TTLCache(
+    "festival_pages",
+    ttl=app.config["FESTIVAL_PAGE_TTL"],
+    max_size=app.config["FESTIVAL_PAGE_CACHE_SIZE"],
+)
+# Festivals recommended to users
+recommended = TTLCache(
+    "recommendations",
+    ttl=app.config["RECOMMENDATION_TTL"],
+    max_size=app.config["RECOMMENDATION_CACHE_SIZE"],
+)
+# Free places of festivals
+places = capacity.from_config(app.config)
+
 
 def validate(email=None, name=None, surname=None, address=None, phone=None, time=None):
     if email and (not match(r"^[a-zA-Z]+[\w.]*@[a-z]{2,}\.[a-z]{2,}$", email)):
@@ -42,12 +73,43 @@ def validate(email=None, name=None, surname=None, address=None, phone=None, time
     return None
 
 
+def parse_attendees(text):
+    """Parse list of attendees in format "Name Surname; Name Surname" to tuples"""
+    attendees = []
+    for entry in (text or "").split(";"):
+        if entry.strip() == "":
+            continue
+        parts = entry.split()
+        if len(parts) != 2:
+            raise ValueError(f"Attendee {entry.strip()} needs name and surname")
+        name, surname = parts
+        result = validate(name=name, surname=surname)
+        if result is not None:
+            raise ValueError(result[0])
+        attendees.append((name, surname))
+    return attendees
+
+
+def ticket_holders(name, surname, quantity, attendees=None):
+    """Holders for ``quantity`` tickets, missing attendees are filled by buyer"""
+    attendees = list(attendees or [])
+    if quantity < 1:
+        raise ValueError("At least one ticket has to be reserved")
+    if len(attendees) > quantity:
+        raise ValueError(
+            f"There are {len(attendees)} attendees for {quantity} tickets"
+        )
+    return attendees + [(name, surname)] * (quantity - len(attendees))
+
+
 class Festival(db.Model):
     __tablename__ = "Festival"
 
     fest_id = db.Column("fest_id", db.Integer, primary_key=True, index=True)
     fest_name = Column("fest_name", Text, nullable=False)
     fest_logo = Column("fest_logo", Text, nullable=False)
+    # Logo resized for festival cards, set by media pipeline
+    fest_thumbnail = Column("fest_thumbnail", Text)
     description = db.Column("description", db.Text)
     style = db.Column("style", db.String(10))
     address = db.Column("address", db.Text, nullable=False)
@@ -65,25 +127,334 @@ class Festival(db.Model):
 
     organizer = relationship("Organizer", foreign_keys=org_id)
 
+    __table_args__ = (
+        # Home page filters published festivals and orders them by date or cost
+        Index("ix_festival_status_time_from", "status", "time_from", "fest_id"),
+        Index("ix_festival_status_style_time_from", "status", "style", "time_from"),
+        Index("ix_festival_status_cost", "status", "cost", "fest_id"),
+        Index("ix_festival_org_id", "org_id"),
+    )
+
+    # Number of festivals on one page of home page
+    page_size = 24
+
     def __repr__(self):
         return f"{self.fest_id}, {self.description}, {self.style}, {self.address}, {self.cost}, {self.time_from}, {self.time_to}, {self.max_capacity}, {self.age_restriction}, {self.sale}, {self.status}"
 
     @classmethod
-    def get_festivals_styles(self):
-        fests_styles = [
-            f[0]
-            for f in Festival.query.with_entities(Festival.style).filter_by(
-                status=1
-            )
-        ]
-        fests = Festival.query.filter_by(status=1).all()
-        return set(fests_styles), fests
+    def snapshot(cls, fest):
+        """Detached copy of festival columns, safe to share between requests"""
+        columns = [column.key for column in cls.__mapper__.column_attrs]
+        return SimpleNamespace(**{key: getattr(fest, key) for key in columns})
+
+    @classmethod
+    def get_styles(cls):
+        return catalogue.get(
+            "styles",
+            lambda: set(
+                f[0]
+                for f in db.session.query(Festival.style)
+                .filter(Festival.status == 1)
+                .distinct()
+            ),
+        )
 
+    # Parameters of search without filters, first page
+    unfiltered = dict(
+        styles=(),
+        date_from=None,
+        date_to=None,
+        price_min=None,
+        price_max=None,
+        on_sale=False,
+        age=None,
+        free_only=False,
+        after=None,
+        fest_ids=None,
+    )
+
+    @classmethod
+    def search(
+        cls,
+        styles=None,
+        date_from=None,
+        date_to=None,
+        price_min=None,
+        price_max=None,
+        on_sale=False,
+        age=None,
+        free_only=False,
+        sort="date",
+        after=None,
+        limit=None,
+        fest_ids=None,
+    ):
+        """One page of published festivals matching given filters.
+
+        Pages are selected by keyset (``after`` is cursor of previous page),
+        so deep pages are as cheap as the first one. ``fest_ids`` limits
+        festivals to given IDs (recommended ones). Only first pages without
+        filters are cached, other pages are keyed by user input.
+
+        Returns:
+            (list of festival snapshots, cursor of next page or None)
+        """
+        params = dict(
+            styles=tuple(sorted(styles or [])),
+            date_from=date_from,
+            date_to=date_to,
+            price_min=price_min,
+            price_max=price_max,
+            on_sale=on_sale,
+            age=age,
+            free_only=free_only,
+            sort=sort,
+            after=after,
+            limit=limit or cls.page_size,
+            fest_ids=None if fest_ids is None else tuple(sorted(fest_ids)),
+        )
+        first_page = dict(cls.unfiltered, sort=sort, limit=cls.page_size)
+        if params != first_page or sort not in ("date", "cost"):
+            return cls._search(**params)
+        return catalogue.get(("page", sort), lambda: cls._search(**params))
+
+    @classmethod
+    def _search(
+        cls,
+        styles,
+        date_from,
+        date_to,
+        price_min,
+        price_max,
+        on_sale,
+        age,
+        free_only,
+        sort,
+        after,
+        limit,
+        fest_ids,
+    ):
+        price = cls.cost * (100 - cls.sale) / 100.0
+        query = Festival.query.filter(Festival.status == 1)
+        if fest_ids is not None:
+            query = query.filter(Festival.fest_id.in_(fest_ids))
+        if styles:
+            query = query.filter(Festival.style.in_(styles))
+        if date_from is not None:
+            query = query.filter(Festival.time_from >= date_from)
+        if date_to is not None:
+            query = query.filter(Festival.time_to <= date_to)
+        if price_min is not None:
+            query = query.filter(price >= price_min)
+        if price_max is not None:
+            query = query.filter(price <= price_max)
+        if on_sale:
+            query = query.filter(Festival.sale > 0)
+        if age is not None:
+            query = query.filter(Festival.age_restriction <= age)
+        if free_only:
+            query = query.filter(Festival.current_ticket_count < Festival.max_capacity)
+
+        sort_column = Festival.cost if sort == "cost" else Festival.time_from
+        if after:
+            value, fest_id = cls.parse_cursor(after, sort)
+            query = query.filter(
+                or_(
+                    sort_column > value,
+                    and_(sort_column == value, Festival.fest_id > fest_id),
+                )
+            )
+        fests = query.order_by(sort_column, Festival.fest_id).limit(limit + 1).all()
+
+        cursor = None
+        if len(fests) > limit:
+            fests = fests[:limit]
+            last = fests[-1]
+            value = last.cost if sort == "cost" else last.time_from.isoformat()
+            cursor = f"{value}|{last.fest_id}"
+        return [cls.snapshot(fest) for fest in fests], cursor
+
+    @staticmethod
+    def parse_cursor(cursor, sort):
+        try:
+            value, fest_id = cursor.rsplit("|", 1)
+            value = int(value) if sort == "cost" else datetime.fromisoformat(value)
+            return value, int(fest_id)
+        except ValueError:
+            raise ValueError(f"Bad page cursor {cursor}")
 
     @classmethod
     def get_festival(self, fest_id):
         return Festival.query.filter_by(fest_id=fest_id).first()
 
+    @classmethod
+    def page(cls, fest_id):
+        """View model of festival page: festival, line up, stages and tags.
+
+        Cached until a change of line up or festival (see invalidate_page),
+        sold tickets are not part of it, use free_places for them.
+        """
+        return festival_pages.get(("page", fest_id), lambda: cls._page(fest_id))
+
+    @classmethod
+    def _page(cls, fest_id):
+        fest = Festival.query.filter_by(fest_id=fest_id).first()
+        if fest is None:
+            return None
+        perfs = (
+            Performance.query.options(*FESTIVAL_PAGE)
+            .filter(Performance.fest_id == fest_id, Performance.canceled == False)
+            .order_by(Performance.time_from, Performance.perf_id)
+            .all()
+        )
+        stages = {perf.stage.stage_id: perf.stage.size for perf in perfs}
+        return SimpleNamespace(
+            fest=cls.snapshot(fest),
+            lineup=[
+                SimpleNamespace(
+                    perf_id=perf.perf_id,
+                    fest_id=perf.fest_id,
+                    stage_id=perf.stage_id,
+                    time_from=perf.time_from,
+                    time_to=perf.time_to,
+                    band=perf.band
+                    and SimpleNamespace(
+                        band_id=perf.band.band_id,
+                        name=perf.band.name,
+                        logo=perf.band.logo,
+                        scores=perf.band.scores,
+                        genre=perf.band.genre,
+                        tags=perf.band.tags,
+                    ),
+                )
+                for perf in perfs
+            ],
+            stages=[SimpleNamespace(stage_id=k, size=v) for k, v in stages.items()],
+            tags=Band.festival_tags(fest_id),
+            fragments={},
+        )
+
+    @staticmethod
+    def page_fragment(page, name, render):
+        """Rendered part of festival page, kept in its cached view model.
+
+        Fragment is dropped together with view model, so it is never
+        rendered from older data than the view model has.
+        """
+        if name not in page.fragments:
+            page.fragments[name] = render()
+        return page.fragments[name]
+
+    @staticmethod
+    def invalidate_page(*fest_ids):
+        for fest_id in fest_ids:
+            festival_pages.invalidate(("page", fest_id))
+
+    @classmethod
+    def load_free_places(cls, fest_id):
+        return (
+            db.session.query(Festival.max_capacity - Festival.current_ticket_count)
+            .filter(Festival.fest_id == fest_id)
+            .scalar()
+        )
+
+    @classmethod
+    def free_places(cls, fest_id):
+        """Places left on festival, from counter (see capacity.py)"""
+        return places.get(fest_id, lambda: cls.load_free_places(fest_id))
+
+    @staticmethod
+    def forget_places(*fest_ids):
+        """Drop counters of festivals whose capacity was changed"""
+        for fest_id in fest_ids:
+            places.forget(fest_id)
+
+    @classmethod
+    def reconcile_places(cls, fest_ids=None):
+        """Recount current_ticket_count from not canceled tickets, reset counters.
+
+        Returns:
+            list of (fest_id, stored count, counted tickets) of fixed festivals
+        """
+        counted = (
+            db.session.query(func.count(Ticket.ticket_id))
+            .filter(Ticket.fest_id == Festival.fest_id, Ticket.approved != 2)
+            .correlate(Festival)
+            .as_scalar()
+        )
+        scope = [] if fest_ids is None else [Festival.fest_id.in_(fest_ids)]
+        fixed = (
+            db.session.query(Festival.fest_id, Festival.current_ticket_count, counted)
+            .filter(Festival.current_ticket_count != counted, *scope)
+            .all()
+        )
+        if fixed:
+            db.session.query(Festival).filter(
+                Festival.fest_id.in_([fest_id for fest_id, _, _ in fixed])
+            ).update({Festival.current_ticket_count: counted}, synchronize_session=False)
+        db.session.commit()
+        free = db.session.query(
+            Festival.fest_id, Festival.max_capacity - Festival.current_ticket_count
+        ).filter(*scope)
+        for fest_id, left in free:
+            places.set(fest_id, left)
+        if fixed:
+            catalogue.invalidate()
+        return fixed
+
+    @staticmethod
+    def ticket_price(cost, sale):
+        return cost if sale == 0 else cost - (cost * sale) / 100
+
+    @classmethod
+    def take_places(cls, fest_id, count=1):
+        """Claim ``count`` places on festival in one conditional UPDATE.
+
+        Capacity is checked and incremented by the database in a single
+        statement, so concurrent reservations can't oversell the festival.
+        Caller is responsible for commit (or rollback) of the transaction.
+
+        Counter of free places is checked first, so sold out festival is
+        refused without touching its row. Local counters are not shared by
+        workers and miss places released by other workers, so their refusal
+        is checked by the UPDATE too.
+
+        Returns:
+            price of one ticket or None if festival has not enough free places
+        """
+        counted = places.reserve(fest_id, count, lambda: cls.load_free_places(fest_id))
+        if not counted and places.shared:
+            return None
+        table = cls.__table__
+        row = db.session.execute(
+            update(table)
+            .where(
+                and_(
+                    table.c.fest_id == fest_id,
+                    table.c.current_ticket_count + count <= table.c.max_capacity,
+                )
+            )
+            .values(current_ticket_count=table.c.current_ticket_count + count)
+            .returning(
+                table.c.cost,
+                table.c.sale,
+                table.c.current_ticket_count,
+                table.c.max_capacity,
+            )
+        ).first()
+        if row is None:
+            if counted:
+                # Counter was behind database
+                places.forget(fest_id)
+            return None
+        if not counted:
+            # Places were released by other worker
+            places.set(fest_id, row.max_capacity - row.current_ticket_count)
+        if row.current_ticket_count == row.max_capacity:
+            # Home page shows sold out festivals
+            catalogue.invalidate()
+        return cls.ticket_price(row.cost, row.sale)
+
 
 class Stage(db.Model):
     __tablename__ = "Stage"
@@ -108,10 +479,73 @@ class Band(db.Model):
         "created_on", Date, nullable=False, default=datetime.now().strftime("%x")
     )
 
+    __table_args__ = (Index("ix_band_name", "name"),)
+
+    @staticmethod
+    def tag_names(tags):
+        """Normalized unique tags from text like "rock;Live; indie" """
+        names = []
+        for tag in (tags or "").split(";"):
+            tag = " ".join(tag.split()).lower()
+            if tag and tag not in names:
+                names.append(tag)
+        return names
+
+    def sync_tags(self):
+        """Store tags of band in Tag and BandTag tables (band has to have ID)"""
+        names = self.tag_names(self.tags)
+        tags = Tag.query.filter(Tag.name.in_(names)).all() if names else []
+        known = {tag.name for tag in tags}
+        for name in names:
+            if name not in known:
+                tag = Tag(name=name)
+                db.session.add(tag)
+                tags.append(tag)
+        db.session.flush()
+        BandTag.query.filter_by(band_id=self.band_id).delete()
+        for tag in tags:
+            db.session.add(BandTag(band_id=self.band_id, tag_id=tag.tag_id))
+
+    @classmethod
+    def festival_tags(cls, fest_id, limit=10):
+        """The most frequent tags of bands in line up of festival"""
+        return [
+            name
+            for (name,) in db.session.query(Tag.name)
+            .join(BandTag, BandTag.tag_id == Tag.tag_id)
+            .join(Performance, Performance.band_id == BandTag.band_id)
+            .filter(Performance.fest_id == fest_id, Performance.canceled == False)
+            .group_by(Tag.name)
+            .order_by(func.count().desc(), Tag.name)
+            .limit(limit)
+        ]
+
     def __repr__(self):
         return f"Band {self.band_id}: {self.name}"
 
 
+class Tag(db.Model):
+    __tablename__ = "Tag"
+    tag_id = Column("tag_id", Integer, primary_key=True)
+    name = Column("name", Text, nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"Tag {self.tag_id}: {self.name}"
+
+
+class BandTag(db.Model):
+    """Inverted index of tags: bands by tag (tags of band are in Band.tags)"""
+
+    __tablename__ = "BandTag"
+    band_id = Column("band_id", Integer, ForeignKey("Band.band_id"), primary_key=True)
+    tag_id = Column("tag_id", Integer, ForeignKey("Tag.tag_id"), primary_key=True)
+
+    __table_args__ = (Index("ix_bandtag_tag_id", "tag_id"),)
+
+    def __repr__(self):
+        return f"BandTag {self.band_id}: {self.tag_id}"
+
+
 class Performance(db.Model):
     __tablename__ = "Performance"
     perf_id = db.Column("perf_id", db.Integer, primary_key=True)
@@ -136,13 +570,37 @@ class Performance(db.Model):
     band = db.relationship("Band", foreign_keys=band_id)  # backref ?
     stage = db.relationship("Stage", foreign_keys=stage_id)  # backref ?
 
+    __table_args__ = (
+        # Collisions of performances on stage
+        Index("ix_performance_stage_time", "stage_id", "time_from", "time_to"),
+        # Line up of festival
+        Index("ix_performance_fest_canceled", "fest_id", "canceled"),
+        Index("ix_performance_band_id", "band_id"),
+    )
+
     def __repr__(self):
         return f"Performance {self.perf_id}: festival_id: {self.fest_id}; stage_id: {self.stage_id}; band_id: {self.band_id}"
 
+    @classmethod
+    def get_schedule(cls, stage_ids, time_from, time_to):
+        """Schedule of not canceled performances on stages between given times"""
+        perfs = Performance.query.filter(
+            Performance.stage_id.in_(stage_ids),
+            Performance.canceled.isnot(True),
+            Performance.time_from < time_to,
+            Performance.time_to > time_from,
+        ).all()
+        return Schedule(
+            (perf.stage_id, perf.time_from, perf.time_to, perf) for perf in perfs
+        )
+
 
 class BaseUser:
+    # Maximal number of not paid tickets for unregistered user
+    max_pending = 4
+
     @classmethod
-    def reserve_ticket(cls, form, fest_id):
+    def reserve_ticket(cls, form, fest_id, quantity=1, attendees=None):
         checker = User.query.filter_by(user_email=form.user_email.data).count()
         if checker != 0:
             raise ValueError(
@@ -150,37 +608,21 @@ class BaseUser:
                 You have registered account, please, login to continue with reservation.
                 """
             )
-        blocker = Ticket.query.filter_by(
-            user_email=form.user_email.data, approved=0
-        ).count()
-        if blocker > 3:
+        holders = ticket_holders(
+            form.user_name.data, form.user_surname.data, quantity, attendees
+        )
+        blocker = Ticket.pending_count(user_email=form.user_email.data)
+        if blocker + len(holders) > cls.max_pending:
             raise ValueError(
                 """
                 You have already issued the maximum reservations for unregistered user,
                 please pay for part of the reservations, or create account to continue.
                 """
             )
-        fest = Festival.query.filter_by(fest_id=fest_id).first()
-        price = (
-            fest.cost if fest.sale == 0 else fest.cost - ((fest.cost * fest.sale) / 100)
+        return Ticket.reserve_many(
+            fest_id, holders, user_email=form.user_email.data
         )
 
-        ticket = Ticket(
-            user_email=form.user_email.data,
-            name=form.user_name.data,
-            surname=form.user_surname.data,
-            fest_id=fest_id,
-            price=price,
-        )      
-        db.session.add(ticket)
-        fest = Festival.query.filter_by(fest_id=fest_id).first()
-        if fest.current_ticket_count != fest.max_capacity:
-            fest.current_ticket_count += 1
-        else:
-            db.session.commit()
-            raise ValueError("Festival is already out of tickets")
-        db.session.commit()
-
     @classmethod
     def register(cls, form, perms):
         email = form.email.data
@@ -236,6 +678,9 @@ class User(UserMixin, db.Model):
     role_active = Column("role_active", Boolean, default=True)
 
     __mapper_args__ = {"polymorphic_identity": 4, "polymorphic_on": perms}
+    __table_args__ = (Index("ix_user_perms", "perms"),)
+    # Maximal number of not paid tickets for one festival
+    max_pending = 6
     _is_authenticated = True
     _is_active = True
     _is_anonymous = False
@@ -281,51 +726,65 @@ class User(UserMixin, db.Model):
     def is_anonymous(self, val):
         self._is_anonymous = val
 
-    def reserve_ticket(self, fest_id):
-        blocker = Ticket.query.filter_by(
-            fest_id=fest_id, user_id=self.user_id, approved=0
-        ).count()
-        if blocker > 5:
+    def reserve_ticket(self, fest_id, quantity=1, attendees=None):
+        holders = ticket_holders(self.name, self.surname, quantity, attendees)
+        blocker = Ticket.pending_count(fest_id=fest_id, user_id=self.user_id)
+        if blocker + len(holders) > self.max_pending:
             raise ValueError(
                 """You have already issued the maximum reservations for this festival,
                    please pay for part of the reservations, or cancel it."""
             )
-        fest = Festival.query.filter_by(fest_id=fest_id).first()
-        if fest.current_ticket_count != fest.max_capacity:
-            price = (
-                fest.cost
-                if fest.sale == 0
-                else fest.cost - (fest.cost * fest.sale) / 100
-            )
-            ticket = Ticket(
-                user_email=self.user_email,
-                user_id=self.user_id,
-                fest_id=fest_id,
-                name=self.name,
-                surname=self.surname,
-                price=price,
-            )
-            fest.current_ticket_count += 1
-            db.session.add(ticket)
-            db.session.commit()
-        else:
-            raise ValueError("Festival is already out of tickets")
+        return Ticket.reserve_many(
+            fest_id, holders, user_email=self.user_email, user_id=self.user_id
+        )
 
     def cancel_ticket(self, ticket_id):
-        today = datetime.now()
-        ticket = Ticket.query.filter_by(ticket_id=ticket_id).first()
-        if ticket.approved == 0 and today < ticket.fest.time_to:
-            ticket.fest.current_ticket_count -= 1
-            ticket.approved = 2
-            ticket.reason = f"Canceled by {self.user_email}"
-            db.session.commit()
+        """Cancel pending ticket of not finished festival by one conditional UPDATE.
+
+        Ticket cancelled concurrently (by seller, expiry job or cascade) is
+        not matched, so its place is released only once. Festival row is
+        locked before the ticket, like by reservations and cascades.
+        """
+        fest_id = (
+            db.session.query(Ticket.fest_id).filter_by(ticket_id=ticket_id).scalar()
+        )
+        time_to = (
+            db.session.query(Festival.time_to)
+            .filter_by(fest_id=fest_id)
+            .with_for_update()
+            .scalar()
+        )
+        if time_to is None or time_to <= datetime.now():
+            db.session.rollback()
+            return
+        table = Ticket.__table__
+        row = db.session.execute(
+            update(table)
+            .where(and_(table.c.ticket_id == ticket_id, table.c.approved == 0))
+            .values(approved=2, reason=f"Canceled by {self.user_email}")
+            .returning(table.c.price)
+        ).first()
+        if row is None:
+            db.session.rollback()
+            return
+        count = Festival.current_ticket_count
+        Festival.query.filter_by(fest_id=fest_id).update(
+            {count: count - 1}, synchronize_session=False
+        )
+        SalesRollup.record(fest_id, cancellations=1, cancelled_amount=row.price or 0)
+        db.session.commit()
+        places.release(fest_id)
 
     def get_tickets(self):
         today = datetime.now()
         actual_tickets, outdated_tickets = [], []
-        tickets = Ticket.query.filter(
-            or_(Ticket.user_id == self.user_id, Ticket.user_email == self.user_email)
-        ).all()
+        tickets = (
+            Ticket.query.options(*TICKET_DETAILS)
+            .filter(
+                or_(Ticket.user_id == self.user_id, Ticket.user_email == self.user_email)
+            )
+            .all()
+        )
         tickets.sort(key=lambda ticket: ticket.fest.time_from)
         for ticket in tickets:
             if ticket.fest.time_from >= today:
@@ -335,13 +794,8 @@ class User(UserMixin, db.Model):
         return actual_tickets, outdated_tickets
 
     def get_recomendations(self):
-        styles = [
-            t.fest.style
-            for t in Ticket.query.filter(
-                Ticket.user_id == self.user_id, Ticket.approved == 1
-            ).all()
-        ]
-        return styles
+        """IDs of recommended festivals (see Recommendation)"""
+        return frozenset(Recommendation.for_user(self.user_id))
 
     def change_account(self, form):
         new_user_email = form.get("user_email")
@@ -391,15 +845,13 @@ class Seller(User):
         super(User, self).__init__(**kwargs)
         self.seller_id = self.get_id()
 
-    def get_all_tickets(self, fest_id=None, user_id=None):
-        if fest_id is not None and user_id is not None:
-            return Ticket.query.filter(fest_id == fest_id, user_id == user_id)
-        elif fest_id is not None:
-            return Ticket.query.filter_by(fest_id=fest_id)
-        elif user_id is not None:
-            return Ticket.query.filter_by(user_id=user_id)
-        else:
-            return Ticket.query.all()
+    def get_all_tickets(
+        self, fest_id=None, user_id=None, status=None, search=None, after=None
+    ):
+        """Page of tickets (see Ticket.ledger), never all tickets at once"""
+        return Ticket.ledger(
+            fest_id=fest_id, user_id=user_id, status=status, search=search, after=after
+        )
 
     def get_festivals(self):
         today = datetime.today()
@@ -424,31 +876,99 @@ class Seller(User):
                 outdated_fests.append(fest)
         return (actual_fests, outdated_fests)
 
-    def get_sellers_tickets(self, fest_id):
+    def get_sellers_tickets(self, fest_id, status=None, search=None, after=None):
+        """Page of tickets of festival with counts of tickets by status
+
+        Returns:
+            (tickets, festival, festival is upcoming, after of next page, counts)
+        """
         today = datetime.now()
-        tickets = Ticket.query.filter_by(fest_id=fest_id).all()
+        tickets, next_after = Ticket.ledger(
+            fest_id=fest_id, status=status, search=search, after=after
+        )
         fest = Festival.query.filter_by(fest_id=fest_id).first()
-        return tickets, fest, (fest.time_from >= today)
+        counts = Ticket.status_counts(fest_id)
+        return tickets, fest, (fest.time_from >= today), next_after, counts
 
     def manage_ticket_seller(self, ticket_id, action, reason):
-        ticket = Ticket.query.filter_by(ticket_id=ticket_id).first()
-        today = datetime.now()
-        if action == "approve" and ticket.approved == 0 and today < ticket.fest.time_to:
-            ticket.approved = 1
-            if reason == "":
-                ticket.reason = f"Approved by {self.user_email}"
-            else:
-                ticket.reason = reason
-        elif (
-            action == "cancel" and ticket.approved == 0 and today < ticket.fest.time_to
+        fest_id = (
+            db.session.query(Ticket.fest_id).filter_by(ticket_id=ticket_id).scalar()
+        )
+        if fest_id is not None:
+            self.manage_tickets_seller(fest_id, [ticket_id], action, reason)
+
+    def manage_tickets_seller(self, fest_id, ticket_ids, action, reason=""):
+        """Approve or cancel pending tickets of festival at once.
+
+        Festival row is locked first (like by reservations and cascades),
+        tickets are locked and checked by one query, changed by one UPDATE
+        and counter of festival is decreased by number of cancelled tickets
+        in one more, everything in one transaction.
+
+        Returns:
+            dict ticket_id -> "approved", "cancelled", "not_pending",
+            "not_found" or "festival_over"
+        """
+        if action not in ("approve", "cancel"):
+            raise ValueError(f"Unknown action {action}")
+        ticket_ids = {int(ticket_id) for ticket_id in ticket_ids}
+        if not ticket_ids:
+            return {}
+        time_to = (
+            db.session.query(Festival.time_to)
+            .filter_by(fest_id=fest_id)
+            .with_for_update()
+            .scalar()
+        )
+        states, prices = {}, {}
+        for ticket_id, approved, price in (
+            db.session.query(Ticket.ticket_id, Ticket.approved, Ticket.price)
+            .filter(Ticket.ticket_id.in_(ticket_ids), Ticket.fest_id == fest_id)
+            .with_for_update()
         ):
-            ticket.fest.current_ticket_count -= 1
-            ticket.approved = 2
-            if reason == "":
-                ticket.reason = f"Cancelled by {self.user_email}"
+            states[ticket_id], prices[ticket_id] = approved, price or 0
+        over = time_to is None or datetime.now() >= time_to
+        pending = [] if over else [t for t, state in states.items() if state == 0]
+        done = "approved" if action == "approve" else "cancelled"
+        outcomes = {}
+        for ticket_id in ticket_ids:
+            if ticket_id not in states:
+                outcomes[ticket_id] = "not_found"
+            elif over:
+                outcomes[ticket_id] = "festival_over"
             else:
-                ticket.reason = reason
+                outcomes[ticket_id] = done if states[ticket_id] == 0 else "not_pending"
+        if not pending:
+            db.session.rollback()
+            return outcomes
+
+        if reason == "":
+            reason = f"{done.capitalize()} by {self.user_email}"
+        Ticket.query.filter(
+            Ticket.ticket_id.in_(pending), Ticket.approved == 0
+        ).update(
+            {Ticket.approved: 1 if action == "approve" else 2, Ticket.reason: reason},
+            synchronize_session=False,
+        )
+        if action == "cancel":
+            count = Festival.current_ticket_count
+            Festival.query.filter_by(fest_id=fest_id).update(
+                {count: count - len(pending)}, synchronize_session=False
+            )
+        amount = sum(prices[ticket_id] for ticket_id in pending)
+        if action == "approve":
+            SalesRollup.record(fest_id, approvals=len(pending), approved_amount=amount)
+        else:
+            SalesRollup.record(
+                fest_id, cancellations=len(pending), cancelled_amount=amount
+            )
         db.session.commit()
+        if action == "cancel":
+            places.release(fest_id, len(pending))
+            # Sold out festival can be on sale again
+            catalogue.invalidate()
+        return outcomes
+
 
 class Organizer(Seller):
     __tablename__ = "Organizer"
@@ -465,7 +985,11 @@ class Organizer(Seller):
 
     def get_sellers(self, fest_id=None):
         if fest_id is not None:
-            return [row for row in SellersList.query.filter_by(fest_id=fest_id).all()]
+            return (
+                SellersList.query.options(*SELLER_LIST_DETAILS)
+                .filter_by(fest_id=fest_id)
+                .all()
+            )
         return [row for row in Seller.query.all()]
 
     def create_seller(self, form, fest_id=None):
@@ -552,24 +1076,29 @@ class Organizer(Seller):
         )
         db.session.add(fest)
         db.session.commit()
+        catalogue.invalidate()
+        Festival.invalidate_page(fest.fest_id)
         return f"Festvial {fest.fest_name} is created", "success", fest
 
     def cancel_fest(self, fest_id):
-        fest = Festival.query.filter_by(fest_id=fest_id).first()
-        Performance.query.filter_by(fest_id=fest_id).delete()
-        SellersList.query.filter_by(fest_id=fest_id).delete()
-        fest.status = 2
-        db.session.commit()
-        return f"Festival {fest.fest_id} is canceled", "success"
+        cancelled = cascades.cancel_festivals([fest_id])
+        return (
+            f"Festival {fest_id} is canceled, {cancelled} tickets cancelled",
+            "success",
+        )
 
     def get_perf(self, fest_id=None):
         if fest_id:
-            return [row for row in Performance.query.filter_by(fest_id=fest_id).all()]
-        return [row for row in Performance.query.all()]
+            return (
+                Performance.query.options(*PERFORMANCE_DETAILS)
+                .filter_by(fest_id=fest_id)
+                .all()
+            )
+        return Performance.query.options(*PERFORMANCE_DETAILS).all()
 
     def get_bands(self, fest_id=None, stage_id=None, perf_id=None):
         if fest_id is not None:
-            perfs = Performance.query.filter_by(fest_id=fest_id).all()
+            perfs = Performance.query.options(*LINEUP).filter_by(fest_id=fest_id).all()
             return [row.band for row in perfs]
 
         return [row for row in Band.query.all()]
@@ -583,43 +1112,27 @@ class Organizer(Seller):
             tags=form["tags_bands"]
         )
         db.session.add(band)
+        db.session.flush()
+        band.sync_tags()
         db.session.commit()
+        catalogue.invalidate("search_terms")
         return f"Band {band.name} is created", "success", band
 
     def fest_del_perf(self, perf_id=None, perf=None):
-        if perf is None:
-            if perf_id is None:
-                print("No perf ID")
-                return 
-
-            perf = Performance.query.filter_by(perf_id=perf_id).first()
-        perf.canceled = True
-        print(perf)        
-        # Cancel tickets until current_ticket_count is not equal to max_capacity
-        if perf.fest.current_ticket_count > perf.fest.max_capacity:
-            tickets = Ticket.query.filter_by(fest_id=perf.fest.fest_id)
-            while perf.fest.current_ticket_count > perf.fest.max_capacity:
-                ticket = tickets[-1]
-                ticket.reason = "Due to capacity reason"
-                ticket.approved = 2
-
-        db.session.commit()
-
-        how_many_perfs = Performance.query.filter(Performance.fest_id==perf.fest.fest_id, Performance.canceled==False).all()
-        if how_many_perfs == []:
-            perf.fest.max_capacity -= perf.stage.size
-        db.session.commit()
-
+        if perf is not None:
+            perf_id = perf.perf_id
+        if perf_id is None:
+            app.logger.warning("Performance to delete is not given")
+            return
+        cascades.remove_performance(perf_id)
 
     def fest_add_perf(self, form, fest_id):
         band = Band.query.filter_by(name=form["band_name"]).first()
         if band is None:
-            print(f"No band with this name: {form['band_name']}")
             return (f"No band with this name: {form['band_name']}", "warning")
         try:
             stage_id = int(form["stage_id"])
         except ValueError:
-            print(f"Please, provide ID for stage ID")
             return (f"Please, provide ID for stage ID", "warning")
 
         stage = Stage.query.filter_by(stage_id=stage_id).first()
@@ -629,9 +1142,6 @@ class Organizer(Seller):
             return (f"Stage {form['stage_id']} is already deleted", "warning")
 
         fest = Festival.query.filter_by(fest_id=fest_id).first()
-        perfs = Performance.query.filter(Performance.fest_id==fest_id, Performance.stage_id==stage.stage_id, Performance.canceled == False).all()
-        if perfs == [] or perfs is None:
-            fest.max_capacity += stage.size
 
         res = validate(time=form['time_from'])
         if res:
@@ -642,71 +1152,187 @@ class Organizer(Seller):
 
         datetime_from = f"{form['date_from']} {form['time_from']}"
         datetime_to = f"{form['date_to']} {form['time_to']}"
+        try:
+            time_from = datetime.strptime(datetime_from, "%Y-%m-%d %H:%M")
+            time_to = datetime.strptime(datetime_to, "%Y-%m-%d %H:%M")
+        except ValueError:
+            return (f"Bad date format: {datetime_from} - {datetime_to}", "warning")
         # Time for performance is not between festival start and end
-        print(datetime_from, fest.time_from)
-        print(datetime_to, fest.time_to)
-        if not (
-            fest.time_from < datetime.strptime(datetime_from, "%Y-%m-%d %H:%M")
-            and fest.time_to > datetime.strptime(datetime_from, "%Y-%m-%d %H:%M")
-            and fest.time_from < datetime.strptime(datetime_to, "%Y-%m-%d %H:%M")
-            and fest.time_to > datetime.strptime(datetime_to, "%Y-%m-%d %H:%M")
-            and datetime.strptime(datetime_to, "%Y-%m-%d %H:%M")
-            > datetime.strptime(datetime_from, "%Y-%m-%d %H:%M")
-        ):
+        if not (fest.time_from < time_from < time_to < fest.time_to):
             return (
                 f"Date of performance is out of festival dates: {datetime_from} - {datetime_to}",
                 "warning",
             )
 
         # Find collisions with other performances
-        collisions = Performance.query.filter(
-            Performance.stage_id == stage.stage_id,
-            or_(
-                and_(
-                    Performance.time_from
-                    < datetime.strptime(datetime_from, "%Y-%m-%d %H:%M"),
-                    Performance.time_to
-                    > datetime.strptime(datetime_from, "%Y-%m-%d %H:%M"),
-                ),
-                and_(
-                    Performance.time_from
-                    < datetime.strptime(datetime_to, "%Y-%m-%d %H:%M"),
-                    Performance.time_to
-                    > datetime.strptime(datetime_to, "%Y-%m-%d %H:%M"),
-                ),
-                and_(
-                    datetime.strptime(datetime_from, "%Y-%m-%d %H:%M")
-                    < Performance.time_from,
-                    datetime.strptime(datetime_to, "%Y-%m-%d %H:%M")
-                    > Performance.time_to,
-                ),
-            ),
-        ).all()
+        collisions = Performance.get_schedule(
+            [stage.stage_id], time_from, time_to
+        ).collisions(stage.stage_id, time_from, time_to)
         if collisions:
             ids = ", ".join([str(perf.perf_id) for perf in collisions])
             return (f"There is collisions with other performances: {ids}", "warning")
+
+        stage_used = Performance.query.filter(
+            Performance.fest_id == fest_id,
+            Performance.stage_id == stage.stage_id,
+            Performance.canceled == False,
+        ).first()
+        if stage_used is None:
+            fest.max_capacity += stage.size
         perf = Performance(
             stage_id=stage.stage_id,
             band_id=band.band_id,
             fest_id=fest_id,
-            time_from=datetime_from,
-            time_to=datetime_to,
+            time_from=time_from,
+            time_to=time_to,
         )
         db.session.add(perf)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Concurrent performance was caught by exclusion constraint
+            db.session.rollback()
+            return (
+                f"There is collision with other performance on stage {stage.stage_id}",
+                "warning",
+            )
+        Festival.invalidate_page(fest.fest_id)
+        Festival.forget_places(fest.fest_id)
         return (
             f"Performance {perf.perf_id}: Band {band.name} add to stage {stage.stage_id}",
             "success",
         )
 
+    def import_lineup(self, rows, fest_id):
+        """Add many performances to festival in one transaction.
+
+        Bands and stages are resolved by one query each and collisions are
+        checked in memory, nothing is added if any row is wrong.
+
+        Args:
+            rows: list of dicts with band_name, stage_id, time_from and time_to
+
+        Returns:
+            (message, status, list of (row number, error))
+        """
+        fest = Festival.query.filter_by(fest_id=fest_id).first()
+        if fest is None:
+            return (f"Festival {fest_id} does not exist", "warning", [])
+
+        names = {str(row.get("band_name", "")).strip() for row in rows}
+        bands = {}
+        for band in Band.query.filter(Band.name.in_(names)).order_by(Band.band_id):
+            bands.setdefault(band.name, band)
+        stage_ids = set()
+        for row in rows:
+            try:
+                stage_ids.add(int(row.get("stage_id")))
+            except (TypeError, ValueError):
+                pass
+        stages = {
+            stage.stage_id: stage
+            for stage in Stage.query.filter(Stage.stage_id.in_(stage_ids))
+        }
+
+        errors, entries = [], []
+        for number, row in enumerate(rows, 1):
+            band = bands.get(str(row.get("band_name", "")).strip())
+            if band is None:
+                errors.append(
+                    (number, f"No band with this name: {row.get('band_name')}")
+                )
+                continue
+            try:
+                stage = stages.get(int(row.get("stage_id")))
+            except (TypeError, ValueError):
+                stage = None
+            if stage is None or stage.removed:
+                errors.append(
+                    (number, f"No stage with this ID: {row.get('stage_id')}")
+                )
+                continue
+            try:
+                time_from = datetime.strptime(
+                    str(row.get("time_from")).strip(), LINEUP_TIME_FORMAT
+                )
+                time_to = datetime.strptime(
+                    str(row.get("time_to")).strip(), LINEUP_TIME_FORMAT
+                )
+            except ValueError:
+                errors.append(
+                    (number, "Bad time format, need to be like 2021-07-01 23:06")
+                )
+                continue
+            if not (fest.time_from < time_from < time_to < fest.time_to):
+                errors.append((number, "Date of performance is out of festival dates"))
+                continue
+            entries.append((stage.stage_id, time_from, time_to, (number, band)))
+
+        if entries:
+            schedule = Performance.get_schedule(
+                {entry[0] for entry in entries},
+                min(entry[1] for entry in entries),
+                max(entry[2] for entry in entries),
+            )
+            for (number, band), collisions in schedule.validate(entries):
+                others = ", ".join(
+                    f"performance {other.perf_id}"
+                    if isinstance(other, Performance)
+                    else f"row {other[0]}"
+                    for other in collisions
+                )
+                errors.append((number, f"There is collisions with {others}"))
+        if errors:
+            errors.sort()
+            return (
+                f"Line up is not imported, {len(errors)} rows are wrong",
+                "warning",
+                errors,
+            )
+
+        used_stages = {
+            row[0]
+            for row in db.session.query(Performance.stage_id).filter(
+                Performance.fest_id == fest_id, Performance.canceled == False
+            )
+        }
+        new_stages = {entry[0] for entry in entries} - used_stages
+        fest.max_capacity += sum(stages[stage_id].size for stage_id in new_stages)
+        db.session.execute(
+            Performance.__table__.insert().values(
+                [
+                    dict(
+                        fest_id=fest_id,
+                        stage_id=stage_id,
+                        band_id=band.band_id,
+                        canceled=False,
+                        time_from=time_from,
+                        time_to=time_to,
+                    )
+                    for stage_id, time_from, time_to, (number, band) in entries
+                ]
+            )
+        )
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Concurrent performance was caught by exclusion constraint
+            db.session.rollback()
+            return ("Line up collides with performance added meanwhile", "warning", [])
+        Festival.invalidate_page(fest.fest_id)
+        Festival.forget_places(fest.fest_id)
+        return (f"{len(entries)} performances imported", "success", [])
+
     def delete_band(self, band_id):
         band = Band.query.filter_by(band_id=band_id).first()
         band.deleted_on = datetime.now().strftime("%x %X")
 
-        all_perfs = Performance.query.filter_by(band_id=band_id)
+        all_perfs = Performance.query.filter_by(band_id=band_id).all()
         for perf in all_perfs:
             perf.canceled = True
         db.session.commit()
+        Festival.invalidate_page(*{perf.fest_id for perf in all_perfs})
+        catalogue.invalidate("search_terms")
 
     def get_all_stages(self):
         return Stage.query.all()
@@ -718,13 +1344,7 @@ class Organizer(Seller):
         return f"Stage {stage.stage_id} added", "success"
 
     def remove_stage(self, stage_id):
-        perfs = Performance.query.filter_by(stage_id=stage_id).all()
-        print(perfs)
-        for perf in perfs:
-            self.fest_del_perf(perf=perf)
-        stage = Stage.query.filter_by(stage_id=stage_id).first()
-        stage.removed = True
-        db.session.commit()
+        cascades.remove_stage(stage_id)
         return f"Stage {stage_id} is removed from all performances", "success"
 
     def update_fest(self, form, fest_id):
@@ -734,6 +1354,8 @@ class Organizer(Seller):
         fest.status = form.get("status")
 
         db.session.commit()
+        catalogue.invalidate()
+        Festival.invalidate_page(fest.fest_id)
 
         return f"Festival {fest.fest_name} successfully updated", "success"
 
@@ -752,27 +1374,11 @@ class Admin(Organizer):
         self.admin_id = self.get_id()
 
     def remove_user(self, user_id):
-        user = User.query.filter_by(user_id=user_id).first()
-        if user.perms <= 3:
-            self.remove_role(user_id)
-        user.active = False
-        db.session.commit()
+        cascades.remove_users([user_id])
         return (f"User {user_id} is removed", "success")
 
     def remove_role(self, user_id):
-        roles = {2: "organizer", 3: "seller", 1: "admin"}
-        user = User.query.filter_by(user_id=user_id).first()
-        if user.perms <= 3:
-            # Delete all relations for seller - festival 
-            SellersList.query.filter_by(seller_id=user_id).delete()
-        if user.perms <= 2:
-            # Move all organized festival to root
-            fests = Festival.query.filter_by(org_id=user_id).all()
-            for fest in fests:
-                fest.org_id = 1
-        user.perms = 4
-        user.role_active = False
-        db.session.commit()
+        cascades.remove_roles([user_id])
         return f"Permissions for user {user_id} is removed", "success"
 
     def get_all_users(self):
@@ -852,6 +1458,8 @@ class Ticket(db.Model):
         surname (string): surname of person
         user_id (int): ID of user, that bought this ticket
         fest_id (int): festival ID ticket corresponds to
+        reserved_at (datetime): time of reservation, not approved tickets expire
+            after RESERVATION_HOLD_HOURS (see expire_stale)
     """
 
     __tablename__ = "Ticket"
@@ -869,6 +1477,7 @@ class Ticket(db.Model):
     )
     approved = Column("approved", Integer, nullable=False, default=0)
     reason = Column("reason", String(50))
+    reserved_at = Column("reserved_at", DateTime, nullable=True)
 
     user = db.relationship("User", foreign_keys=user_id)
     fest = db.relationship(
@@ -877,9 +1486,248 @@ class Ticket(db.Model):
         backref=backref("Ticket"),
     )
 
+    __table_args__ = (
+        # Reservation limit of registered user, prefix serves tickets of festival
+        Index("ix_ticket_fest_user_approved", "fest_id", "user_id", "approved"),
+        # Reservation limit of unregistered user and tickets of user
+        Index("ix_ticket_user_email_approved", "user_email", "approved"),
+        Index("ix_ticket_user_approved", "user_id", "approved"),
+        # Ledger of festival, newest first, all tickets or by status
+        Index("ix_ticket_fest_id", "fest_id", "ticket_id"),
+        Index("ix_ticket_fest_approved_id", "fest_id", "approved", "ticket_id"),
+        # Stale reservations expired by jobs.py
+        Index("ix_ticket_approved_reserved_at", "approved", "reserved_at"),
+    )
+
+    # Values of approved by status name used by ticket ledger
+    statuses = {"pending": 0, "approved": 1, "cancelled": 2}
+    # Tickets on one page of ledger
+    ledger_page_size = 50
+    # Columns searched by prefix in ledger, expression indexes are created by
+    # migrations.create_search_indexes
+    search_columns = ("user_email", "name", "surname")
+
     def __repr__(self):
         return f"Ticket {self.ticket_id}: user_id: {self.user_id}; festival_id: {self.fest_id}"
 
+    @classmethod
+    def ledger(
+        cls,
+        fest_id=None,
+        user_id=None,
+        status=None,
+        search=None,
+        after=None,
+        limit=None,
+    ):
+        """Page of tickets, newest first, paginated by ticket_id (keyset).
+
+        Args:
+            status: "pending", "approved" or "cancelled"
+            search: prefix of e-mail, name or surname of ticket holder
+            after: ticket_id of the last ticket of previous page
+
+        Returns:
+            (list of tickets with festival and user, ``after`` of next page or None)
+        """
+        limit = limit or cls.ledger_page_size
+        query = Ticket.query.options(*TICKET_DETAILS)
+        if fest_id is not None:
+            query = query.filter(Ticket.fest_id == fest_id)
+        if user_id is not None:
+            query = query.filter(Ticket.user_id == user_id)
+        if status is not None:
+            if status not in cls.statuses:
+                raise ValueError(f"Unknown ticket status {status}")
+            query = query.filter(Ticket.approved == cls.statuses[status])
+        if search:
+            prefix = sub(r"([\\%_])", r"\\\1", search.strip().lower()) + "%"
+            query = query.filter(
+                or_(
+                    *[
+                        func.lower(getattr(Ticket, column)).like(prefix, escape="\\")
+                        for column in cls.search_columns
+                    ]
+                )
+            )
+        if after is not None:
+            query = query.filter(Ticket.ticket_id < after)
+        tickets = query.order_by(Ticket.ticket_id.desc()).limit(limit + 1).all()
+        if len(tickets) > limit:
+            return tickets[:limit], tickets[limit - 1].ticket_id
+        return tickets, None
+
+    @classmethod
+    def status_counts(cls, fest_id):
+        """Number of tickets of festival by status name (and "all") in one query"""
+        counts = dict.fromkeys(cls.statuses, 0)
+        names = {value: name for name, value in cls.statuses.items()}
+        for approved, count in (
+            db.session.query(Ticket.approved, func.count(Ticket.ticket_id))
+            .filter(Ticket.fest_id == fest_id)
+            .group_by(Ticket.approved)
+        ):
+            counts[names[approved]] = count
+        counts["all"] = sum(counts.values())
+        return counts
+
+    @classmethod
+    def pending_count(cls, fest_id=None, user_id=None, user_email=None):
+        """Number of not approved tickets of user in one aggregate query"""
+        query = db.session.query(func.count(Ticket.ticket_id)).filter(
+            Ticket.approved == 0
+        )
+        if fest_id is not None:
+            query = query.filter(Ticket.fest_id == fest_id)
+        if user_id is not None:
+            query = query.filter(Ticket.user_id == user_id)
+        if user_email is not None:
+            query = query.filter(Ticket.user_email == user_email)
+        return query.scalar()
+
+    @classmethod
+    def reserve(cls, fest_id, user_email, name, surname, user_id=None):
+        """Reserve one ticket, returns its ID"""
+        return cls.reserve_many(fest_id, [(name, surname)], user_email, user_id)[0]
+
+    @classmethod
+    def reserve_many(cls, fest_id, holders, user_email, user_id=None):
+        """Reserve ticket for every (name, surname) in ``holders``.
+
+        All places are claimed by one capacity check, tickets are inserted by
+        one multi-row INSERT and everything is committed at once.
+
+        Returns:
+            list of IDs of reserved tickets
+        """
+        price = Festival.take_places(fest_id, len(holders))
+        if price is None:
+            db.session.rollback()
+            raise ValueError(
+                f"Festival has not enough free places for {len(holders)} tickets"
+                if len(holders) > 1
+                else "Festival is already out of tickets"
+            )
+        table = cls.__table__
+        try:
+            rows = db.session.execute(
+                table.insert()
+                .values(
+                    [
+                        {
+                            "user_email": user_email,
+                            "user_id": user_id,
+                            "fest_id": fest_id,
+                            "name": name,
+                            "surname": surname,
+                            "price": price,
+                            "approved": 0,
+                            "reserved_at": datetime.now(),
+                        }
+                        for name, surname in holders
+                    ]
+                )
+                .returning(table.c.ticket_id, table.c.price)
+            ).fetchall()
+            SalesRollup.record(
+                fest_id,
+                reservations=len(rows),
+                reserved_amount=sum(row.price or 0 for row in rows),
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            places.release(fest_id, len(holders))
+            raise
+        return [row.ticket_id for row in rows]
+
+
+    @classmethod
+    def stale_count(cls, hold_hours):
+        """Number of not approved tickets reserved more than ``hold_hours`` ago"""
+        cutoff = datetime.now() - timedelta(hours=hold_hours)
+        return (
+            db.session.query(func.count(cls.ticket_id))
+            .filter(cls.approved == 0, cls.reserved_at < cutoff)
+            .scalar()
+        )
+
+    @classmethod
+    def expire_stale(cls, hold_hours, batch_size=500):
+        """Cancel not approved tickets reserved more than ``hold_hours`` ago.
+
+        Works in batches, every batch is one transaction: festivals of
+        tickets are locked first (like by reservations and cascades), then
+        tickets with SKIP LOCKED (tickets locked by sellers or other workers
+        are left for next run), they are cancelled by one UPDATE and counters
+        of their festivals are decreased by one UPDATE per festival. Tickets reserved
+        before reserved_at existed get current time, so they expire after
+        full hold time.
+
+        Returns:
+            dict fest_id -> number of expired tickets
+        """
+        now = datetime.now()
+        cls.query.filter(cls.approved == 0, cls.reserved_at.is_(None)).update(
+            {cls.reserved_at: now}, synchronize_session=False
+        )
+        db.session.commit()
+        cutoff = now - timedelta(hours=hold_hours)
+        expired = {}
+        while True:
+            candidates = (
+                db.session.query(cls.ticket_id, cls.fest_id)
+                .filter(cls.approved == 0, cls.reserved_at < cutoff)
+                .order_by(cls.ticket_id)
+                .limit(batch_size)
+                .all()
+            )
+            if not candidates:
+                db.session.rollback()
+                break
+            # Festivals in fixed order, so concurrent workers can't deadlock
+            cascades.lock_festivals(sorted({row.fest_id for row in candidates}))
+            rows = (
+                db.session.query(cls.ticket_id, cls.fest_id, cls.price)
+                .filter(
+                    cls.ticket_id.in_([row.ticket_id for row in candidates]),
+                    cls.approved == 0,
+                )
+                .order_by(cls.ticket_id)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not rows:
+                # All locked by others
+                db.session.rollback()
+                break
+            cls.query.filter(cls.ticket_id.in_([row.ticket_id for row in rows])).update(
+                {cls.approved: 2, cls.reason: "Reservation expired"},
+                synchronize_session=False,
+            )
+            batch = {}
+            for row in rows:
+                count, amount = batch.get(row.fest_id, (0, 0))
+                batch[row.fest_id] = (count + 1, amount + (row.price or 0))
+            for fest_id, (count, amount) in sorted(batch.items()):
+                current = Festival.current_ticket_count
+                Festival.query.filter_by(fest_id=fest_id).update(
+                    {current: current - count}, synchronize_session=False
+                )
+                SalesRollup.record(
+                    fest_id, cancellations=count, cancelled_amount=amount
+                )
+            db.session.commit()
+            for fest_id, (count, _) in batch.items():
+                places.release(fest_id, count)
+                expired[fest_id] = expired.get(fest_id, 0) + count
+            if len(candidates) < batch_size:
+                break
+        if expired:
+            # Sold out festivals can be on sale again
+            catalogue.invalidate()
+        return expired
+
 
 class SellersList(db.Model):
     __tablename__ = "SellerList"
@@ -896,5 +1744,169 @@ class SellersList(db.Model):
     )
     seller = relationship("Seller", foreign_keys=seller_id)
 
+    __table_args__ = (
+        Index("ix_sellerlist_seller_fest", "seller_id", "fest_id"),
+        Index("ix_sellerlist_fest_id", "fest_id"),
+    )
+
     def __repr__(self):
         return f"Entry ID: {self.entry_id} - Seller id: {self.seller_id} -> Festival ID: {self.fest_id}"
+
+
+class Recommendation(db.Model):
+    """Top festivals for user, computed by batch job (recommendations.build).
+
+    Entries without user are the most popular festivals, which are
+    recommended to users without ticket history.
+    """
+
+    __tablename__ = "Recommendation"
+    entry_id = Column("entry_id", Integer, primary_key=True)
+    user_id = Column("user_id", Integer, ForeignKey("User.user_id"), nullable=True)
+    fest_id = Column("fest_id", Integer, ForeignKey("Festival.fest_id"), nullable=False)
+    rank = Column("rank", Integer, nullable=False)
+    score = Column("score", Float, nullable=False)
+
+    __table_args__ = (Index("ix_recommendation_user_rank", "user_id", "rank"),)
+
+    @classmethod
+    def for_user(cls, user_id):
+        """IDs of festivals recommended to user, best first"""
+
+        def load(uid):
+            return tuple(
+                fest_id
+                for (fest_id,) in db.session.query(cls.fest_id)
+                .filter(cls.user_id == uid)
+                .order_by(cls.rank)
+            )
+
+        fest_ids = recommended.get(("user", user_id), lambda: load(user_id))
+        return fest_ids or recommended.get("popular", lambda: load(None))
+
+
+class SalesRollup(db.Model):
+    """Ticket sales of festival in one day, kept by ticket state transitions.
+
+    Counters are changes of ticket states made that day, so their sums over
+    all days equal states of tickets: reserved tickets, tickets approved now
+    and tickets cancelled now. Cancelling approved ticket decreases
+    approvals. Amounts are sums of Ticket.price. Dashboards (analytics.py)
+    read only this table, analytics.reconcile fixes it from Ticket table.
+    """
+
+    __tablename__ = "SalesRollup"
+    fest_id = Column(
+        "fest_id", Integer, ForeignKey("Festival.fest_id"), primary_key=True
+    )
+    day = Column("day", Date, primary_key=True)
+    reservations = Column("reservations", Integer, nullable=False, default=0)
+    approvals = Column("approvals", Integer, nullable=False, default=0)
+    cancellations = Column("cancellations", Integer, nullable=False, default=0)
+    reserved_amount = Column("reserved_amount", Integer, nullable=False, default=0)
+    approved_amount = Column("approved_amount", Integer, nullable=False, default=0)
+    cancelled_amount = Column("cancelled_amount", Integer, nullable=False, default=0)
+
+    counters = (
+        "reservations",
+        "approvals",
+        "cancellations",
+        "reserved_amount",
+        "approved_amount",
+        "cancelled_amount",
+    )
+
+    @classmethod
+    def record(cls, fest_id, day=None, **deltas):
+        """Add ``deltas`` (counter -> change) to rollup of festival and day.
+
+        Runs in transaction of caller, after festival row was changed, so
+        locks are always taken in the same order.
+        """
+        deltas = {name: value for name, value in deltas.items() if value}
+        if not deltas:
+            return
+        table = cls.__table__
+        day = day or date.today()
+        if db.engine.dialect.name == "postgresql":
+            statement = pg_insert(table).values(fest_id=fest_id, day=day, **deltas)
+            db.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[table.c.fest_id, table.c.day],
+                    set_={
+                        name: table.c[name] + statement.excluded[name]
+                        for name in deltas
+                    },
+                )
+            )
+            return
+        updated = db.session.execute(
+            table.update()
+            .where(and_(table.c.fest_id == fest_id, table.c.day == day))
+            .values({name: table.c[name] + value for name, value in deltas.items()})
+        ).rowcount
+        if not updated:
+            db.session.execute(
+                table.insert().values(fest_id=fest_id, day=day, **deltas)
+            )
+
+
+class JobRun(db.Model):
+    """Totals and last run of background job, written by scheduler in jobs.py"""
+
+    __tablename__ = "JobRun"
+    name = Column("name", String(50), primary_key=True)
+    runs = Column("runs", Integer, nullable=False, default=0)
+    failures = Column("failures", Integer, nullable=False, default=0)
+    processed = Column("processed", Integer, nullable=False, default=0)
+    last_started = Column("last_started", DateTime)
+    last_duration_ms = Column("last_duration_ms", Float)
+    last_result = Column("last_result", Text)
+    last_error = Column("last_error", Text)
+
+    def __repr__(self):
+        return f"JobRun {self.name}: {self.runs} runs, {self.failures} failures"
+
+
+class MediaJob(db.Model):
+    """Copy of uploaded logo to its final key, run by media pipeline (media.py)
+
+    Attributes:
+        kind (string): "festival" or "band"
+        row_id (int): ID of festival or band
+        status (int): pending - 0 / done - 1 / failed - 2
+        run_after (datetime): job is not run before, set on retry and while
+            job is run (lease of worker)
+    """
+
+    __tablename__ = "MediaJob"
+    job_id = Column("job_id", Integer, primary_key=True)
+    kind = Column("kind", String(20), nullable=False)
+    row_id = Column("row_id", Integer, nullable=False)
+    upload_url = Column("upload_url", Text, nullable=False)
+    key = Column("key", Text, nullable=False)
+    status = Column("status", Integer, nullable=False, default=0)
+    attempts = Column("attempts", Integer, nullable=False, default=0)
+    run_after = Column("run_after", DateTime, nullable=False)
+    error = Column("error", Text)
+
+    __table_args__ = (Index("ix_media_job_status_run_after", "status", "run_after"),)
+
+    def __repr__(self):
+        return f"MediaJob {self.job_id} {self.kind} {self.row_id}: {self.key}"
+
+
+# Loader options for access patterns of views, relationships used by templates
+# are loaded by the main query instead of one lazy load per row
+TICKET_DETAILS = (joinedload(Ticket.fest), joinedload(Ticket.user))
+LINEUP = (joinedload(Performance.band),)
+PERFORMANCE_DETAILS = (
+    joinedload(Performance.band),
+    joinedload(Performance.stage),
+    joinedload(Performance.fest),
+)
+SELLER_LIST_DETAILS = (joinedload(SellersList.seller),)
+FESTIVAL_PAGE = (joinedload(Performance.band), joinedload(Performance.stage))
+
+# Cascades use models above
+import cascades
@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 from flask import Flask
 from flask_login import LoginManager
 import boto3
+import instrumentation
 
 load_dotenv()
 login_manager = LoginManager()
@@ -12,12 +13,89 @@ app = Flask(__name__)
 app.config["SECRET_USER"] = os.getenv("ROOT_EMAIL")
 app.config["SECRET_KEY"] = os.getenv("ROOT_PSSWD")
 app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
+app.config["CATALOGUE_TTL"] = int(os.getenv("CATALOGUE_TTL", 60))
+app.config["CATALOGUE_CACHE_SIZE"] = int(os.getenv("CATALOGUE_CACHE_SIZE", 100))
+# Requests issuing more SQL statements fail (for tests), 0 disables the check
+app.config["SQL_STATEMENT_LIMIT"] = int(os.getenv("SQL_STATEMENT_LIMIT", 0))
+# Statements slower than SLOW_QUERY_MS are written to SLOW_QUERY_LOG (if set)
+app.config["SLOW_QUERY_MS"] = float(os.getenv("SLOW_QUERY_MS", 100))
+app.config["SLOW_QUERY_LOG"] = os.getenv("SLOW_QUERY_LOG")
+# View models of festival pages are cached for FESTIVAL_PAGE_TTL seconds
+app.config["FESTIVAL_PAGE_TTL"] = int(os.getenv("FESTIVAL_PAGE_TTL", 60))
+app.config["FESTIVAL_PAGE_CACHE_SIZE"] = int(
+    os.getenv("FESTIVAL_PAGE_CACHE_SIZE", 1000)
+)
+# Recommendations of users are cached for RECOMMENDATION_TTL seconds
+app.config["RECOMMENDATION_TTL"] = int(os.getenv("RECOMMENDATION_TTL", 300))
+app.config["RECOMMENDATION_CACHE_SIZE"] = int(
+    os.getenv("RECOMMENDATION_CACHE_SIZE", 10000)
+)
+# Counters of free places: "local" (per worker) or "redis" (CAPACITY_REDIS_URL),
+# they are reloaded from database after CAPACITY_TTL seconds
+app.config["CAPACITY_BACKEND"] = os.getenv("CAPACITY_BACKEND", "local")
+app.config["CAPACITY_REDIS_URL"] = os.getenv(
+    "CAPACITY_REDIS_URL", "redis://localhost:6379/0"
+)
+app.config["CAPACITY_TTL"] = int(os.getenv("CAPACITY_TTL", 30))
+app.config["CAPACITY_SHARDS"] = int(os.getenv("CAPACITY_SHARDS", 16))
+# Festival page polls free places every CAPACITY_POLL_SECONDS
+app.config["CAPACITY_POLL_SECONDS"] = int(os.getenv("CAPACITY_POLL_SECONDS", 5))
+# Waiting room admits WAITING_ROOM_RATE visitors of festival per second,
+# WAITING_ROOM_BURST at once, admission is valid for given seconds, one client
+# address waits with at most WAITING_ROOM_PER_CLIENT numbers. Queues are kept
+# by WAITING_ROOM_BACKEND: "local" (in process, tests and one worker only) or
+# "redis" (WAITING_ROOM_REDIS_URL, shared by workers)
+app.config["WAITING_ROOM_BACKEND"] = os.getenv("WAITING_ROOM_BACKEND", "local")
+app.config["WAITING_ROOM_REDIS_URL"] = os.getenv(
+    "WAITING_ROOM_REDIS_URL", app.config["CAPACITY_REDIS_URL"]
+)
+app.config["WAITING_ROOM_RATE"] = float(os.getenv("WAITING_ROOM_RATE", 5))
+app.config["WAITING_ROOM_BURST"] = int(os.getenv("WAITING_ROOM_BURST", 20))
+app.config["WAITING_ROOM_ADMISSION_SECONDS"] = int(
+    os.getenv("WAITING_ROOM_ADMISSION_SECONDS", 600)
+)
+app.config["WAITING_ROOM_PER_CLIENT"] = int(os.getenv("WAITING_ROOM_PER_CLIENT", 4))
+# Uploaded logos are processed by jobs worker every MEDIA_INTERVAL_SECONDS,
+# MEDIA_BATCH_SIZE at once, job is leased to worker for MEDIA_LEASE_SECONDS,
+# failed jobs are retried MEDIA_RETRIES times after 1, 2, 4... *
+# MEDIA_RETRY_SECONDS
+app.config["MEDIA_INTERVAL_SECONDS"] = int(os.getenv("MEDIA_INTERVAL_SECONDS", 5))
+app.config["MEDIA_BATCH_SIZE"] = int(os.getenv("MEDIA_BATCH_SIZE", 20))
+app.config["MEDIA_LEASE_SECONDS"] = int(os.getenv("MEDIA_LEASE_SECONDS", 300))
+app.config["MEDIA_RETRIES"] = int(os.getenv("MEDIA_RETRIES", 3))
+app.config["MEDIA_RETRY_SECONDS"] = float(os.getenv("MEDIA_RETRY_SECONDS", 10))
+# Size of thumbnails of festival cards, WIDTHxHEIGHT
+app.config["THUMBNAIL_SIZE"] = tuple(
+    int(side) for side in os.getenv("THUMBNAIL_SIZE", "460x800").split("x")
+)
+# S3 stand-in (minio, moto server) for local tests, None means AWS
+app.config["S3_ENDPOINT_URL"] = os.getenv("S3_ENDPOINT_URL")
+app.config["S3_MAX_CONNECTIONS"] = int(os.getenv("S3_MAX_CONNECTIONS", 10))
+# Limits of uploads signed by /sign-s3, parts of multipart upload have to
+# have at least 5 MB
+app.config["UPLOAD_MAX_BYTES"] = int(os.getenv("UPLOAD_MAX_BYTES", 50 * 1024 * 1024))
+app.config["UPLOAD_BATCH_SIZE"] = int(os.getenv("UPLOAD_BATCH_SIZE", 10))
+app.config["MULTIPART_PART_SIZE"] = int(
+    os.getenv("MULTIPART_PART_SIZE", 8 * 1024 * 1024)
+)
+# Not approved tickets are cancelled RESERVATION_HOLD_HOURS after reservation
+# by jobs worker, EXPIRY_BATCH_SIZE tickets in one transaction
+app.config["RESERVATION_HOLD_HOURS"] = float(os.getenv("RESERVATION_HOLD_HOURS", 48))
+app.config["EXPIRY_BATCH_SIZE"] = int(os.getenv("EXPIRY_BATCH_SIZE", 500))
+# Intervals of jobs in seconds, 0 disables the job
+app.config["EXPIRY_INTERVAL_SECONDS"] = int(os.getenv("EXPIRY_INTERVAL_SECONDS", 60))
+app.config["RECONCILE_CAPACITY_SECONDS"] = int(
+    os.getenv("RECONCILE_CAPACITY_SECONDS", 600)
+)
+app.config["RECONCILE_SALES_SECONDS"] = int(os.getenv("RECONCILE_SALES_SECONDS", 3600))
 
 S3_BUCKET = os.environ.get("S3_BUCKET")
 S3_KEY = os.environ.get("AWS_ACCESS_KEY_ID")
 S3_SECRET = os.environ.get("AWS_SECRET_ACCESS_KEY")
+app.config["S3_BUCKET"] = S3_BUCKET
 
 login_manager.init_app(app)
+instrumentation.init_app(app)
 
 from views import *
 
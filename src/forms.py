@@ -65,6 +65,10 @@ class TicketForm(FlaskForm):
         "Surname *", validators=[DataRequired(), Regexp(r"^[a-zA-Z]{2,}[a-zA-Z\- ]*$")]
     )
     user_email = StringField("Email", validators=[DataRequired(), Email()])
+    quantity = IntegerField(
+        "Quantity", default=1, validators=[NumberRange(min=1, max=6)]
+    )
+    attendees = StringField("Other attendees (Name Surname; Name Surname)")
 
 
 class BandForm(FlaskForm):
@@ -0,0 +1,198 @@
+"""SQL instrumentation of requests.
+
+For every request counts issued SQL statements, time spent in database and
+fetched rows, keeps the slowest statements and sends totals in Server-Timing
+header. Statements slower than SLOW_QUERY_MS are written to rolling log
+SLOW_QUERY_LOG. Totals per route and per statement fingerprint are kept in
+process for admin endpoint /metrics/sql.
+
+When SQL_STATEMENT_LIMIT is configured, request which issues more statements
+fails with TooManyStatements, so N+1 queries are caught in tests.
+"""
+import logging
+import re
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Number of slowest statements kept for one request
+SLOWEST_KEPT = 5
+# Number of last slow statements shown by metrics endpoint
+RECENT_SLOW_KEPT = 50
+
+slow_log = logging.getLogger("festival_is.slow_queries")
+
+
+class TooManyStatements(AssertionError):
+    pass
+
+
+class Stats:
+    """Totals of requests per route and of statements per fingerprint"""
+
+    def __init__(self):
+        self.routes = {}
+        self.fingerprints = {}
+        self.recent_slow = deque(maxlen=RECENT_SLOW_KEPT)
+        self._lock = Lock()
+
+    def add_request(self, route, statements, db_ms, rows, total_ms):
+        with self._lock:
+            entry = self.routes.setdefault(
+                route,
+                {
+                    "requests": 0,
+                    "statements": 0,
+                    "db_ms": 0.0,
+                    "rows": 0,
+                    "total_ms": 0.0,
+                    "max_statements": 0,
+                },
+            )
+            entry["requests"] += 1
+            entry["statements"] += statements
+            entry["db_ms"] += db_ms
+            entry["rows"] += rows
+            entry["total_ms"] += total_ms
+            entry["max_statements"] = max(entry["max_statements"], statements)
+
+    def add_statement(self, fingerprint, ms):
+        with self._lock:
+            entry = self.fingerprints.setdefault(
+                fingerprint, {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            )
+            entry["count"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+
+    def add_slow(self, route, ms, statement, parameters):
+        with self._lock:
+            self.recent_slow.append(
+                {
+                    "route": route,
+                    "ms": round(ms, 3),
+                    "statement": statement,
+                    "parameters": repr(parameters),
+                }
+            )
+
+    def top(self, limit=20):
+        """Routes ordered by database time and fingerprints by total time"""
+        with self._lock:
+            routes = [
+                dict(
+                    route=route,
+                    avg_statements=round(entry["statements"] / entry["requests"], 1),
+                    avg_db_ms=round(entry["db_ms"] / entry["requests"], 3),
+                    **entry,
+                )
+                for route, entry in self.routes.items()
+            ]
+            fingerprints = [
+                dict(statement=statement, **entry)
+                for statement, entry in self.fingerprints.items()
+            ]
+            slow = list(self.recent_slow)
+        routes.sort(key=lambda r: r["db_ms"], reverse=True)
+        fingerprints.sort(key=lambda f: f["total_ms"], reverse=True)
+        return {
+            "routes": routes[:limit],
+            "statements": fingerprints[:limit],
+            "recent_slow": slow,
+        }
+
+
+stats = Stats()
+
+
+def fingerprint(statement):
+    """Statement without literal values, so the same queries are grouped"""
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"%\(\w+\)s|%s|:\w+|\b\d+\b", "?", statement)
+    statement = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", statement)
+    # Rows of multi-row INSERT
+    statement = re.sub(r"\(\?\)(?:\s*,\s*\(\?\))+", "(?)", statement)
+    return re.sub(r"\s+", " ", statement).strip()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    ms = (time.perf_counter() - conn.info["statement_start"].pop()) * 1000
+    stats.add_statement(fingerprint(statement), ms)
+    if not has_request_context():
+        return
+    g.sql_statements = g.get("sql_statements", 0) + 1
+    g.sql_ms = g.get("sql_ms", 0.0) + ms
+    g.sql_rows = g.get("sql_rows", 0) + max(cursor.rowcount or 0, 0)
+    slowest = g.setdefault("sql_slowest", [])
+    slowest.append((ms, statement, parameters))
+    slowest.sort(key=lambda s: s[0], reverse=True)
+    del slowest[SLOWEST_KEPT:]
+
+
+@event.listens_for(Engine, "handle_error")
+def failed_statement(context):
+    # after_cursor_execute is not called for failed statement
+    if context.connection is not None and context.execution_context is not None:
+        started = context.connection.info.get("statement_start")
+        if started:
+            started.pop()
+
+
+def init_app(app):
+    if app.config.get("SLOW_QUERY_LOG"):
+        handler = RotatingFileHandler(
+            app.config["SLOW_QUERY_LOG"], maxBytes=10 * 1024 * 1024, backupCount=5
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_log.addHandler(handler)
+        slow_log.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_request():
+        # g lives in app context, which is shared by requests in tests
+        g.sql_statements = 0
+        g.sql_ms = 0.0
+        g.sql_rows = 0
+        g.sql_slowest = []
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def report_request(response):
+        now = time.perf_counter()
+        total_ms = (now - g.get("request_start", now)) * 1000
+        statements = g.get("sql_statements", 0)
+        db_ms = g.get("sql_ms", 0.0)
+        # Unmatched URLs share one entry, so stats don't grow by random paths
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        route = f"{request.method} {rule}"
+        stats.add_request(route, statements, db_ms, g.get("sql_rows", 0), total_ms)
+        response.headers["Server-Timing"] = (
+            f'db;dur={db_ms:.1f};desc="{statements} statements", app;dur={total_ms:.1f}'
+        )
+        threshold = app.config.get("SLOW_QUERY_MS", 100)
+        for ms, statement, parameters in g.get("sql_slowest", []):
+            if ms >= threshold:
+                statement = " ".join(statement.split())
+                stats.add_slow(route, ms, statement, parameters)
+                slow_log.info("%s %.1f ms %s %r", route, ms, statement, parameters)
+        return response
+
+    @app.teardown_request
+    def check_statement_limit(exc):
+        # Raised from teardown, so it is not swallowed by error handlers of views
+        limit = app.config.get("SQL_STATEMENT_LIMIT")
+        count = g.get("sql_statements", 0)
+        if limit and count > limit:
+            raise TooManyStatements(
+                f"Request issued {count} SQL statements, limit is {limit}"
+            )
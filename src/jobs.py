@@ -0,0 +1,151 @@
+"""Background jobs run by worker process: python src/manage.py run_jobs
+
+Scheduler runs registered jobs one after another, every job when its
+interval passed since its previous run. Every run is recorded to JobRun
+table (runs, failures, processed items, duration and result or error of
+last run), so state of jobs run by worker is shown by web workers on
+/metrics/jobs.
+
+Jobs work in their own short transactions and skip rows locked by others,
+so several workers can run at once. Counters of free places released by
+worker are shared with web workers only by Redis backend, local counters
+of web workers are reloaded after CAPACITY_TTL.
+"""
+import json
+import logging
+import time
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+import analytics
+import media
+from festival_is import app
+from classes import db, Festival, JobRun, Ticket
+
+log = logging.getLogger("festival_is.jobs")
+
+
+def expire_reservations():
+    expired = Ticket.expire_stale(
+        app.config["RESERVATION_HOLD_HOURS"], app.config["EXPIRY_BATCH_SIZE"]
+    )
+    return sum(expired.values()), expired
+
+
+def process_media():
+    result = media.pipeline.run_due()
+    return sum(result.values()), result
+
+
+def reconcile_capacity():
+    fixed = Festival.reconcile_places()
+    return len(fixed), [list(row) for row in fixed]
+
+
+def reconcile_sales():
+    fixed = analytics.reconcile()
+    return len(fixed), fixed
+
+
+class Job:
+    def __init__(self, name, interval, function):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.next_run = 0.0
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, name, interval, function):
+        """Run ``function`` every ``interval`` seconds, 0 disables the job.
+
+        ``function`` returns (number of processed items, JSON-able result).
+        """
+        if interval > 0:
+            self.jobs.append(Job(name, interval, function))
+
+    def run_job(self, job):
+        started = datetime.now()
+        start = time.perf_counter()
+        try:
+            processed, result = job.function()
+        except Exception as e:
+            db.session.rollback()
+            log.exception("Job %s failed", job.name)
+            record(job.name, started, start, error=f"{e}")
+            return None
+        record(job.name, started, start, processed, result)
+        return processed
+
+    def run_pending(self):
+        """Run due jobs, returns seconds until the next one is due"""
+        for job in self.jobs:
+            if job.next_run <= time.monotonic():
+                self.run_job(job)
+                job.next_run = time.monotonic() + job.interval
+        return max(min(job.next_run for job in self.jobs) - time.monotonic(), 0)
+
+    def run(self, once=False):
+        while self.jobs:
+            with app.app_context():
+                wait = self.run_pending()
+            if once:
+                break
+            time.sleep(wait)
+
+
+def record(name, started, start, processed=0, result=None, error=None):
+    """Add run of job to its JobRun row"""
+    values = {
+        JobRun.runs: JobRun.runs + 1,
+        JobRun.failures: JobRun.failures + (1 if error else 0),
+        JobRun.processed: JobRun.processed + processed,
+        JobRun.last_started: started,
+        JobRun.last_duration_ms: round((time.perf_counter() - start) * 1000, 3),
+        JobRun.last_result: None if error else json.dumps(result),
+        JobRun.last_error: error,
+    }
+    for _ in range(2):
+        if JobRun.query.filter_by(name=name).update(values, synchronize_session=False):
+            db.session.commit()
+            return
+        db.session.add(JobRun(name=name, runs=0, failures=0, processed=0))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Added by other worker meanwhile
+            db.session.rollback()
+
+
+def scheduler_from_config(config):
+    scheduler = Scheduler()
+    scheduler.add(
+        "expire_reservations", config["EXPIRY_INTERVAL_SECONDS"], expire_reservations
+    )
+    scheduler.add(
+        "reconcile_capacity", config["RECONCILE_CAPACITY_SECONDS"], reconcile_capacity
+    )
+    scheduler.add("reconcile_sales", config["RECONCILE_SALES_SECONDS"], reconcile_sales)
+    scheduler.add("process_media", config["MEDIA_INTERVAL_SECONDS"], process_media)
+    return scheduler
+
+
+def stats():
+    return {
+        "hold_hours": app.config["RESERVATION_HOLD_HOURS"],
+        "stale_reservations": Ticket.stale_count(app.config["RESERVATION_HOLD_HOURS"]),
+        "jobs": {
+            run.name: {
+                "runs": run.runs,
+                "failures": run.failures,
+                "processed": run.processed,
+                "last_started": run.last_started and run.last_started.isoformat(),
+                "last_duration_ms": run.last_duration_ms,
+                "last_result": run.last_result and json.loads(run.last_result),
+                "last_error": run.last_error,
+            }
+            for run in JobRun.query.order_by(JobRun.name)
+        },
+    }
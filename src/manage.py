@@ -1,11 +1,16 @@
 from flask_script import Manager, commands
-from datetime import datetime
 from festival_is import app
-from classes import db, RootAdmin
+from classes import db, RootAdmin, Festival
+from scheduling import read_lineup
+import analytics
+import backup
+import benchmarks
+import jobs
+import migrations
+import recommendations
 from werkzeug.security import generate_password_hash
-import psycopg2
-import os
 import sys
+import time
 
 manager = Manager(app)
 
@@ -17,6 +22,8 @@ def init_db():
         db.engine.echo = True
         db.metadata.bind = db.engine
         db.metadata.create_all(checkfirst=True)
+        migrations.create_schedule_constraint()
+        migrations.create_search_indexes()
         root = RootAdmin(
             user_email=app.config["SECRET_USER"],
             name="Main",
@@ -39,40 +46,224 @@ def drop_db():
         db.metadata.drop_all(checkfirst=True)
 
 
+@manager.option("-w", "--workers", dest="workers", type=int, default=4)
+@manager.option("-c", "--compression", dest="compression", default="gzip")
+@manager.option("-d", "--directory", dest="directory", default="")
+def export_db(workers, compression, directory):
+    """Dump all tables from one snapshot in parallel (compression gzip, zstd or none)"""
+    manifest = backup.export(directory or None, workers, compression)
+    for table, entry in manifest["tables"].items():
+        print(f"{table:>15}: {entry['rows']} rows, {entry['seconds']} s")
+    print(f"Snapshot {manifest['snapshot_time']} exported in {manifest['seconds']} s")
+
+
+@manager.option("-d", "--directory", dest="directory", default="src/data")
+@manager.option("-w", "--workers", dest="workers", type=int, default=4)
+@manager.option("-m", "--mode", dest="mode", default="upsert")
+def import_db(directory="src/data", workers=4, mode="upsert"):
+    """Load table files (CSV, CSV.GZ, CSV.ZST) in foreign key order (mode upsert or skip)"""
+    with app.app_context():
+        results = backup.restore(directory, workers, mode)
+        migrations.sync_band_tags()
+    for entry in results:
+        print(
+            f"{entry['table']:>15}: {entry['rows']} rows, {entry['merged']} merged, "
+            f"{entry['seconds']} s, {entry['rows_per_second']} rows/s"
+        )
+
+
+@manager.command
+def migrate():
+    """Apply all schema migrations to existing database"""
+    migrate_tables()
+    migrate_indexes()
+    migrate_schedule()
+    migrate_search()
+
+
+@manager.command
+def migrate_tables():
+    """Create tables of new models and new columns of existing ones"""
+    with app.app_context():
+        created = migrations.create_tables()
+        added = migrations.create_columns()
+    print("Created tables:", ", ".join(created) if created else "nothing to do")
+    print("Added columns:", ", ".join(added) if added else "nothing to do")
+
+
 @manager.command
-def export_db():
-    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-    cur = conn.cursor()
-    sql = """
-    select table_name from information_schema.tables
-    where table_schema not in ('information_schema', 'pg_catalog') and
-    table_type = 'BASE TABLE'
+def migrate_schedule():
+    """Add exclusion constraint for overlapping performances on stage"""
+    with app.app_context():
+        created = migrations.create_schedule_constraint()
+    print("Schedule constraint:", "created" if created else "nothing to do")
+
+
+@manager.command
+def migrate_search():
+    """Add full-text indexes and fill tag index from tags of bands"""
+    with app.app_context():
+        created = migrations.create_search_indexes()
+        synced = migrations.sync_band_tags()
+    print("Full-text indexes:", "ready" if created else "not supported by database")
+    print(f"Tags of {synced} bands synchronized")
+
+
+@manager.command
+def migrate_indexes():
+    """Create indexes declared on models, which are missing in database"""
+    with app.app_context():
+        created = migrations.create_indexes()
+    print("Created indexes:", ", ".join(created) if created else "nothing to do")
+
+
+@manager.option("-e", "--every", dest="every", type=float, default=0)
+def reconcile_capacity(every):
+    """Recount sold tickets of festivals and reset counters of free places.
+
+    With every > 0 runs forever, every ``every`` seconds. Only Redis counters
+    are shared with web workers, local ones are reloaded after CAPACITY_TTL.
+    """
+    while True:
+        with app.app_context():
+            fixed = Festival.reconcile_places()
+        for fest_id, stored, counted in fixed:
+            print(f"Festival {fest_id}: {stored} -> {counted} tickets")
+        print(f"{len(fixed)} festivals fixed")
+        if every <= 0:
+            break
+        time.sleep(every)
+
+
+@manager.option("-e", "--every", dest="every", type=float, default=0)
+def reconcile_sales(every):
+    """Book tickets missing in sales rollups (imports, manual fixes) to today.
+
+    With every > 0 runs forever, every ``every`` seconds.
     """
-    cur.execute(sql)
-    date = datetime.now().strftime("%Y%m%d-%H%M%S")
-    os.mkdir("src/data/backup/" + date)
-    for i in cur.fetchall():
-        f = open("src/data/backup/" + date + "/" + i[0] + ".csv", "w")
-        cur.copy_expert('COPY "' + i[0] + '" TO STDOUT WITH CSV HEADER', f)
-        f.close()
-    cur.close()
+    while True:
+        with app.app_context():
+            fixed = analytics.reconcile()
+        for fest_id, deltas in fixed.items():
+            print(f"Festival {fest_id}: {deltas}")
+        print(f"{len(fixed)} festivals fixed")
+        if every <= 0:
+            break
+        time.sleep(every)
+
+
+@manager.command
+def run_jobs(once=False):
+    """Run background jobs (expiry of reservations, reconciliations) forever"""
+    jobs.scheduler_from_config(app.config).run(once)
+
+
+@manager.option("-c", "--calls", dest="calls", type=int, default=200)
+def bench_sign(calls):
+    """Latency of signing uploads with new and with shared S3 client"""
+    with app.app_context():
+        benchmarks.signing(calls)
+
+
+@manager.option("-t", "--top_k", dest="top_k", type=int, default=20)
+def build_recommendations(top_k):
+    """Recompute recommended festivals of users from ticket history"""
+    with app.app_context():
+        result = recommendations.build(top_k)
+    for key, value in result.items():
+        print(f"{key:>15}: {value}")
+
+
+@manager.option("-u", "--users", dest="users", type=int, default=10000)
+@manager.option("-f", "--festivals", dest="festivals", type=int, default=1000)
+@manager.option("-t", "--tickets", dest="tickets", type=int, default=200000)
+@manager.option("-r", "--repeat", dest="repeat", type=int, default=50)
+@manager.option("-o", "--output", dest="output", default="")
+def bench_indexes(users, festivals, tickets, repeat, output):
+    """Seed synthetic data and compare hot query latencies without/with indexes"""
+    benchmarks.indexes(users, festivals, tickets, repeat, output or None)
+
+
+@manager.option("-u", "--users", dest="users", type=int, default=100000)
+@manager.option("-s", "--sellers", dest="sellers", type=int, default=1000)
+@manager.option("-o", "--organizers", dest="organizers", type=int, default=100)
+@manager.option("-a", "--admins", dest="admins", type=int, default=10)
+@manager.option("-f", "--festivals", dest="festivals", type=int, default=5000)
+@manager.option("-t", "--tickets", dest="tickets", type=int, default=1000000)
+@manager.option("-b", "--bands", dest="bands", type=int, default=2000)
+def seed_db(users, sellers, organizers, admins, festivals, tickets, bands):
+    """Fill database with synthetic data of given size (names contain "bench")"""
+    start = time.perf_counter()
+    with app.app_context():
+        seeded = benchmarks.seed(
+            users, sellers, organizers, admins, festivals, tickets, bands
+        )
+    print(f"Seeded {tickets} tickets in {round(time.perf_counter() - start, 1)} s")
+    for key, ids in seeded.items():
+        if key != "token":
+            print(f"{key:>15}: {len(ids)}")
+
+
+@manager.option("-d", "--duration", dest="duration", type=float, default=60)
+@manager.option("-c", "--clients", dest="clients", type=int, default=20)
+@manager.option("-o", "--output", dest="output", default="")
+def bench_load(duration, clients, output):
+    """Replay traffic mix on seeded database, report p50/p95/p99 latency of routes"""
+    benchmarks.load(duration, clients, output or None)
+
+
+@manager.option("-s", "--sizes", dest="sizes", default="1000,10000")
+@manager.option("-r", "--repeat", dest="repeat", type=int, default=20)
+@manager.option("-o", "--output", dest="output", default="")
+def bench_methods(sizes, repeat, output):
+    """Latencies of domain methods at several data sizes, saved as JSON baseline"""
+    sizes = [int(size) for size in sizes.split(",")]
+    benchmarks.methods(sizes, repeat, output or None)
+
+
+# Options are registered bottom up, so baseline is the first argument
+@manager.option("current")
+@manager.option("baseline")
+@manager.option("-t", "--threshold", dest="threshold", type=float, default=0.2)
+def bench_compare(baseline, current, threshold):
+    """Compare two bench_methods reports, fail when method is slower than threshold"""
+    regressions = benchmarks.compare(baseline, current, threshold)
+    if regressions:
+        print(f"{len(regressions)} regressions over {threshold:.0%}")
+        sys.exit(1)
+
+
+@manager.option("-s", "--sizes", dest="sizes", default="100,1000,10000")
+@manager.option("-r", "--repeat", dest="repeat", type=int, default=3)
+@manager.option("-o", "--output", dest="output", default="")
+def bench_cascades(sizes, repeat, output):
+    """Latencies of set-based cascades (cancel festival, remove stage and user)"""
+    sizes = [int(size) for size in sizes.split(",")]
+    benchmarks.cascade_timings(sizes, repeat, output or None)
+
+
+@manager.option("-a", "--attempts", dest="attempts", type=int, default=5000)
+@manager.option("-c", "--capacity", dest="capacity", type=int, default=1000)
+@manager.option("-w", "--workers", dest="workers", type=int, default=10)
+def bench_reserve(attempts, capacity, workers):
+    """Parallel reservations against one festival, checks oversell and throughput"""
+    benchmarks.reservations(attempts, capacity, workers)
 
 
 @manager.command
-def import_db():
-    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-    cur = conn.cursor()
-    for i in sorted(os.listdir("src/data")):
-        if i.endswith(".csv"):
-            table = i.split("-")[1].split(".")[0]
-            print(f"From src/data/{i} - To table {table}")
-            with open(f"src/data/{i}", "r") as f:
-                header = f.readline()
-                cur.copy_expert(
-                    f'COPY "{table}" ({header}) FROM STDIN CSV', f,
-                )
-            conn.commit()
-    cur.close()
+def import_lineup(fest_id, path):
+    """Add performances from CSV/JSON file (band_name, stage_id, time_from, time_to)"""
+    with app.app_context():
+        with open(path, "r") as f:
+            rows = read_lineup(f.read(), path)
+        fest = Festival.query.filter_by(fest_id=fest_id).first()
+        if fest is None:
+            print(f"Festival {fest_id} does not exist")
+            return
+        msg, status, errors = fest.organizer.import_lineup(rows, fest_id)
+    print(msg)
+    for number, error in errors:
+        print(f"Row {number}: {error}")
 
 
 @manager.command
@@ -0,0 +1,400 @@
+"""Uploads of images to S3 and background processing of uploaded logos.
+
+Browser gets presigned POST (or presigned parts of multipart upload for big
+files) from sign_* functions, which need no request to S3 except creating
+and completing multipart upload. Latency of every signing is measured and
+shown by metrics endpoint.
+
+Browser uploads logo straight to S3 (see sign_s3), festival or band keeps
+URL of the upload as pending logo and request returns at once. Copy of the
+upload to its final key (server-side copy), thumbnail for festival cards
+(made by Pillow, error is logged at start without it) and storing of final
+URLs is MediaJob row, run by jobs worker (manage.py run_jobs). Jobs survive
+restarts of processes, failed jobs are retried with exponential backoff and
+the last error of every job is kept in its row.
+
+All threads of process share one S3 client (boto3 clients are
+thread-safe), S3_ENDPOINT_URL points it to local stand-in (minio, moto
+server).
+"""
+import io
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+import boto3
+from botocore.config import Config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are optional
+    Image = None
+from festival_is import app
+from sqlalchemy import func
+from classes import db, Band, Festival, MediaJob, Performance, catalogue
+
+if Image is None:
+    app.logger.error("Package Pillow is not installed, thumbnails are not made")
+
+# Number of last failed jobs shown by metrics endpoint
+FAILED_KEPT = 50
+# Status of MediaJob by name
+STATUSES = {"pending": 0, "done": 1, "failed": 2}
+
+log = logging.getLogger("festival_is.media")
+
+_client = None
+_client_lock = Lock()
+
+
+def s3_client():
+    """S3 client shared by the whole process"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.client(
+                    "s3",
+                    endpoint_url=app.config["S3_ENDPOINT_URL"],
+                    config=Config(
+                        max_pool_connections=app.config["S3_MAX_CONNECTIONS"],
+                        retries={"max_attempts": 3, "mode": "standard"},
+                    ),
+                )
+    return _client
+
+
+def public_url(key):
+    if app.config["S3_ENDPOINT_URL"]:
+        endpoint = app.config["S3_ENDPOINT_URL"].rstrip("/")
+        return f"{endpoint}/{app.config['S3_BUCKET']}/{key}"
+    return f"https://{app.config['S3_BUCKET']}.s3.amazonaws.com/{key}"
+
+
+def key_of(url):
+    """Key of object in bucket from its public URL"""
+    base = public_url("")
+    if url.startswith(base):
+        return url[len(base) :]
+    return url.split(".com/")[-1]
+
+
+def url_of(url, key):
+    """Public URL of ``key`` in the same bucket as object with ``url``"""
+    return url[: len(url) - len(key_of(url))] + key
+
+
+def thumbnail(data, size):
+    """PNG image cropped and resized to ``size`` (width, height)"""
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.fit(image.convert("RGBA"), size, Image.LANCZOS)
+    result = io.BytesIO()
+    image.save(result, "PNG", optimize=True)
+    return result.getvalue()
+
+
+class Timings:
+    """Count and latency of signing calls by operation"""
+
+    def __init__(self):
+        self.operations = {}
+        self._lock = Lock()
+
+    def add(self, operation, ms):
+        with self._lock:
+            entry = self.operations.setdefault(
+                operation, {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            )
+            entry["count"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+
+    def stats(self):
+        with self._lock:
+            return {
+                operation: dict(
+                    avg_ms=round(entry["total_ms"] / entry["count"], 3), **entry
+                )
+                for operation, entry in self.operations.items()
+            }
+
+
+timings = Timings()
+
+
+def timed(operation):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.add(operation, (time.perf_counter() - start) * 1000)
+
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+    return decorator
+
+
+def check_size(size):
+    if size is not None and not 0 < size <= app.config["UPLOAD_MAX_BYTES"]:
+        limit = app.config["UPLOAD_MAX_BYTES"]
+        raise ValueError(f"File has to be at most {limit} bytes")
+
+
+@timed("post")
+def sign_post(key, content_type, expires=3600):
+    """Presigned POST of one public file, limited to UPLOAD_MAX_BYTES"""
+    return {
+        "data": s3_client().generate_presigned_post(
+            Bucket=app.config["S3_BUCKET"],
+            Key=key,
+            Fields={"acl": "public-read", "Content-Type": content_type},
+            Conditions=[
+                {"acl": "public-read"},
+                {"Content-Type": content_type},
+                ["content-length-range", 1, app.config["UPLOAD_MAX_BYTES"]],
+            ],
+            ExpiresIn=expires,
+        ),
+        "url": public_url(key),
+    }
+
+
+def sign_posts(folder, files, expires=3600):
+    """Presigned POSTs of several files
+
+    Args:
+        files: list of (file name, content type)
+    """
+    if len(files) > app.config["UPLOAD_BATCH_SIZE"]:
+        raise ValueError(f"At most {app.config['UPLOAD_BATCH_SIZE']} files at once")
+    return [
+        sign_post(f"{folder}/{name}", content_type, expires)
+        for name, content_type in files
+    ]
+
+
+@timed("multipart")
+def sign_multipart(key, content_type, size, expires=3600):
+    """Start multipart upload and presign PUT of its every part"""
+    check_size(size)
+    client = s3_client()
+    bucket = app.config["S3_BUCKET"]
+    part_size = app.config["MULTIPART_PART_SIZE"]
+    upload_id = client.create_multipart_upload(
+        Bucket=bucket, Key=key, ACL="public-read", ContentType=content_type
+    )["UploadId"]
+    return {
+        "upload_id": upload_id,
+        "key": key,
+        "part_size": part_size,
+        "parts": [
+            {
+                "part_number": number,
+                "url": client.generate_presigned_url(
+                    "upload_part",
+                    Params={
+                        "Bucket": bucket,
+                        "Key": key,
+                        "UploadId": upload_id,
+                        "PartNumber": number,
+                    },
+                    ExpiresIn=expires,
+                ),
+            }
+            for number in range(1, math.ceil(size / part_size) + 1)
+        ],
+        "url": public_url(key),
+    }
+
+
+@timed("complete")
+def complete_multipart(key, upload_id, parts):
+    """Join uploaded parts, ``parts`` are (part number, ETag)"""
+    s3_client().complete_multipart_upload(
+        Bucket=app.config["S3_BUCKET"],
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": int(number), "ETag": etag}
+                for number, etag in sorted(parts, key=lambda p: int(p[0]))
+            ]
+        },
+    )
+    return public_url(key)
+
+
+@timed("abort")
+def abort_multipart(key, upload_id):
+    s3_client().abort_multipart_upload(
+        Bucket=app.config["S3_BUCKET"], Key=key, UploadId=upload_id
+    )
+
+
+class LogoJob:
+    """Copy of uploaded logo of festival or band to its final key"""
+
+    def __init__(self, kind, row_id, upload_url, key):
+        self.kind = kind
+        self.row_id = row_id
+        self.upload_url = upload_url
+        self.key = key
+
+    def __repr__(self):
+        return f"LogoJob {self.kind} {self.row_id}: {self.upload_url} -> {self.key}"
+
+    def thumbnail_key(self):
+        return self.key.rsplit(".", 1)[0] + "-thumb.png"
+
+    def run(self, client, bucket):
+        source = key_of(self.upload_url)
+        client.copy(
+            {"Bucket": bucket, "Key": source},
+            bucket,
+            self.key,
+            ExtraArgs={"ACL": "public-read"},
+        )
+        thumbnail_url = None
+        if self.kind == "festival" and Image is not None:
+            data = client.get_object(Bucket=bucket, Key=source)["Body"].read()
+            client.put_object(
+                Bucket=bucket,
+                Key=self.thumbnail_key(),
+                Body=thumbnail(data, app.config["THUMBNAIL_SIZE"]),
+                ContentType="image/png",
+                ACL="public-read",
+            )
+            thumbnail_url = url_of(self.upload_url, self.thumbnail_key())
+        self.store(url_of(self.upload_url, self.key), thumbnail_url)
+
+    def store(self, url, thumbnail_url):
+        """Replace pending logo, unless the logo was changed meanwhile"""
+        if self.kind == "festival":
+            values = {Festival.fest_logo: url}
+            if thumbnail_url:
+                values[Festival.fest_thumbnail] = thumbnail_url
+            Festival.query.filter(
+                Festival.fest_id == self.row_id, Festival.fest_logo == self.upload_url
+            ).update(values, synchronize_session=False)
+            fest_ids = [self.row_id]
+        else:
+            Band.query.filter(
+                Band.band_id == self.row_id, Band.logo == self.upload_url
+            ).update({Band.logo: url}, synchronize_session=False)
+            fest_ids = [
+                fest_id
+                for (fest_id,) in db.session.query(Performance.fest_id)
+                .filter(Performance.band_id == self.row_id)
+                .distinct()
+            ]
+        db.session.commit()
+        catalogue.invalidate()
+        Festival.invalidate_page(*fest_ids)
+
+
+class MediaPipeline:
+    """Queue of LogoJobs kept in MediaJob table"""
+
+    def __init__(self, retries=3, retry_seconds=10.0, batch_size=20, lease_seconds=300):
+        self.retries = retries
+        self.retry_seconds = retry_seconds
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+
+    def submit(self, job):
+        """Add job to queue, commits session"""
+        db.session.add(
+            MediaJob(
+                kind=job.kind,
+                row_id=job.row_id,
+                upload_url=job.upload_url,
+                key=job.key,
+                status=0,
+                attempts=0,
+                run_after=datetime.now(),
+            )
+        )
+        db.session.commit()
+
+    def claim(self):
+        """Lease due pending jobs to this worker, jobs leased by others are skipped"""
+        now = datetime.now()
+        rows = (
+            MediaJob.query.filter(MediaJob.status == 0, MediaJob.run_after <= now)
+            .order_by(MediaJob.run_after)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for row in rows:
+            # Job of killed worker is run again after lease
+            row.run_after = now + timedelta(seconds=self.lease_seconds)
+            row.attempts += 1
+        db.session.commit()
+        return rows
+
+    def run_due(self):
+        """Run due jobs once
+
+        Returns:
+            dict "done", "retried", "failed" -> number of jobs
+        """
+        result = {"done": 0, "retried": 0, "failed": 0}
+        client, bucket = s3_client(), app.config["S3_BUCKET"]
+        for row in self.claim():
+            job_id, attempts = row.job_id, row.attempts
+            job = LogoJob(row.kind, row.row_id, row.upload_url, row.key)
+            try:
+                job.run(client, bucket)
+            except Exception as e:
+                db.session.rollback()
+                if attempts <= self.retries:
+                    delay = self.retry_seconds * 2 ** (attempts - 1)
+                    values = {
+                        MediaJob.run_after: datetime.now() + timedelta(seconds=delay),
+                        MediaJob.error: f"{e}",
+                    }
+                    result["retried"] += 1
+                else:
+                    log.exception("%r failed", job)
+                    values = {MediaJob.status: 2, MediaJob.error: f"{e}"}
+                    result["failed"] += 1
+            else:
+                values = {MediaJob.status: 1, MediaJob.error: None}
+                result["done"] += 1
+            MediaJob.query.filter_by(job_id=job_id).update(
+                values, synchronize_session=False
+            )
+            db.session.commit()
+        return result
+
+    def stats(self):
+        counts = dict(
+            db.session.query(MediaJob.status, func.count(MediaJob.job_id)).group_by(
+                MediaJob.status
+            )
+        )
+        failed = (
+            MediaJob.query.filter(MediaJob.status == 2)
+            .order_by(MediaJob.job_id.desc())
+            .limit(FAILED_KEPT)
+        )
+        return {
+            **{name: counts.get(status, 0) for name, status in STATUSES.items()},
+            "failed_jobs": [{"job": repr(job), "error": job.error} for job in failed],
+            "thumbnails": Image is not None,
+            "signing": timings.stats(),
+        }
+
+
+pipeline = MediaPipeline(
+    app.config["MEDIA_RETRIES"],
+    app.config["MEDIA_RETRY_SECONDS"],
+    app.config["MEDIA_BATCH_SIZE"],
+    app.config["MEDIA_LEASE_SECONDS"],
+)
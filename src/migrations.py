@@ -0,0 +1,167 @@
+"""Schema changes for already existing databases (create_all only creates missing tables)"""
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex, DropIndex
+from classes import db, Band, BandTag, Ticket
+import search
+
+
+def create_tables():
+    """Create tables of models added after database was created
+
+    Returns:
+        list of names of created tables
+    """
+    existing = set(inspect(db.engine).get_table_names())
+    missing = [t for t in db.metadata.sorted_tables if t.name not in existing]
+    db.metadata.create_all(db.engine, tables=missing)
+    return [table.name for table in missing]
+
+
+def create_columns():
+    """Add nullable columns added to models of already existing tables
+
+    Returns:
+        list of added columns as "table.column"
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                raise ValueError(f"Column {table.name}.{column.name} has to be nullable")
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            db.engine.execute(
+                f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+            )
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def managed_indexes():
+    """All indexes declared on models"""
+    return [index for table in db.metadata.sorted_tables for index in table.indexes]
+
+
+def existing_indexes():
+    inspector = inspect(db.engine)
+    return {
+        (table.name, index["name"])
+        for table in db.metadata.sorted_tables
+        for index in inspector.get_indexes(table.name)
+    }
+
+
+def create_indexes(concurrently=True):
+    """Create declared indexes, which don't exist in database yet.
+
+    On PostgreSQL indexes are built CONCURRENTLY, so tables stay writable
+    while the migration runs (it can't be done inside transaction, so every
+    index is created in autocommit mode).
+
+    Returns:
+        list of names of created indexes
+    """
+    existing = existing_indexes()
+    concurrently = concurrently and db.engine.dialect.name == "postgresql"
+    created = []
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        for index in managed_indexes():
+            if (index.table.name, index.name) in existing:
+                continue
+            index.dialect_kwargs["postgresql_concurrently"] = concurrently
+            try:
+                conn.execute(CreateIndex(index))
+            finally:
+                index.dialect_kwargs["postgresql_concurrently"] = False
+            created.append(index.name)
+    if created and db.engine.dialect.name == "postgresql":
+        db.engine.execute("ANALYZE")
+    return created
+
+
+def drop_indexes():
+    """Drop declared indexes (used by benchmark to measure queries without them)"""
+    existing = existing_indexes()
+    dropped = []
+    with db.engine.connect() as conn:
+        for index in managed_indexes():
+            if (index.table.name, index.name) in existing:
+                conn.execute(DropIndex(index))
+                dropped.append(index.name)
+    return dropped
+
+
+def create_schedule_constraint():
+    """Forbid overlapping not canceled performances on one stage (PostgreSQL only).
+
+    Returns:
+        True if constraint was created, False if it exists or database is not PostgreSQL
+    """
+    if db.engine.dialect.name != "postgresql":
+        return False
+    exists = db.engine.execute(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'ex_performance_stage_time'"
+    ).first()
+    if exists:
+        return False
+    with db.engine.begin() as conn:
+        conn.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+        conn.execute(
+            """
+            ALTER TABLE "Performance" ADD CONSTRAINT ex_performance_stage_time
+            EXCLUDE USING gist (stage_id WITH =, tsrange(time_from, time_to) WITH &&)
+            WHERE (canceled IS NOT TRUE)
+            """
+        )
+    return True
+
+
+def create_search_indexes():
+    """GIN indexes of full-text documents of festivals and bands and prefix
+    indexes of ticket holders searched in ticket ledger (PostgreSQL only)
+
+    Returns:
+        True if database is PostgreSQL and indexes exist
+    """
+    if db.engine.dialect.name != "postgresql":
+        return False
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        for name, table, document in (
+            ("ix_festival_fts", "Festival", search.FESTIVAL_DOCUMENT),
+            ("ix_band_fts", "Band", search.BAND_DOCUMENT),
+        ):
+            conn.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON "{table}" '
+                f"USING gin (({document}))"
+            )
+        # lower(column) LIKE 'prefix%' of one festival
+        for column in Ticket.search_columns:
+            conn.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                f'ix_ticket_fest_{column}_prefix ON "Ticket" '
+                f"(fest_id, lower({column}) text_pattern_ops)"
+            )
+    return True
+
+
+def sync_band_tags():
+    """Fill Tag and BandTag tables from Band.tags of bands which have no tags there
+
+    Returns:
+        number of synchronized bands
+    """
+    bands = Band.query.filter(
+        Band.tags.isnot(None), ~Band.band_id.in_(db.session.query(BandTag.band_id))
+    ).all()
+    for band in bands:
+        band.sync_tags()
+    db.session.commit()
+    return len(bands)
@@ -0,0 +1,170 @@
+"""Batch job computing festival recommendations from ticket history.
+
+Score of upcoming festival F for user is sum of two parts:
+
+    * co-attendance: for every festival A the user bought ticket for, cosine
+      similarity of A and F by sets of their visitors
+      (|visitors(A) & visitors(F)| / sqrt(|visitors(A)| * |visitors(F)|))
+    * content: CONTENT_WEIGHT * cosine similarity of user profile and F, both
+      as vectors of style, band genres and band tags
+
+Vectors are sparse dicts, matrices are never materialized: co-attendance
+is accumulated only for pairs of festivals some user visited together.
+Top TOP_K festivals of every user are stored in Recommendation table, users
+without history get the most popular upcoming festivals.
+"""
+import heapq
+import math
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from classes import db, Band, Festival, Performance, Recommendation, Ticket, recommended
+
+TOP_K = 20
+CONTENT_WEIGHT = 0.5
+# Festivals of one user taken into account, bounds work for very active users
+MAX_HISTORY = 50
+# Candidates for content part per feature, the most popular first
+MAX_PER_FEATURE = 200
+
+
+def normalize(vector):
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    return {key: value / norm for key, value in vector.items()} if norm else {}
+
+
+def festival_vectors(styles, bands):
+    """Normalized feature vectors of festivals.
+
+    Args:
+        styles: iterable of (fest_id, style)
+        bands: iterable of (fest_id, genre, tags separated by ";")
+    """
+    vectors = defaultdict(Counter)
+    for fest_id, style in styles:
+        if style:
+            vectors[fest_id][f"style:{style.lower()}"] += 2
+    for fest_id, genre, tags in bands:
+        if genre:
+            vectors[fest_id][f"style:{genre.lower()}"] += 1
+        for tag in (tags or "").split(";"):
+            if tag.strip():
+                vectors[fest_id][f"tag:{tag.strip().lower()}"] += 1
+    return {fest_id: normalize(vector) for fest_id, vector in vectors.items()}
+
+
+def co_attendance(history, candidates):
+    """Cosine similarity of festivals by visitors, only pairs ending in candidate
+
+    Returns:
+        dict festival -> dict candidate -> similarity
+    """
+    visitors = Counter(fest_id for fests in history.values() for fest_id in fests)
+    together = defaultdict(Counter)
+    for fests in history.values():
+        for fest_id in fests:
+            for other in fests:
+                if other != fest_id and other in candidates:
+                    together[fest_id][other] += 1
+    return {
+        fest_id: {
+            other: count / math.sqrt(visitors[fest_id] * visitors[other])
+            for other, count in others.items()
+        }
+        for fest_id, others in together.items()
+    }
+
+
+def recommend(history, vectors, candidates, popularity, top_k=TOP_K):
+    """Top festivals for every user with history.
+
+    Args:
+        history: dict user -> list of visited festivals (newest first)
+        vectors: dict festival -> normalized feature vector
+        candidates: set of festivals which can be recommended
+        popularity: Counter of tickets of candidates
+
+    Returns:
+        dict user -> list of (festival, score), best first
+    """
+    history = {user: fests[:MAX_HISTORY] for user, fests in history.items()}
+    similar = co_attendance(history, candidates)
+    by_feature = defaultdict(list)
+    for fest_id in sorted(candidates, key=lambda f: -popularity[f]):
+        for feature in vectors.get(fest_id, {}):
+            if len(by_feature[feature]) < MAX_PER_FEATURE:
+                by_feature[feature].append(fest_id)
+
+    result = {}
+    for user, fests in history.items():
+        visited = set(fests)
+        scores = Counter()
+        for fest_id in visited:
+            for other, similarity in similar.get(fest_id, {}).items():
+                scores[other] += similarity
+        profile = Counter()
+        for fest_id in visited:
+            profile.update(vectors.get(fest_id, {}))
+        profile = normalize(profile)
+        for feature, weight in profile.items():
+            for other in by_feature.get(feature, ()):
+                scores[other] += CONTENT_WEIGHT * weight * vectors[other][feature]
+        for fest_id in visited:
+            scores.pop(fest_id, None)
+        result[user] = heapq.nlargest(top_k, scores.items(), key=lambda s: s[1])
+    return result
+
+
+def build(top_k=TOP_K):
+    """Recompute Recommendation table from tickets, returns statistics"""
+    start = time.perf_counter()
+    now = datetime.now()
+    candidates = {
+        fest_id
+        for (fest_id,) in db.session.query(Festival.fest_id).filter(
+            Festival.status == 1, Festival.time_from > now
+        )
+    }
+    history = defaultdict(list)
+    tickets = (
+        db.session.query(Ticket.user_id, Ticket.fest_id, Festival.time_from)
+        .join(Festival, Festival.fest_id == Ticket.fest_id)
+        .filter(Ticket.user_id.isnot(None), Ticket.approved != 2)
+        .distinct()
+        .order_by(Ticket.user_id, Festival.time_from.desc())
+    )
+    popularity = Counter()
+    for user_id, fest_id, _ in tickets.yield_per(10000):
+        history[user_id].append(fest_id)
+        if fest_id in candidates:
+            popularity[fest_id] += 1
+    vectors = festival_vectors(
+        db.session.query(Festival.fest_id, Festival.style),
+        db.session.query(Performance.fest_id, Band.genre, Band.tags)
+        .join(Band, Band.band_id == Performance.band_id)
+        .filter(Performance.canceled == False),
+    )
+    computed = recommend(history, vectors, candidates, popularity, top_k)
+    popular = sorted(candidates, key=lambda f: (-popularity[f], f))[:top_k]
+
+    rows = [
+        dict(user_id=None, fest_id=fest_id, rank=rank, score=float(popularity[fest_id]))
+        for rank, fest_id in enumerate(popular)
+    ]
+    for user_id, scored in computed.items():
+        rows += [
+            dict(user_id=user_id, fest_id=fest_id, rank=rank, score=score)
+            for rank, (fest_id, score) in enumerate(scored)
+        ]
+    table = Recommendation.__table__
+    db.session.execute(table.delete())
+    for part in range(0, len(rows), 5000):
+        db.session.execute(table.insert(), rows[part : part + 5000])
+    db.session.commit()
+    recommended.invalidate()
+    return {
+        "users": len(computed),
+        "candidates": len(candidates),
+        "rows": len(rows),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
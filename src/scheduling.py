@@ -0,0 +1,117 @@
+"""Timelines of stages, used to find collisions of performances.
+
+Intervals are half-open [start, end), so performance can start exactly when
+previous one on the same stage ends. Same rule is used by exclusion
+constraint on Performance table (see migrations.py).
+"""
+import csv
+import io
+import json
+from bisect import bisect_left, bisect_right
+
+# Columns of line up file, times are in format LINEUP_TIME_FORMAT
+LINEUP_COLUMNS = ("band_name", "stage_id", "time_from", "time_to")
+LINEUP_TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+
+class Timeline:
+    """Intervals of one stage.
+
+    Overlapping intervals (which can exist in old data) are merged to blocks,
+    blocks don't overlap and are sorted, so both their starts and ends are
+    sorted and collisions are found by binary search in O(log n + k).
+    """
+
+    def __init__(self, intervals=()):
+        self.starts, self.ends, self.blocks = [], [], []
+        for start, end, item in sorted(intervals, key=lambda i: (i[0], i[1])):
+            if self.ends and start < self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+                self.blocks[-1].append((start, end, item))
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.blocks.append([(start, end, item)])
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks)
+
+    def _overlapping_blocks(self, start, end):
+        # Blocks starting before end and ending after start
+        return bisect_right(self.ends, start), bisect_left(self.starts, end)
+
+    def collisions(self, start, end):
+        """Items of intervals overlapping with [start, end)"""
+        first, last = self._overlapping_blocks(start, end)
+        return [
+            item
+            for block in self.blocks[first:last]
+            for (s, e, item) in block
+            if s < end and start < e
+        ]
+
+    def add(self, start, end, item):
+        """Add interval, merging blocks it overlaps with"""
+        first, last = self._overlapping_blocks(start, end)
+        block = [(start, end, item)]
+        for merged in self.blocks[first:last]:
+            block += merged
+        block.sort(key=lambda i: (i[0], i[1]))
+        new_start = min(start, self.starts[first]) if first < last else start
+        new_end = max(end, self.ends[last - 1]) if first < last else end
+        self.starts[first:last] = [new_start]
+        self.ends[first:last] = [new_end]
+        self.blocks[first:last] = [block]
+
+
+class Schedule:
+    """Timelines of several stages"""
+
+    def __init__(self, intervals=()):
+        by_stage = {}
+        for stage_id, start, end, item in intervals:
+            by_stage.setdefault(stage_id, []).append((start, end, item))
+        self.timelines = {
+            stage_id: Timeline(items) for stage_id, items in by_stage.items()
+        }
+
+    def timeline(self, stage_id):
+        return self.timelines.setdefault(stage_id, Timeline())
+
+    def collisions(self, stage_id, start, end):
+        return self.timeline(stage_id).collisions(start, end)
+
+    def validate(self, entries):
+        """Check proposed performances against timelines and against each other.
+
+        Args:
+            entries: iterable of (stage_id, start, end, item)
+
+        Returns:
+            list of (item, list of colliding items) for entries with collisions,
+            valid entries are added to timelines
+        """
+        problems = []
+        for stage_id, start, end, item in entries:
+            collisions = self.collisions(stage_id, start, end)
+            if collisions:
+                problems.append((item, collisions))
+            else:
+                self.timeline(stage_id).add(start, end, item)
+        return problems
+
+
+def read_lineup(text, filename):
+    """Rows of line up from CSV file with header or from JSON list of objects"""
+    if filename.lower().endswith(".json"):
+        rows = json.loads(text)
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("JSON line up has to be list of objects")
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    if not rows:
+        raise ValueError("Line up file is empty")
+    missing = [column for column in LINEUP_COLUMNS if column not in rows[0]]
+    if missing:
+        raise ValueError(f"Line up file has no columns: {', '.join(missing)}")
+    return rows
@@ -0,0 +1,109 @@
+"""Full-text search over published festivals and bands.
+
+On PostgreSQL documents are weighted tsvectors (name > style/genre >
+description/tags) matched by prefix tsquery and ranked by ts_rank, both
+backed by GIN expression indexes (see migrations.create_search_indexes, the
+expressions here and there have to be the same). Other databases fall back
+to LIKE matching, which is fine for development data.
+
+Autocomplete uses sorted list of names and tags kept in catalogue cache and
+finds prefixes by binary search.
+"""
+import re
+from bisect import bisect_left
+from sqlalchemy import and_, or_, text
+from classes import db, Band, Festival, Tag, catalogue
+
+# Same configuration and weights are used by GIN indexes
+FESTIVAL_DOCUMENT = (
+    "setweight(to_tsvector('simple', coalesce(fest_name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(style, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'C')"
+)
+BAND_DOCUMENT = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(genre, '')), 'B') || "
+    "setweight(to_tsvector('simple', replace(coalesce(tags, ''), ';', ' ')), 'C')"
+)
+# Words of query taken into account
+MAX_WORDS = 8
+
+
+def words(query):
+    return re.findall(r"\w+", query.lower())[:MAX_WORDS]
+
+
+def prefix_query(query):
+    """tsquery matching documents with every word (last one can be unfinished)"""
+    return " & ".join(f"{word}:*" for word in words(query))
+
+
+def ranked(model, document, query, condition, limit):
+    tsquery = prefix_query(query)
+    if not tsquery:
+        return []
+    if db.engine.dialect.name != "postgresql":
+        columns = {
+            Festival: (Festival.fest_name, Festival.style, Festival.description),
+            Band: (Band.name, Band.genre, Band.tags),
+        }[model]
+        matches = [or_(*[c.ilike(f"%{word}%") for c in columns]) for word in words(query)]
+        return model.query.filter(condition, and_(*matches)).limit(limit).all()
+    match = text(f"({document}) @@ to_tsquery('simple', :query)")
+    rank = text(f"ts_rank({document}, to_tsquery('simple', :query)) DESC")
+    return (
+        model.query.filter(condition, match)
+        .order_by(rank)
+        .params(query=tsquery)
+        .limit(limit)
+        .all()
+    )
+
+
+def search(query, limit=20):
+    """Published festivals and not deleted bands matching query, best first"""
+    return {
+        "festivals": ranked(
+            Festival, FESTIVAL_DOCUMENT, query, Festival.status == 1, limit
+        ),
+        "bands": ranked(Band, BAND_DOCUMENT, query, Band.deleted_on.is_(None), limit),
+    }
+
+
+def load_terms():
+    """Sorted (key, label, kind) of every word suffix of names and of tags.
+
+    Keys start at every word, so "fest" completes "Bear fest" too.
+    """
+    labels = [
+        (name, "festival")
+        for (name,) in db.session.query(Festival.fest_name).filter(Festival.status == 1)
+    ]
+    labels += [
+        (name, "band")
+        for (name,) in db.session.query(Band.name).filter(Band.deleted_on.is_(None))
+    ]
+    labels += [(name, "tag") for (name,) in db.session.query(Tag.name)]
+    terms = set()
+    for label, kind in labels:
+        parts = label.lower().split()
+        for i in range(len(parts)):
+            terms.add((" ".join(parts[i:]), label, kind))
+    terms = sorted(terms)
+    return [term[0] for term in terms], terms
+
+
+def autocomplete(prefix, limit=10):
+    """Names of festivals, bands and tags starting with prefix (at any word)"""
+    prefix = " ".join(prefix.lower().split())
+    if not prefix:
+        return []
+    keys, terms = catalogue.get("search_terms", load_terms)
+    result = []
+    for i in range(bisect_left(keys, prefix), len(keys)):
+        if not keys[i].startswith(prefix) or len(result) >= limit:
+            break
+        entry = {"label": terms[i][1], "kind": terms[i][2]}
+        if entry not in result:
+            result.append(entry)
+    return result
@@ -1,13 +1,41 @@
-from flask import render_template, request, redirect, flash, url_for, session
+from flask import (
+    render_template,
+    request,
+    redirect,
+    flash,
+    url_for,
+    session,
+)
 from classes import *
+from cache import caches
+import analytics
+import instrumentation
+import jobs
+import media
+import search
+from scheduling import read_lineup
+import waiting_room
 from festival_is import app, login_manager
 from forms import *
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_required, logout_user, current_user, login_user
-from datetime import timedelta
+from datetime import datetime, timedelta
 from werkzeug.datastructures import MultiDict
-import json, boto3
+from markupsafe import Markup
+from botocore.exceptions import ClientError
+import json
 import os
+import time
+
+# Reservations are accepted only from sessions admitted by waiting room
+reservation_queue = waiting_room.from_config(app.config)
+if app.config["WAITING_ROOM_BACKEND"] == "local" and (
+    int(os.getenv("WEB_CONCURRENCY", 1)) > 1
+):
+    app.logger.warning(
+        "Waiting room is kept in process of every worker, "
+        "set WAITING_ROOM_BACKEND=redis"
+    )
 
 
 @app.before_request
@@ -45,24 +73,82 @@ def user_loader(user_id):
     return User.query.get(user_id)
 
 
+def festival_filters(args):
+    """Festival.search filters from query string of home page"""
+
+    def number(name):
+        value = args.get(name, "").strip()
+        return int(value) if value != "" else None
+
+    def day(name):
+        value = args.get(name, "").strip()
+        return datetime.strptime(value, "%Y-%m-%d") if value != "" else None
+
+    return dict(
+        styles=[style for style in args.getlist("style") if style != ""],
+        date_from=day("date_from"),
+        date_to=day("date_to"),
+        price_min=number("price_min"),
+        price_max=number("price_max"),
+        on_sale=args.get("sale") == "1",
+        age=number("age"),
+        free_only=args.get("free") == "1",
+        sort="cost" if args.get("sort") == "cost" else "date",
+        after=args.get("after") or None,
+    )
+
+
 @app.route("/", methods=["GET", "POST"])
 def home():
-
-    recommendations = None
-    styles_set, data = Festival.get_festivals_styles()
-    list_of_dicts = [row for row in data]
+    recommendations = frozenset()
+    try:
+        filters = festival_filters(request.args)
+    except ValueError:
+        flash("Bad format of filter values", "warning")
+        return redirect("/")
     if current_user.is_authenticated:
-        recommendations = list(current_user.get_recomendations())
-        recommendations_count = len(recommendations)
-        return render_template(
-            "festivals.html",
-            user_columns=current_user,
-            fests=list_of_dicts,
-            recommendations=recommendations,
-            styles=styles_set,
-            recommendations_count=recommendations_count,
-        )
-    return render_template("festivals.html", fests=list_of_dicts,styles=styles_set)
+        recommendations = current_user.get_recomendations()
+        if request.args.get("recommended") == "1":
+            filters["fest_ids"] = recommendations
+    try:
+        if filters.get("fest_ids") == frozenset():
+            # Nothing to recommend yet
+            fests, cursor = [], None
+        else:
+            fests, cursor = Festival.search(**filters)
+    except ValueError as e:
+        flash(f"{e}", "warning")
+        return redirect("/")
+
+    args = request.args.to_dict(flat=False)
+    args.pop("after", None)
+    first_page = url_for("home", **args) if filters["after"] else None
+    next_page = url_for("home", after=cursor, **args) if cursor else None
+    return render_template(
+        "festivals.html",
+        user_columns=current_user,
+        fests=fests,
+        recommendations=recommendations,
+        styles=Festival.get_styles(),
+        recommendations_count=len(recommendations),
+        filters=request.args,
+        next_page=next_page,
+        first_page=first_page,
+    )
+
+
+@app.route("/search")
+def search_page():
+    query = request.args.get("q", "")
+    results = search.search(query) if query.strip() else None
+    return render_template(
+        "search.html", user_columns=current_user, query=query, results=results
+    )
+
+
+@app.route("/search/autocomplete")
+def search_autocomplete():
+    return json.dumps(search.autocomplete(request.args.get("q", "")))
 
 
 @app.route("/about")
@@ -74,12 +160,12 @@ def about():
 
 @app.route("/user")
 def user():
-    return render_template("festivals.html", title="User")
+    return redirect(url_for("home"))
 
 
 @app.route("/organizer")
 def organizer():
-    return render_template("festivals.html")
+    return redirect(url_for("home"))
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -148,34 +234,158 @@ def submit_form():
 @app.route("/sign-s3/<folder>/<_id>/")
 @login_required
 def sign_s3(folder, _id):
-    # Load necessary information into the application
-    S3_BUCKET = os.environ.get("S3_BUCKET")
-
     # Load required data from the request
     folder_name = f"{folder}/{_id}"
     file_name = request.args.get("file-name")
     file_type = request.args.get("file-type")
 
-    # Initialise the S3 client
-    s3 = boto3.client("s3")
     # Generate and return the presigned URL
-    presigned_post = s3.generate_presigned_post(
-        Bucket=S3_BUCKET,
-        Key=f"{folder_name}/{file_name}",
-        Fields={"acl": "public-read", "Content-Type": file_type},
-        Conditions=[{"acl": "public-read"}, {"Content-Type": file_type}],
-        ExpiresIn=3600,
-    )
+    return json.dumps(media.sign_post(f"{folder_name}/{file_name}", file_type))
 
-    # Return the data to the client
-    return json.dumps(
-        {
-            "data": presigned_post,
-            "url": f"https://{S3_BUCKET}.s3.amazonaws.com/{folder_name}/{file_name}",
-        }
+
+@app.route("/sign-s3/<folder>/<_id>/batch", methods=["POST"])
+@login_required
+def sign_s3_batch(folder, _id):
+    """Presigned POSTs of files given as JSON list of {"name", "type"}"""
+    files = request.get_json(force=True).get("files", [])
+    try:
+        signed = media.sign_posts(
+            f"{folder}/{_id}", [(file["name"], file["type"]) for file in files]
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        return json.dumps({"error": f"{e}"}), 400
+    return json.dumps({"files": signed})
+
+
+@app.route("/sign-s3/<folder>/<_id>/multipart", methods=["POST"])
+@login_required
+def sign_s3_multipart(folder, _id):
+    """Start multipart upload of big file given as JSON {"name", "type", "size"}"""
+    file = request.get_json(force=True)
+    try:
+        signed = media.sign_multipart(
+            f"{folder}/{_id}/{file['name']}", file["type"], int(file["size"])
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        return json.dumps({"error": f"{e}"}), 400
+    except ClientError as e:
+        return json.dumps({"error": f"{e}"}), 502
+    return json.dumps(signed)
+
+
+@app.route("/sign-s3/<folder>/<_id>/multipart/complete", methods=["POST"])
+@login_required
+def complete_s3_multipart(folder, _id):
+    """Join parts, JSON {"key", "upload_id", "parts": [{"part_number", "etag"}]}"""
+    upload = request.get_json(force=True)
+    try:
+        if not upload["key"].startswith(f"{folder}/{_id}/"):
+            raise ValueError("Upload does not belong to this folder")
+        if upload.get("abort"):
+            media.abort_multipart(upload["key"], upload["upload_id"])
+            return json.dumps({"aborted": True})
+        url = media.complete_multipart(
+            upload["key"],
+            upload["upload_id"],
+            [(part["part_number"], part["etag"]) for part in upload["parts"]],
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        return json.dumps({"error": f"{e}"}), 400
+    except ClientError as e:
+        return json.dumps({"error": f"{e}"}), 502
+    return json.dumps({"url": url})
+
+
+def analytics_festivals():
+    """IDs of festivals whose sales current user can see, None means all"""
+    if current_user.perms <= 1:
+        return None
+    return [
+        fest_id
+        for (fest_id,) in db.session.query(Festival.fest_id).filter(
+            Festival.org_id == current_user.user_id
+        )
+    ]
+
+
+@app.route("/analytics")
+@login_required
+def analytics_dashboard():
+    if current_user.perms > 2:
+        flash("Only organizers and admins can see sales", "warning")
+        return redirect("/")
+    festivals = analytics.summary(analytics_festivals())
+    if request.args.get("format") == "json":
+        return json.dumps(festivals)
+    return render_template(
+        "analytics.html", festivals=festivals, user_columns=current_user
     )
 
 
+@app.route("/analytics/<int:fest_id>")
+@login_required
+def analytics_festival(fest_id):
+    """Daily sales of festival as JSON, optionally ?from=YYYY-MM-DD&to=YYYY-MM-DD"""
+    allowed = analytics_festivals()
+    if current_user.perms > 2 or (allowed is not None and fest_id not in allowed):
+        return json.dumps({"error": "Sales of this festival are not available"}), 403
+    try:
+        date_from, date_to = (
+            datetime.strptime(request.args[name], "%Y-%m-%d").date()
+            if request.args.get(name)
+            else None
+            for name in ("from", "to")
+        )
+    except ValueError as e:
+        return json.dumps({"error": f"{e}"}), 400
+    return json.dumps(analytics.daily(fest_id, date_from, date_to))
+
+
+@app.route("/metrics/cache")
+@login_required
+def cache_metrics():
+    if current_user.perms > 1:
+        flash("Only admin can see cache metrics", "warning")
+        return redirect("/")
+    return json.dumps([cache.stats() for cache in caches.values()])
+
+
+@app.route("/metrics/sql")
+@login_required
+def sql_metrics():
+    if current_user.perms > 1:
+        flash("Only admin can see SQL metrics", "warning")
+        return redirect("/")
+    return json.dumps(instrumentation.stats.top())
+
+
+@app.route("/metrics/media")
+@login_required
+def media_metrics():
+    if current_user.perms > 1:
+        flash("Only admin can see media metrics", "warning")
+        return redirect("/")
+    return json.dumps(media.pipeline.stats())
+
+
+@app.route("/metrics/jobs")
+@login_required
+def jobs_metrics():
+    if current_user.perms > 1:
+        flash("Only admin can see job metrics", "warning")
+        return redirect("/")
+    return json.dumps(jobs.stats())
+
+
+@app.route("/metrics/waiting_room")
+@login_required
+def waiting_room_metrics():
+    if current_user.perms > 1:
+        flash("Only admin can see waiting room metrics", "warning")
+        return redirect("/")
+    return json.dumps(reservation_queue.stats())
+
+
 @app.route("/protected")
 @login_required
 def protected():
@@ -190,14 +400,51 @@ def logout():
     return redirect("/")
 
 
-@app.route("/festival/<fest_id>", methods=["GET", "POST"])
+def queue_entry(fest_id):
+    return session.get("waiting_room", {}).get(str(fest_id))
+
+
+def queue_position(fest_id):
+    """Place of session in waiting room of festival, (0, 0) when admitted.
+
+    Returns:
+        None when session is not in queue (or its number is not valid)
+    """
+    entry = queue_entry(fest_id)
+    if entry is None:
+        return None
+    position = reservation_queue.position(fest_id, entry["room"], entry["number"])
+    if position is None:
+        leave_queue(fest_id)
+    return position
+
+
+def join_queue(fest_id):
+    """Give session number in queue of festival, False when client has too many"""
+    joined = reservation_queue.join(fest_id, request.access_route[-1])
+    if joined is None:
+        return False
+    entries = session.get("waiting_room", {})
+    entries[str(fest_id)] = {"room": joined[0], "number": joined[1]}
+    session["waiting_room"] = entries
+    return True
+
+
+def leave_queue(fest_id, admitted=False):
+    entries = session.get("waiting_room", {})
+    entry = entries.pop(str(fest_id), None)
+    if admitted and entry is not None:
+        reservation_queue.leave(fest_id, entry["room"], entry["number"])
+    session["waiting_room"] = entries
+
+
+@app.route("/festival/<int:fest_id>", methods=["GET", "POST"])
 def festival_page(fest_id):
-    fest = Festival.get_festival(fest_id)
+    page = Festival.page(fest_id)
+    if page is None:
+        flash(f"Festival {fest_id} does not exist", "warning")
+        return redirect("/")
     anonim = current_user.is_anonymous
-    perfs = Performance.query.filter( and_( Performance.fest_id == fest_id, Performance.canceled == False )).all() 
-    tags = ""
-    for perf in perfs[0:5:]:
-        tags += " ".join(perf.band.tags.split(";"))
 
     form = (
         TicketForm()
@@ -213,24 +460,74 @@ def festival_page(fest_id):
     )
 
     if form.is_submitted():
+        position = queue_position(fest_id)
+        if position is None:
+            if not join_queue(fest_id):
+                flash("Too many places in queue from your address", "warning")
+                return redirect(f"/festival/{fest_id}")
+            # Without spike the new number is admitted at once
+            position = queue_position(fest_id)
+        if position != (0, 0):
+            flash("Please wait in queue until it is your turn", "warning")
+            return redirect(f"/festival/{fest_id}")
         try:
+            quantity = int(request.form.get("quantity") or 1)
+            attendees = parse_attendees(request.form.get("attendees"))
             if anonim:
-                BaseUser.reserve_ticket(form, fest_id)
+                tickets = BaseUser.reserve_ticket(form, fest_id, quantity, attendees)
             else:
-                current_user.reserve_ticket(fest_id)
+                tickets = current_user.reserve_ticket(fest_id, quantity, attendees)
         except ValueError as e:
             flash(f"{e}", "warning")
             return redirect("/")
-        flash("Ticket is successfully reserved", "success")
+        leave_queue(fest_id, admitted=True)
+        flash(f"{len(tickets)} ticket(s) successfully reserved", "success")
         return redirect("/")
+    ahead, wait = queue_position(fest_id) or (0, 0)
+    lineup_html = Festival.page_fragment(
+        page,
+        "lineup",
+        lambda: Markup(render_template("festival_lineup.html", lineup=page.lineup)),
+    )
     return render_template(
         "festival_page.html",
-        fest=fest,
+        fest=page.fest,
         user_columns=current_user,
         form=form,
         anonym=current_user.is_anonymous,
-        perfs=perfs,
-        tags=tags
+        lineup_html=lineup_html,
+        tags=" ".join(page.tags),
+        free_places=Festival.free_places(fest_id),
+        queue_ahead=ahead,
+        queue_wait=wait,
+    )
+
+
+@app.route("/festival/<int:fest_id>/queue")
+def festival_queue(fest_id):
+    """Position of session in waiting room, polled by festival page"""
+    position = queue_position(fest_id)
+    if position is None:
+        return json.dumps({"queued": False, "admitted": False})
+    ahead, wait = position
+    return json.dumps(
+        {"queued": True, "admitted": not ahead, "ahead": ahead, "wait_seconds": wait}
+    )
+
+
+@app.route("/festival/<int:fest_id>/availability")
+def festival_availability(fest_id):
+    """Free places read from counter, polled by festival page"""
+    free = Festival.free_places(fest_id)
+    if free is None:
+        return "", 404
+    return (
+        json.dumps({"free_places": free}),
+        200,
+        {
+            "Content-Type": "application/json",
+            "Cache-Control": f"max-age={app.config['CAPACITY_POLL_SECONDS']}",
+        },
     )
 
 
@@ -308,20 +605,17 @@ def add_festival():
         if request.form["fest_logo"] == "https://festival-static.s3-eu-west-1.amazonaws.com/def_fest_logo.png":
             pass
         else:
-            print(request.form["fest_logo"], flush=True)
-            S3_BUCKET = os.environ.get("S3_BUCKET")
-
-            s3 = boto3.resource("s3")
-            copy_source = {
-                "Bucket": S3_BUCKET,
-                "Key": form["fest_logo"].split(".com/")[-1],
-            }
-            bucket = s3.Bucket(S3_BUCKET)
-            bucket.copy(copy_source, f"fest/{fest.fest_id}/{fest.fest_id}.png")
-        
-            fest.fest_logo = f'{form["fest_logo"].split(".com/")[0]}.com/fest/{fest.fest_id}/{fest.fest_id}.png'
-            
-        db.session.commit()
+            # Upload is shown until media pipeline copies it to its place
+            fest.fest_logo = form["fest_logo"]
+            db.session.commit()
+            media.pipeline.submit(
+                media.LogoJob(
+                    "festival",
+                    fest.fest_id,
+                    form["fest_logo"],
+                    f"fest/{fest.fest_id}/{fest.fest_id}.png",
+                )
+            )
         return redirect(f"/my_festivals/{fest.fest_id}/edit")
     return render_template(
         "edit_festival.html",
@@ -351,6 +645,25 @@ def fest_add_perf(fest_id, source):
     return redirect(f"/my_festivals/{fest_id}/edit")
 
 
+@login_required
+@app.route("/<source>/<fest_id>/import_lineup", methods=["POST"])
+def import_lineup(fest_id, source):
+    lineup = request.files.get("lineup")
+    if lineup is None or lineup.filename == "":
+        flash("Please, choose file with line up", "warning")
+        return redirect(f"/my_festivals/{fest_id}/edit")
+    try:
+        rows = read_lineup(lineup.read().decode("utf-8"), lineup.filename)
+    except (UnicodeDecodeError, ValueError) as e:
+        flash(f"Line up file can't be read: {e}", "warning")
+        return redirect(f"/my_festivals/{fest_id}/edit")
+    msg, status, errors = current_user.import_lineup(rows, fest_id)
+    flash(msg, status)
+    for number, error in errors:
+        flash(f"Row {number}: {error}", "warning")
+    return redirect(f"/my_festivals/{fest_id}/edit")
+
+
 @login_required
 @app.route("/<source>/<fest_id>/del_perf/<perf_id>")
 def fest_del_perf(fest_id, perf_id, source):
@@ -388,14 +701,57 @@ def create_seller(fest_id, source):
 @login_required
 @app.route("/<source>/<fest_id>/manage_tickets")
 def manage_tickets(fest_id, source):
-    tickets, fest, actuality = current_user.get_sellers_tickets(fest_id)
+    status = request.args.get("status") or None
+    search = request.args.get("q", "").strip() or None
+    try:
+        after = int(request.args["after"]) if request.args.get("after") else None
+        page = current_user.get_sellers_tickets(
+            fest_id, status=status, search=search, after=after
+        )
+    except ValueError as e:
+        flash(f"{e}", "warning")
+        return redirect(f"/{source}/{fest_id}/manage_tickets")
+    tickets, fest, actuality, next_after, counts = page
     return render_template(
         "manage_tickets.html",
         tickets=tickets,
         user_columns=current_user,
         actuality=actuality,
         fest=fest,
+        counts=counts,
+        status=status,
+        search=search,
+        next_after=next_after,
+        source=source,
+    )
+
+
+@login_required
+@app.route("/<source>/<fest_id>/manage_tickets/bulk", methods=["POST"])
+def manage_tickets_bulk(fest_id, source):
+    """Approve or cancel selected tickets, form or JSON {"ticket_ids", "action"}"""
+    data = request.get_json() if request.is_json else request.form
+    ticket_ids = (
+        data.get("ticket_ids", []) if request.is_json else data.getlist("ticket_id")
     )
+    try:
+        outcomes = current_user.manage_tickets_seller(
+            int(fest_id), ticket_ids, data.get("action"), data.get("reason", "")
+        )
+    except ValueError as e:
+        if request.is_json:
+            return json.dumps({"error": f"{e}"}), 400
+        flash(f"{e}", "warning")
+        return redirect(f"/{source}/{fest_id}/manage_tickets")
+    if request.is_json:
+        return json.dumps(outcomes)
+    done = [t for t, outcome in outcomes.items() if outcome in ("approved", "cancelled")]
+    skipped = sorted(set(outcomes) - set(done))
+    action = "approved" if data.get("action") == "approve" else "cancelled"
+    flash(f"{len(done)} ticket(s) {action}", "success")
+    if skipped:
+        flash(f"Tickets {', '.join(map(str, skipped))} were not changed", "warning")
+    return redirect(f"/{source}/{fest_id}/manage_tickets")
 
 
 @login_required
@@ -495,17 +851,14 @@ def add_band():
     if request.form["band-logo"] == "https://festival-static.s3-eu-west-1.amazonaws.com/defaut_band_logo.png":
         pass
     else:
-        S3_BUCKET = os.environ.get("S3_BUCKET")
-        s3 = boto3.resource("s3")
-        copy_source = {
-            "Bucket": S3_BUCKET,
-            "Key": request.form["band-logo"].split(".com/")[-1],
-        }
-        bucket = s3.Bucket(S3_BUCKET)
-        bucket.copy(copy_source, f"band/{band.band_id}/{band.name}.png")
-
-        band.logo = f'{request.form["band-logo"].split(".com/")[0]}.com/band/{band.band_id}/{band.name}.png'
-    db.session.commit()
+        media.pipeline.submit(
+            media.LogoJob(
+                "band",
+                band.band_id,
+                band.logo,
+                f"band/{band.band_id}/{band.name}.png",
+            )
+        )
 
     return redirect("/manage_bands")
 
@@ -0,0 +1,308 @@
+"""Virtual waiting room in front of ticket reservations.
+
+Visitor who submits reservation of festival without admission gets next
+number of festival's queue (admitted at once when tokens are left) and
+numbers are admitted in order by token bucket: ``rate`` admissions per
+second, up to ``burst`` at once after quiet period. Without spike queue is
+empty and visitors are admitted at once, during on-sale of popular
+festival the database gets at most ``rate`` reservations per second.
+
+Admissions are kept by the room (number -> deadline) and used up by the
+reservation, session only carries ID of room and its number. Numbers are
+valid only in the room which issued them, so they can't be replayed for
+other festivals or after the room is dropped. One client (IP address) can
+wait with at most ``per_client`` numbers, so clients without cookies can't
+push other visitors back.
+
+Backends (like counters in capacity.py):
+
+    * LocalWaitingRoom: rooms kept in process, for tests and one worker
+      process. With several gunicorn workers every worker has its own
+      queues, numbers issued by other worker are refused and the database
+      gets ``rate`` reservations per second from every worker
+    * RedisWaitingRoom: rooms shared by all workers in Redis, changed by
+      Lua scripts, so they are atomic. Time of admissions is taken from
+      clocks of web workers, which have to be synchronized (NTP)
+"""
+import secrets
+import time
+from collections import deque
+from threading import Lock
+
+try:
+    import redis
+except ImportError:  # Redis backend is optional
+    redis = None
+
+# Keys of rooms of festivals in Redis
+REDIS_PREFIX = "festival_is:waiting_room:"
+
+# Loads room (KEYS[1] hash, KEYS[2] admissions: number -> deadline) and
+# admits visitors by tokens accrued until ARGV[1]
+ROOM_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local hold = tonumber(ARGV[4])
+local room = redis.call('HMGET', KEYS[1], 'id', 'next', 'admitted', 'tokens', 'updated')
+local room_id = room[1]
+local next_number = tonumber(room[2]) or 0
+local admitted = tonumber(room[3]) or 0
+local tokens = tonumber(room[4]) or burst
+local updated = tonumber(room[5]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local function admit()
+    local count = math.min(math.floor(tokens), next_number - admitted)
+    for number = admitted + 1, admitted + count do
+        redis.call('ZADD', KEYS[2], now + hold, number)
+    end
+    admitted = admitted + count
+    tokens = tokens - count
+end
+-- Room is dropped after its last admission expired
+local function ttl()
+    return math.ceil(hold + (next_number - admitted) / rate) + 1
+end
+local function save()
+    redis.call('HSET', KEYS[1], 'next', next_number, 'admitted', admitted,
+        'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], ttl())
+    redis.call('EXPIRE', KEYS[2], ttl())
+end
+admit()
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. now)
+"""
+# KEYS[3] waiting numbers of client, ARGV[5] per client, ARGV[6] ID of new room
+JOIN_SCRIPT = """
+if not room_id then
+    room_id = ARGV[6]
+    redis.call('HSET', KEYS[1], 'id', room_id)
+    redis.call('DEL', KEYS[3])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', admitted)
+if redis.call('ZCARD', KEYS[3]) >= tonumber(ARGV[5]) then
+    save()
+    return false
+end
+next_number = next_number + 1
+redis.call('ZADD', KEYS[3], next_number, next_number)
+admit()
+save()
+redis.call('EXPIRE', KEYS[3], ttl())
+return {room_id, next_number}
+"""
+# ARGV[5] room ID, ARGV[6] number, wait is string (Lua numbers are integers
+# in replies)
+POSITION_SCRIPT = """
+if room_id ~= ARGV[5] then return false end
+save()
+local number = tonumber(ARGV[6])
+if not number or number < 1 or number > next_number then return false end
+if number <= admitted then
+    if redis.call('ZSCORE', KEYS[2], number) then return {0, '0'} end
+    return false
+end
+local ahead = number - admitted
+return {ahead, tostring(math.max(ahead - tokens, 0) / rate)}
+"""
+LEAVE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'id') == ARGV[1] then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+"""
+
+
+class Room:
+    """Queue of one festival"""
+
+    def __init__(self, burst, now):
+        self.id = secrets.token_hex(8)
+        self.next_number = 0
+        self.admitted = 0
+        self.tokens = burst
+        self.updated = now
+        # Admitted numbers not used yet -> deadline, ordered by deadline
+        self.admissions = {}
+        # Client -> its numbers, the waiting ones are above admitted
+        self.clients = {}
+
+
+class LocalWaitingRoom:
+    def __init__(self, rate=5.0, burst=20, admission_seconds=600, per_client=4):
+        self.rate = rate
+        self.burst = burst
+        self.admission_seconds = admission_seconds
+        self.per_client = per_client
+        self._rooms = {}
+        self._lock = Lock()
+
+    def _room(self, fest_id, now):
+        """Room of festival with visitors admitted by tokens accrued until now"""
+        room = self._rooms.get(fest_id)
+        if room is None:
+            room = self._rooms[fest_id] = Room(self.burst, now)
+        room.tokens = min(self.burst, room.tokens + (now - room.updated) * self.rate)
+        room.updated = now
+        self._admit(room, now)
+        return room
+
+    def _admit(self, room, now):
+        admitted = min(int(room.tokens), room.next_number - room.admitted)
+        for number in range(room.admitted + 1, room.admitted + admitted + 1):
+            room.admissions[number] = now + self.admission_seconds
+        room.admitted += admitted
+        room.tokens -= admitted
+        while room.admissions:
+            number = next(iter(room.admissions))
+            if room.admissions[number] >= now:
+                break
+            del room.admissions[number]
+
+    def join(self, fest_id, client):
+        """New number of ``client`` in queue of festival.
+
+        Returns:
+            (room ID, number) or None when client waits with too many numbers
+        """
+        with self._lock:
+            now = time.monotonic()
+            room = self._room(fest_id, now)
+            if len(room.clients) > room.next_number - room.admitted:
+                # Some clients have no waiting numbers
+                for key in list(room.clients):
+                    if room.clients[key][-1] <= room.admitted:
+                        del room.clients[key]
+            numbers = room.clients.setdefault(client, deque())
+            while numbers and numbers[0] <= room.admitted:
+                numbers.popleft()
+            if len(numbers) >= self.per_client:
+                return None
+            room.next_number += 1
+            numbers.append(room.next_number)
+            # Admitted at once when queue is empty and tokens are left
+            self._admit(room, now)
+            return room.id, room.next_number
+
+    def position(self, fest_id, room_id, number):
+        """Visitors before ``number`` and estimated wait in seconds.
+
+        Returns:
+            (0, 0) for admitted visitor, None for number not valid in the
+            room (other room, used or expired admission)
+        """
+        with self._lock:
+            if fest_id not in self._rooms:
+                return None
+            room = self._room(fest_id, time.monotonic())
+            if room_id != room.id or not 0 < number <= room.next_number:
+                return None
+            if number <= room.admitted:
+                return (0, 0) if number in room.admissions else None
+            ahead = number - room.admitted
+            return ahead, round(max(ahead - room.tokens, 0) / self.rate, 1)
+
+    def leave(self, fest_id, room_id, number):
+        """Use up admission of reserved visitor"""
+        with self._lock:
+            room = self._rooms.get(fest_id)
+            if room is not None and room.id == room_id:
+                room.admissions.pop(number, None)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            festivals = {}
+            for fest_id in list(self._rooms):
+                room = self._room(fest_id, now)
+                festivals[fest_id] = {
+                    "joined": room.next_number,
+                    "waiting": room.next_number - room.admitted,
+                    "admitted": len(room.admissions),
+                }
+        return {
+            "backend": "local",
+            "rate": self.rate,
+            "burst": self.burst,
+            "per_client": self.per_client,
+            "festivals": festivals,
+        }
+
+
+class RedisWaitingRoom:
+    def __init__(self, client, rate=5.0, burst=20, admission_seconds=600, per_client=4):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.admission_seconds = admission_seconds
+        self.per_client = per_client
+        self._join = client.register_script(ROOM_SCRIPT + JOIN_SCRIPT)
+        self._position = client.register_script(ROOM_SCRIPT + POSITION_SCRIPT)
+        self._leave = client.register_script(LEAVE_SCRIPT)
+
+    @staticmethod
+    def keys(fest_id):
+        return [f"{REDIS_PREFIX}{fest_id}", f"{REDIS_PREFIX}{fest_id}:admissions"]
+
+    def _args(self):
+        return [time.time(), self.rate, self.burst, self.admission_seconds]
+
+    def join(self, fest_id, client):
+        keys = self.keys(fest_id) + [f"{REDIS_PREFIX}{fest_id}:client:{client}"]
+        joined = self._join(
+            keys=keys, args=self._args() + [self.per_client, secrets.token_hex(8)]
+        )
+        if not joined:
+            return None
+        return joined[0].decode(), joined[1]
+
+    def position(self, fest_id, room_id, number):
+        position = self._position(
+            keys=self.keys(fest_id), args=self._args() + [room_id, number]
+        )
+        if not position:
+            return None
+        return position[0], round(float(position[1]), 1)
+
+    def leave(self, fest_id, room_id, number):
+        self._leave(keys=self.keys(fest_id), args=[room_id, number])
+
+    def stats(self):
+        now = time.time()
+        festivals = {}
+        for key in self.client.scan_iter(match=f"{REDIS_PREFIX}*"):
+            fest_id = key.decode()[len(REDIS_PREFIX) :]
+            if not fest_id.isdigit():
+                # Admissions and numbers of clients
+                continue
+            joined, admitted = self.client.hmget(key, "next", "admitted")
+            joined, admitted = int(joined or 0), int(admitted or 0)
+            festivals[int(fest_id)] = {
+                "joined": joined,
+                "waiting": joined - admitted,
+                "admitted": self.client.zcount(self.keys(fest_id)[1], now, "+inf"),
+            }
+        return {
+            "backend": "redis",
+            "rate": self.rate,
+            "burst": self.burst,
+            "per_client": self.per_client,
+            "festivals": festivals,
+        }
+
+
+def from_config(config):
+    """Waiting room by WAITING_ROOM_BACKEND ("local" or "redis") of app config"""
+    options = (
+        config["WAITING_ROOM_RATE"],
+        config["WAITING_ROOM_BURST"],
+        config["WAITING_ROOM_ADMISSION_SECONDS"],
+        config["WAITING_ROOM_PER_CLIENT"],
+    )
+    if config["WAITING_ROOM_BACKEND"] == "redis":
+        if redis is None:
+            raise ValueError("Redis waiting room backend needs package redis")
+        client = redis.Redis.from_url(config["WAITING_ROOM_REDIS_URL"])
+        return RedisWaitingRoom(client, *options)
+    if config["WAITING_ROOM_BACKEND"] == "local":
+        return LocalWaitingRoom(*options)
+    raise ValueError(f"Unknown waiting room backend {config['WAITING_ROOM_BACKEND']}")
@@ -0,0 +1,105 @@
+"""Tests run the app against SQLite database in temporary directory.
+
+Run from repository root: python -m pytest tests (packages are in
+requirements-test.txt). S3 is replaced by moto, Redis backends are tested
+with fakeredis when it is installed.
+"""
+import os
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+import pytest
+
+# Configuration is read when the app is imported
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ.setdefault("ROOT_PSSWD", "test")
+os.environ["S3_BUCKET"] = "festival-test"
+os.environ.pop("S3_ENDPOINT_URL", None)
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+from festival_is import app as flask_app  # noqa: E402
+from classes import db, Band, Festival, Performance, Stage  # noqa: E402
+from cache import caches  # noqa: E402
+import media  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+    for cache in caches.values():
+        cache.invalidate()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """Bucket in moto, shared S3 client of media is created inside the mock"""
+    moto = pytest.importorskip("moto")
+    with moto.mock_s3():
+        monkeypatch.setattr(media, "_client", None)
+        client = media.s3_client()
+        client.create_bucket(Bucket=flask_app.config["S3_BUCKET"])
+        yield client
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_festival(app):
+    """Festival in 30 days with ``performances`` of different bands on one stage"""
+
+    def make(performances=0, capacity=100):
+        start = datetime.now() + timedelta(days=30)
+        fest = Festival(
+            fest_name="Test",
+            fest_logo="https://festival-test.s3.amazonaws.com/logo.png",
+            description="Festival of tests",
+            style="rock",
+            address="Test, Test street, 1",
+            cost=100,
+            time_from=start,
+            time_to=start + timedelta(days=1),
+            max_capacity=capacity,
+            current_ticket_count=0,
+            age_restriction=0,
+            sale=0,
+            org_id=1,
+            status=1,
+        )
+        stage = Stage(size=capacity, removed=False)
+        db.session.add_all([fest, stage])
+        db.session.flush()
+        for i in range(performances):
+            band = Band(
+                name=f"Band {i}",
+                genre="rock",
+                tags="live;rock",
+                created_on=date.today(),
+            )
+            db.session.add(band)
+            db.session.flush()
+            band.sync_tags()
+            db.session.add(
+                Performance(
+                    fest_id=fest.fest_id,
+                    stage_id=stage.stage_id,
+                    band_id=band.band_id,
+                    canceled=False,
+                    time_from=start + timedelta(hours=i),
+                    time_to=start + timedelta(hours=i, minutes=50),
+                )
+            )
+        db.session.commit()
+        return fest.fest_id
+
+    return make
@@ -0,0 +1,66 @@
+import io
+from datetime import datetime, timedelta
+
+import pytest
+from PIL import Image
+
+import media
+from classes import db, Festival, MediaJob
+
+
+@pytest.fixture
+def pipeline(app, s3):
+    return media.MediaPipeline(
+        retries=1, retry_seconds=0, batch_size=10, lease_seconds=300
+    )
+
+
+def upload_logo(s3, key):
+    image = io.BytesIO()
+    Image.new("RGB", (40, 30), "red").save(image, "PNG")
+    s3.put_object(Bucket=media.app.config["S3_BUCKET"], Key=key, Body=image.getvalue())
+    return media.public_url(key)
+
+
+def submit(pipeline, fest_id, upload_url):
+    pipeline.submit(media.LogoJob("festival", fest_id, upload_url, "fest/logo.png"))
+    Festival.query.filter_by(fest_id=fest_id).update({Festival.fest_logo: upload_url})
+    db.session.commit()
+
+
+def test_job_copies_logo_and_makes_thumbnail(pipeline, s3, make_festival):
+    fest_id = make_festival()
+    submit(pipeline, fest_id, upload_logo(s3, "uploads/logo.png"))
+    assert pipeline.run_due() == {"done": 1, "retried": 0, "failed": 0}
+    fest = Festival.query.get(fest_id)
+    assert fest.fest_logo == media.public_url("fest/logo.png")
+    assert fest.fest_thumbnail == media.public_url("fest/logo-thumb.png")
+    bucket = media.app.config["S3_BUCKET"]
+    thumbnail = s3.get_object(Bucket=bucket, Key="fest/logo-thumb.png")["Body"]
+    assert Image.open(thumbnail).size == media.app.config["THUMBNAIL_SIZE"]
+    assert MediaJob.query.one().status == media.STATUSES["done"]
+
+
+def test_failed_job_is_retried_then_failed(pipeline, make_festival):
+    fest_id = make_festival()
+    submit(pipeline, fest_id, media.public_url("uploads/missing.png"))
+    assert pipeline.run_due() == {"done": 0, "retried": 1, "failed": 0}
+    job = MediaJob.query.one()
+    assert (job.status, job.attempts) == (media.STATUSES["pending"], 1)
+    assert job.error
+    assert pipeline.run_due() == {"done": 0, "retried": 0, "failed": 1}
+    db.session.expire_all()
+    assert MediaJob.query.one().status == media.STATUSES["failed"]
+    assert pipeline.stats()["failed_jobs"][0]["error"]
+
+
+def test_claimed_job_is_leased(pipeline, make_festival):
+    submit(pipeline, make_festival(), media.public_url("uploads/logo.png"))
+    (job,) = pipeline.claim()
+    assert job.run_after > datetime.now() + timedelta(seconds=290)
+    assert pipeline.claim() == []
+    # Worker was killed, the job is run again after its lease
+    MediaJob.query.update({MediaJob.run_after: datetime.now() - timedelta(seconds=1)})
+    db.session.commit()
+    (job,) = pipeline.claim()
+    assert job.attempts == 2
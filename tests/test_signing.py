@@ -0,0 +1,70 @@
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import media
+
+PART_SIZE = 5 * 1024 * 1024
+
+
+def test_sign_posts_signs_every_file(app, s3):
+    files = [("a.png", "image/png"), ("b.jpg", "image/jpeg")]
+    signed = media.sign_posts("fest/1", files)
+    assert [entry["url"] for entry in signed] == [
+        media.public_url("fest/1/a.png"),
+        media.public_url("fest/1/b.jpg"),
+    ]
+    for entry, (name, content_type) in zip(signed, files):
+        fields = entry["data"]["fields"]
+        assert fields["key"] == f"fest/1/{name}"
+        assert fields["Content-Type"] == content_type
+        assert fields["policy"]
+
+
+def test_sign_posts_limits_batch(app, monkeypatch):
+    monkeypatch.setitem(app.config, "UPLOAD_BATCH_SIZE", 1)
+    with pytest.raises(ValueError):
+        media.sign_posts("fest/1", [("a.png", "image/png"), ("b.png", "image/png")])
+
+
+def test_sign_multipart_signs_every_part(app, s3, monkeypatch):
+    monkeypatch.setitem(app.config, "MULTIPART_PART_SIZE", PART_SIZE)
+    data = b"x" * (PART_SIZE + 1024)
+    signed = media.sign_multipart("fest/1/video.mp4", "video/mp4", len(data))
+    assert [part["part_number"] for part in signed["parts"]] == [1, 2]
+    bucket = app.config["S3_BUCKET"]
+    parts = []
+    for part in signed["parts"]:
+        query = parse_qs(urlparse(part["url"]).query)
+        assert query["uploadId"] == [signed["upload_id"]]
+        assert query["partNumber"] == [str(part["part_number"])]
+        # Clients PUT to the signed URL, same part is uploaded here directly
+        start = (part["part_number"] - 1) * PART_SIZE
+        response = s3.upload_part(
+            Bucket=bucket,
+            Key=signed["key"],
+            UploadId=signed["upload_id"],
+            PartNumber=part["part_number"],
+            Body=data[start : start + PART_SIZE],
+        )
+        parts.append((part["part_number"], response["ETag"]))
+    url = media.complete_multipart(signed["key"], signed["upload_id"], parts)
+    assert url == signed["url"]
+    stored = s3.get_object(Bucket=bucket, Key=signed["key"])
+    assert stored["ContentType"] == "video/mp4"
+    assert stored["Body"].read() == data
+
+
+def test_aborted_multipart_is_not_stored(app, s3):
+    signed = media.sign_multipart("fest/1/video.mp4", "video/mp4", 1024)
+    media.abort_multipart(signed["key"], signed["upload_id"])
+    uploads = s3.list_multipart_uploads(Bucket=app.config["S3_BUCKET"])
+    assert not uploads.get("Uploads")
+
+
+def test_sign_multipart_limits_size(app, s3):
+    with pytest.raises(ValueError):
+        media.sign_multipart("fest/1/video.mp4", "video/mp4", 0)
+    with pytest.raises(ValueError):
+        size = app.config["UPLOAD_MAX_BYTES"] + 1
+        media.sign_multipart("fest/1/video.mp4", "video/mp4", size)
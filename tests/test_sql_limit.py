@@ -0,0 +1,32 @@
+import pytest
+
+from instrumentation import TooManyStatements
+
+# Statements of festival page do not depend on size of line up
+LIMIT = 10
+
+
+@pytest.fixture
+def limited(app, monkeypatch):
+    monkeypatch.setitem(app.config, "SQL_STATEMENT_LIMIT", LIMIT)
+
+
+def statements(response):
+    """Number of SQL statements of request from its Server-Timing header"""
+    return int(response.headers["Server-Timing"].split('desc="')[1].split()[0])
+
+
+def test_festival_page_has_no_n_plus_one(client, make_festival, limited):
+    counts = []
+    for performances in (1, 20):
+        response = client.get(f"/festival/{make_festival(performances)}")
+        assert response.status_code == 200
+        counts.append(statements(response))
+    assert counts[0] == counts[1]
+
+
+def test_request_over_limit_fails(client, make_festival, app, monkeypatch):
+    fest_id = make_festival(3)
+    monkeypatch.setitem(app.config, "SQL_STATEMENT_LIMIT", 1)
+    with pytest.raises(TooManyStatements):
+        client.get(f"/festival/{fest_id}")
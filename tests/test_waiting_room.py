@@ -0,0 +1,86 @@
+import pytest
+
+import waiting_room
+
+
+class Clock:
+    """Time of waiting room, moved by tests"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(waiting_room, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["local", "redis"])
+def make_room(request, clock):
+    def make(rate=1.0, burst=2, admission_seconds=60, per_client=2):
+        options = (rate, burst, admission_seconds, per_client)
+        if request.param == "local":
+            return waiting_room.LocalWaitingRoom(*options)
+        fakeredis = pytest.importorskip("fakeredis")
+        return waiting_room.RedisWaitingRoom(fakeredis.FakeRedis(), *options)
+
+    return make
+
+
+def test_admits_in_order_by_rate(make_room, clock):
+    room = make_room(rate=1.0, burst=2)
+    joined = [room.join(1, f"client-{i}") for i in range(4)]
+    assert [number for _, number in joined] == [1, 2, 3, 4]
+    assert [room.position(1, *entry)[0] for entry in joined] == [0, 0, 1, 2]
+    clock.now += 1
+    assert [room.position(1, *entry)[0] for entry in joined] == [0, 0, 0, 1]
+    clock.now += 1
+    assert room.position(1, *joined[3])[0] == 0
+
+
+def test_admits_at_once_when_queue_is_empty(make_room):
+    room = make_room(burst=1)
+    assert room.position(1, *room.join(1, "client")) == (0, 0)
+
+
+def test_admission_expires(make_room, clock):
+    room = make_room(admission_seconds=60)
+    entry = room.join(1, "client")
+    clock.now += 59
+    assert room.position(1, *entry) == (0, 0)
+    clock.now += 2
+    assert room.position(1, *entry) is None
+
+
+def test_admission_is_used_up(make_room):
+    room = make_room()
+    entry = room.join(1, "client")
+    room.leave(1, *entry)
+    assert room.position(1, *entry) is None
+
+
+def test_numbers_are_valid_only_in_their_room(make_room):
+    room = make_room()
+    room_id, number = room.join(1, "client")
+    assert room.position(2, room_id, number) is None
+    assert room.position(1, "other", number) is None
+    assert room.position(1, room_id, number + 1) is None
+
+
+def test_client_waits_with_limited_numbers(make_room, clock):
+    room = make_room(rate=1.0, burst=1, per_client=2)
+    room.join(1, "other")
+    assert room.join(1, "client") is not None
+    assert room.join(1, "client") is not None
+    assert room.join(1, "client") is None
+    # Admitted numbers do not count
+    clock.now += 1
+    assert room.join(1, "client") is not None